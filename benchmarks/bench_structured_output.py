@@ -0,0 +1,146 @@
+# benchmarks/bench_structured_output.py
+"""
+比較舊的正規表示式 JSON 提取與 services.structured_output.extract_json。
+
+執行方式 (於專案根目錄)：
+    python -m benchmarks.bench_structured_output [--repeat N]
+
+輸出每個語料項目的正確性，以及兩種方法的平均耗時。
+"""
+import re
+import json
+import time
+import argparse
+from typing import Any, Dict, List, Optional, Tuple
+
+from services.structured_output import extract_json
+
+
+def legacy_parse(raw_text: str) -> Optional[Dict]:
+    """重現先前 GeminiService._parse_structured_output 的邏輯 (失敗時返回 None)"""
+    match = re.search(r"```json\s*(\{[\s\S]*?\})\s*```|(\{[\s\S]*?\})", raw_text, re.DOTALL)
+    if not match:
+        return None
+    json_str = match.group(1) if match.group(1) else match.group(2)
+    try:
+        data = json.loads(json_str, strict=False)
+        return data if isinstance(data, dict) else None
+    except json.JSONDecodeError:
+        fixed_json_str = re.sub(r',\s*([\}\]])', r'\1', json_str)
+        try:
+            return json.loads(fixed_json_str, strict=False)
+        except json.JSONDecodeError:
+            return None
+
+
+_TURN = {
+    "internal_thought": "使用者今天好像很累，我想安慰他 {但不要太誇張}。",
+    "spoken_response": "辛苦了！要不要先休息一下？我陪你聊聊天～",
+    "user_emotions": {"tiredness": 0.7, "sadness": 0.2},
+    "appraisal": {"novelty": 0.2, "pleasantness": -0.3, "goal_conduciveness": -0.2, "coping_potential": 0.5, "urgency": 0.1},
+}
+
+# (名稱, 原始輸出, 期望結果)
+CORPUS: List[Tuple[str, str, Any]] = [
+    ("flat_fenced",
+     "```json\n{\"internal_thought\": \"開心\", \"spoken_response\": \"太好了！\"}\n```",
+     {"internal_thought": "開心", "spoken_response": "太好了！"}),
+    ("flat_bare",
+     "{\"internal_thought\": \"嗯\", \"spoken_response\": \"好喔\"}",
+     {"internal_thought": "嗯", "spoken_response": "好喔"}),
+    ("single_call_turn_nested",
+     "```json\n" + json.dumps(_TURN, ensure_ascii=False, indent=2) + "\n```",
+     _TURN),
+    ("prose_before_and_after",
+     "好的，以下是我的回應：\n" + json.dumps(_TURN, ensure_ascii=False) + "\n希望這樣可以！",
+     _TURN),
+    ("brace_inside_string",
+     "{\"internal_thought\": \"記得 } 這個符號\", \"spoken_response\": \"用 {大括號} 包起來\"}",
+     {"internal_thought": "記得 } 這個符號", "spoken_response": "用 {大括號} 包起來"}),
+    ("raw_newline_in_string",
+     "{\"internal_thought\": \"第一行\n第二行\", \"spoken_response\": \"嗨\"}",
+     {"internal_thought": "第一行\n第二行", "spoken_response": "嗨"}),
+    ("trailing_commas",
+     "```json\n{\"internal_thought\": \"a\", \"spoken_response\": \"b\", \"user_emotions\": {\"joy\": 0.5,},}\n```",
+     {"internal_thought": "a", "spoken_response": "b", "user_emotions": {"joy": 0.5}}),
+    ("truncated_max_tokens",
+     "{\"internal_thought\": \"想了很多\", \"spoken_response\": \"我覺得這件事情其實可以從另一個角度來看",
+     {"internal_thought": "想了很多", "spoken_response": "我覺得這件事情其實可以從另一個角度來看"}),
+    ("python_literals",
+     "{\"is_question\": True, \"topic\": None, \"score\": 0.4}",
+     {"is_question": True, "topic": None, "score": 0.4}),
+    ("emotion_analysis",
+     "```json\n{\"joy\": 0.8, \"neutral\": 0.2}\n```",
+     {"joy": 0.8, "neutral": 0.2}),
+    ("stray_braces_before_json",
+     "回應格式 {範例} 如下：{\"spoken_response\": \"哈囉\"}",
+     {"spoken_response": "哈囉"}),
+    ("no_json_at_all",
+     "今天天氣真好，我們出去走走吧！",
+     None),
+]
+
+# 陣列輸出 (反思工作者)；舊做法是另一組非貪婪的陣列正規表示式
+ARRAY_CORPUS: List[Tuple[str, str, Any]] = [
+    ("reflection_array",
+     "```json\n[{\"insight_type\": \"emerging_interest\", \"description\": \"對星星有興趣\", "
+     "\"trait_suggestion\": {\"trait_type\": \"favorite_topic\", \"trait_value\": \"天文 [星座]\"}}]\n```",
+     [{"insight_type": "emerging_interest", "description": "對星星有興趣",
+       "trait_suggestion": {"trait_type": "favorite_topic", "trait_value": "天文 [星座]"}}]),
+    ("reflection_empty", "[]", []),
+]
+
+
+def legacy_parse_array(raw_text: str) -> Optional[List]:
+    match = re.search(r"```json\s*(\[[\s\S]*?\])\s*```|(\[[\s\S]*?\])", raw_text, re.DOTALL)
+    if not match:
+        return None
+    try:
+        data = json.loads(match.group(1) or match.group(2))
+        return data if isinstance(data, list) else None
+    except json.JSONDecodeError:
+        return None
+
+
+def _time_per_call(func, texts: List[str], repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            func(text)
+    return (time.perf_counter() - start) / (repeat * len(texts)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    cases = [(name, raw, expected, legacy_parse, lambda t: extract_json(t, expected_type=dict)) for name, raw, expected in CORPUS]
+    cases += [(name, raw, expected, legacy_parse_array, lambda t: extract_json(t, expected_type=list)) for name, raw, expected in ARRAY_CORPUS]
+
+    legacy_ok = new_ok = 0
+    print(f"{'case':<28}{'legacy':>8}{'new':>8}")
+    for name, raw, expected, legacy_func, new_func in cases:
+        legacy_correct = legacy_func(raw) == expected
+        new_correct = new_func(raw) == expected
+        legacy_ok += legacy_correct
+        new_ok += new_correct
+        print(f"{name:<28}{'ok' if legacy_correct else 'FAIL':>8}{'ok' if new_correct else 'FAIL':>8}")
+    print(f"{'correct':<28}{legacy_ok:>5}/{len(cases)}{new_ok:>5}/{len(cases)}")
+
+    texts = [raw for _, raw, _ in CORPUS]
+    legacy_us = _time_per_call(legacy_parse, texts, args.repeat)
+    new_us = _time_per_call(lambda t: extract_json(t, expected_type=dict), texts, args.repeat)
+    print(f"\nmean time per call over {len(texts)} object cases x {args.repeat}:")
+    print(f"  legacy regex : {legacy_us:8.1f} µs")
+    print(f"  extract_json : {new_us:8.1f} µs")
+
+    # 大型輸出 (例如長篇摘要) 下的擴展性
+    big = json.dumps({"spoken_response": "星" * 20000, "items": [{"k": i} for i in range(2000)]}, ensure_ascii=False)
+    print(f"\nlarge output ({len(big)} chars):")
+    print(f"  legacy regex : {_time_per_call(legacy_parse, [big], 20):8.1f} µs (correct={legacy_parse(big) == json.loads(big)})")
+    print(f"  extract_json : {_time_per_call(lambda t: extract_json(t, expected_type=dict), [big], 20):8.1f} µs (correct={extract_json(big) == json.loads(big)})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# benchmarks/bench_turn_latency.py
+"""
+在沒有網路的環境下量測 PetLogic 的回合延遲、首字延遲與排程器行為。
+
+使用合成回應 (預設) 或既有的卡帶重播，LLM 服務仍包含排程器、速率限制、
+分析快取與 JSON 解析，因此量到的是應用程式本身加上注入延遲的表現。
+
+執行方式 (於專案根目錄)：
+    python -m benchmarks.bench_turn_latency [--mode synthetic|replay] [--turns 20]
+        [--latency-ms 800] [--background 6] [--cassette-dir DIR]
+"""
+import os
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import statistics
+from typing import List
+
+import config
+from database import DatabaseManager
+from services.offline_services import MODE_SYNTHETIC, MODE_REPLAY, LatencyModel, build_offline_services
+from services.rate_limiter import RateLimiter
+from services.llm_scheduler import PRIORITY_LEARNING
+
+USER_MESSAGES = [
+    "今天上班好累喔，老闆一直改需求。",
+    "你知道高雄有什麼好吃的嗎？",
+    "我剛剛看完一部很感人的電影！",
+    "明天要考試了，有點緊張。",
+    "週末想去爬山，你覺得好嗎？",
+]
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mode", choices=[MODE_SYNTHETIC, MODE_REPLAY], default=MODE_SYNTHETIC)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=800.0, help="每次 LLM 請求注入的延遲")
+    parser.add_argument("--background", type=int, default=6, help="同時送出的背景 (learning) 請求數")
+    parser.add_argument("--cassette-dir", default=config.CASSETTE_DIR)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # 合成負載不應受每日配額影響
+    unlimited = {name: {"rpm": 100000, "tpm": 10 ** 9, "rpd": 10 ** 9} for name in
+                 list(config.LLM_RATE_LIMITS) + list(config.LLM_TIER_MODELS.values())}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = DatabaseManager(os.path.join(tmp_dir, "bench.db"))
+        llm, search = build_offline_services(
+            args.mode, db, config.DEFAULT_APP_SETTINGS[config.SETTING_SELECTED_LLM], args.cassette_dir,
+            latency=LatencyModel(fixed_ms=args.latency_ms, jitter_ms=args.latency_ms * 0.2),
+            rate_limiter=RateLimiter(db, model_limits=unlimited)
+        )
+        from core.pet_logic import PetLogic  # 延後匯入，避免在解析參數前載入整個核心
+        logic = PetLogic(db_manager=db, llm_service=llm, search_service=search)
+        logic.is_sleeping = False
+        logic._check_sleep_schedule = lambda: None
+
+        # 背景負載：持續送出 learning 等級的請求，觀察互動回合是否被拖慢
+        stop = threading.Event()
+
+        def background_worker():
+            while not stop.is_set():
+                llm.generate_content({
+                    "contents": [{"role": "user", "parts": [{"text": "請用 JSON 陣列總結：背景學習工作"}]}],
+                    "generation_config": {"temperature": 0.3, "max_output_tokens": 200},
+                    "priority": PRIORITY_LEARNING,
+                })
+
+        workers = [threading.Thread(target=background_worker, daemon=True) for _ in range(args.background)]
+        for worker in workers:
+            worker.start()
+
+        turn_ms: List[float] = []
+        first_text_ms: List[float] = []
+        for idx in range(args.turns):
+            started = time.perf_counter()
+            first = {}
+
+            def on_stream(delta: str, first=first, started=started):
+                first.setdefault("at", time.perf_counter() - started)
+
+            logic.is_processing_llm = False
+            logic.handle_user_input(USER_MESSAGES[idx % len(USER_MESSAGES)], on_stream=on_stream)
+            turn_ms.append((time.perf_counter() - started) * 1000)
+            if "at" in first:
+                first_text_ms.append(first["at"] * 1000)
+
+        stop.set()
+
+        print(f"mode={args.mode} turns={args.turns} injected_latency={args.latency_ms:.0f}ms background_workers={args.background}")
+        print(f"turn latency    : p50 {_percentile(turn_ms, 0.5):7.0f} ms  p95 {_percentile(turn_ms, 0.95):7.0f} ms  mean {statistics.mean(turn_ms):7.0f} ms")
+        if first_text_ms:
+            print(f"first character : p50 {_percentile(first_text_ms, 0.5):7.0f} ms  p95 {_percentile(first_text_ms, 0.95):7.0f} ms")
+        print(f"offline stats   : {llm.stats} search={search.stats}")
+        print("scheduler       :")
+        for priority, stats in llm.scheduler.get_stats().items():
+            print(f"  {priority:<12} admitted={stats['admitted']:<4} dropped={stats['dropped']:<3} "
+                  f"queue p50/p95={stats['queue_latency']['p50_ms']}/{stats['queue_latency']['p95_ms']} ms "
+                  f"total p50/p95={stats['total_latency']['p50_ms']}/{stats['total_latency']['p95_ms']} ms")
+
+
+if __name__ == "__main__":
+    main()
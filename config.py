@@ -30,6 +30,7 @@ EMOTIONS = {name: 0.5 for name in [
     'pessimism','trust','distrust','surprise','anticipation','regret','remorse','neutral'
 ]}
 POSITIVE_EMOTIONS = {'joy', 'excitement', 'admiration', 'adoration', 'amusement', 'awe', 'calmness', 'satisfaction', 'relief', 'hope', 'gratitude', 'compassion', 'love', 'contentment', 'optimism', 'trust', 'pride', 'triumph', 'entrancement', 'aesthetic_appreciation', 'romance', 'sexual_desire'}
+APPRAISAL_DIMENSIONS = ["novelty", "pleasantness", "goal_conduciveness", "coping_potential", "urgency"]
 NEGATIVE_EMOTIONS = {'sadness', 'anger', 'fear', 'disgust', 'anxiety', 'boredom', 'confusion', 'craving', 'empathetic_pain', 'envy', 'horror', 'nostalgia', 'guilt', 'shame', 'embarrassment', 'hatred', 'jealousy', 'frustration', 'disappointment', 'pessimism', 'distrust', 'surprise', 'anticipation', 'regret', 'remorse', 'awkwardness'}
 
 # --- 設定鍵名常量 ---
@@ -66,6 +67,14 @@ SETTING_LAST_NEWS_SEARCH_TIMESTAMP = 'last_news_search_timestamp'
 SETTING_SEARCH_API_CALL_COUNT = 'search_api_call_count'
 SETTING_SEARCH_API_LAST_RESET_DATE = 'search_api_last_reset_date'
 SETTING_INITIAL_PERSONALITY_SETUP_DONE = 'initial_personality_setup_done'
+SETTING_PROMPT_TOKEN_BUDGET = 'prompt_token_budget'
+SETTING_PROMPT_EXACT_TOKEN_COUNT = 'prompt_exact_token_count'
+SETTING_SINGLE_CALL_TURN = 'single_call_turn_enabled'
+SETTING_STREAMING_RESPONSES = 'streaming_responses_enabled'
+SETTING_LLM_USAGE_COUNTERS = 'llm_usage_counters' # 內部狀態：今日各模型請求/token 用量 (JSON)
+SETTING_SEARCH_SAVED_COUNTERS = 'search_saved_counters' # 內部狀態：今日由快取省下的搜尋次數 (JSON)
+SETTING_SEARCH_PREFETCH_USAGE = 'search_prefetch_usage' # 內部狀態：今日預先搜尋已用次數 (JSON)
+SETTING_CONVERSATION_STATE = 'conversation_state' # 內部狀態：最近對話視窗、待摘要訊息與滾動摘要 (JSON)
 
 # --- 個體特徵類型與來源常數 ---
 TRAIT_TYPE_PREFERENCE = "preference"
@@ -102,7 +111,11 @@ DEFAULT_APP_SETTINGS = {
     SETTING_LAST_NEWS_SEARCH_TIMESTAMP: 0,
     SETTING_SEARCH_API_CALL_COUNT: 0,
     SETTING_SEARCH_API_LAST_RESET_DATE: "",
-    SETTING_INITIAL_PERSONALITY_SETUP_DONE: 0
+    SETTING_INITIAL_PERSONALITY_SETUP_DONE: 0,
+    SETTING_PROMPT_TOKEN_BUDGET: 6000, # 單次提示 (不含輸出) 的 token 預算
+    SETTING_PROMPT_EXACT_TOKEN_COUNT: 0, # 1 = 每次額外呼叫服務端 count_tokens 取得精確數字
+    SETTING_SINGLE_CALL_TURN: 1, # 1 = 主要生成同時回傳使用者情緒與事件評價，省去獨立的分析呼叫
+    SETTING_STREAMING_RESPONSES: 1 # 1 = 串流生成，口頭回應邊產生邊顯示在聊天視窗
 }
 DEFAULT_CHARACTER_TRAITS = {
     SETTING_OCEAN_OPENNESS: 0.5, SETTING_OCEAN_CONSCIENTIOUSNESS: 0.5, SETTING_OCEAN_EXTRAVERSION: 0.5,
@@ -114,6 +127,165 @@ DEFAULT_DEMOGRAPHICS = {
 }
 DEMOGRAPHIC_KEYS = list(DEFAULT_DEMOGRAPHICS.keys())
 AVAILABLE_LLM_MODELS = [ "gemini-2.5-flash", "gemini-2.5-flash-lite"]
+# --- 批次分析 (analyze_texts_for_emotions_batch / appraise_events_batch) ---
+LLM_BATCH_ANALYSIS_INPUT_TOKENS = 2000 # 每次批次呼叫的輸入文字預算，超過時自動分塊
+LLM_BATCH_ANALYSIS_MAX_ITEMS = 20
+LLM_BATCH_OUTPUT_TOKENS_PER_ITEM = 80
+LLM_BATCH_ANALYSIS_TIMEOUT_SECONDS = 40.0
+
+# --- 文字向量 (services/embedding_service.py) ---
+EMBEDDING_BACKEND = "auto" # auto = 有 Gemini 金鑰時用 Gemini，否則用本地雜湊向量；也可指定 gemini / local
+GEMINI_EMBEDDING_MODEL = "models/text-embedding-004"
+GEMINI_EMBEDDING_BATCH_SIZE = 100 # embed_content 單次請求的文字數上限
+LOCAL_EMBEDDING_DIMENSIONS = 512
+EMBEDDING_CACHE_MEMORY_ENTRIES = 4096
+EMBEDDING_CACHE_MAX_DB_ENTRIES = 50000
+
+# --- 任務模型分級 (services/llm_tasks.py) ---
+# chat = 使用者選擇的模型；其餘分級對應到固定模型
+LLM_TIER_MODELS = {"lite": "gemini-2.5-flash-lite"}
+# 便宜的背景與分析任務使用 lite，省下費用與主要模型的速率額度給互動回合
+LLM_TASK_TIERS = {
+    "chat": "chat", "tool_followup": "chat",
+    "correction_analysis": "chat", "thought_reflection": "chat",
+    "emotion_analysis": "lite", "event_appraisal": "lite",
+    "user_text_learning": "lite", "pet_text_learning": "lite",
+    "regulation_thought": "lite", "memory_summary": "lite",
+    "conversation_summary": "lite",
+}
+
+# --- LLM 分析快取 (analyze_text_for_emotions / appraise_event) ---
+ANALYSIS_CACHE_TTL_SECONDS = 7 * 24 * 3600
+ANALYSIS_CACHE_MEMORY_ENTRIES = 512 # 程序內 LRU 的容量
+ANALYSIS_CACHE_MAX_DB_ENTRIES = 5000 # SQLite 中保留的最大筆數
+
+# --- LLM 呼叫的可靠性設定 (services/async_llm_service.py) ---
+LLM_CALL_TIMEOUT_SECONDS = 45.0 # 主要對話生成的總期限 (含重試)
+LLM_ANALYSIS_TIMEOUT_SECONDS = 20.0 # 分析類輕量呼叫的總期限
+LLM_MAX_RETRIES = 3 # 可重試錯誤 (429/5xx/連線) 的最大重試次數
+LLM_RETRY_BASE_DELAY_SECONDS = 0.5 # 指數退避的起始間隔 (搭配完整抖動)
+LLM_RETRY_MAX_DELAY_SECONDS = 8.0
+LLM_MAX_CONCURRENT_CALLS = 4 # 全域同時進行的 LLM 請求上限 (路由下的所有後端共用，見 services/async_runtime.py)
+LLM_CIRCUIT_FAILURE_THRESHOLD = 5 # 連續失敗幾次後斷路
+LLM_CIRCUIT_RESET_SECONDS = 30.0 # 斷路後多久允許一次試探請求
+
+# --- 工具呼叫循環 (services/tool_loop.py) ---
+LLM_TOOL_MAX_DEPTH = 3 # 一個回合最多幾輪「執行工具 → 回傳結果給模型」
+LLM_TOOL_MAX_PARALLEL = 4 # 同時執行的工具呼叫上限
+LLM_TOOL_TIMEOUT_SECONDS = 15.0 # 單一工具呼叫的預設逾時
+LLM_TOOL_TIMEOUTS = {"custom_search": 20.0} # 個別工具的逾時覆寫
+
+# --- 多模型路由 (services/model_router.py) ---
+LLM_ROUTER_ENABLED = True # 以 AVAILABLE_LLM_MODELS 中的其他模型作為備援
+LLM_ROUTER_STATS_WINDOW = 50 # 每個模型保留最近幾次呼叫的延遲與成敗
+LLM_ROUTER_COOLDOWN_FAILURES = 3 # 連續失敗幾次後暫時把該模型排到最後
+LLM_ROUTER_COOLDOWN_SECONDS = 60.0
+LLM_ROUTER_MAX_ERROR_RATE = 0.5 # 視窗內錯誤率超過此值視為不健康
+LLM_HEDGE_ENABLED = False # 對沖請求會在慢的回合多花一次呼叫，預設關閉
+LLM_HEDGE_MIN_SAMPLES = 10 # 主要模型至少累積幾筆成功延遲後才開始對沖
+LLM_HEDGE_MIN_DELAY_SECONDS = 1.5 # 對沖等待時間的下限 (實際為 max(此值, p90))
+
+# --- LLM 請求優先排程 (services/llm_scheduler.py) ---
+LLM_SCHEDULER_INTERACTIVE_RESERVE = 1 # 保留給使用者回合的名額，背景工作不可佔用
+LLM_SCHEDULER_CLASS_CAPS = {"interactive": 4, "proactive": 1, "learning": 2, "maintenance": 1}
+LLM_SCHEDULER_QUEUE_DEADLINES = {"interactive": None, "proactive": 30.0, "learning": 120.0, "maintenance": 300.0} # 秒；None = 不捨棄
+
+# --- 速率限制與配額 (services/rate_limiter.py) ---
+# 每個模型的每分鐘請求數 / 每分鐘 token 數 / 每日請求數，請依帳戶的實際方案調整
+LLM_RATE_LIMITS = {
+    "gemini-2.5-flash": {"rpm": 10, "tpm": 250000, "rpd": 250},
+    "gemini-2.5-flash-lite": {"rpm": 15, "tpm": 250000, "rpd": 1000},
+    "text-embedding-004": {"rpm": 1500, "tpm": 1000000, "rpd": 100000},
+}
+LLM_RATE_LIMIT_DEFAULT = {"rpm": 10, "tpm": 250000, "rpd": 250}
+SEARCH_DAILY_QUOTA = 100 # Custom Search 免費方案每日 100 次
+SEARCH_RATE_LIMIT_RPM = 60
+SEARCH_QUOTA_INTERACTIVE_RESERVE = 20 # 每日配額中保留給使用者對話 (工具呼叫) 的次數
+# --- 搜尋結果快取 (services/search_cache.py) ---
+SEARCH_LANGUAGE_RESTRICT = "lang_zh-TW" # Custom Search 的 lr 參數，優先顯示繁體中文結果
+# 依查詢類別的 TTL：新聞與天氣很快過時，一般知識類查詢的結果很少變動
+SEARCH_CACHE_TTL_SECONDS = {"news": 3 * 3600, "weather": 30 * 60, "general": 7 * 24 * 3600}
+SEARCH_QUERY_CLASS_KEYWORDS = {
+    "weather": ["天氣", "氣溫", "溫度", "下雨", "降雨", "颱風", "空氣品質", "weather", "forecast"],
+    "news": ["新聞", "頭條", "焦點", "最新", "今日", "今天", "股價", "匯率", "比分", "news", "headline"],
+}
+SEARCH_QUERY_FILLER_WORDS = ["請問", "幫我", "查一下", "一下", "如何", "怎麼樣", "怎樣", "的", "嗎", "呢", "吧", "了"]
+SEARCH_QUERY_SYNONYMS = {"今天": "今日", "臺": "台", "現在": "目前"}
+SEARCH_CACHE_NEAR_DUPLICATE_MIN_JACCARD = 0.9 # 近似查詢的特徵集合相似度下限 (短查詢實際上需要完全相同)
+SEARCH_CACHE_STALE_GRACE_SECONDS = 24 * 3600 # 過期結果保留多久，供配額用盡或 API 失敗時使用
+SEARCH_CACHE_MEMORY_ENTRIES = 256
+SEARCH_CACHE_MAX_DB_ENTRIES = 2000
+SEARCH_INFLIGHT_WAIT_SECONDS = 30.0 # 相同查詢併發時，跟隨者等待第一個請求的上限
+SEARCH_MAX_CONCURRENT_REQUESTS = 4 # search_many 同時進行的搜尋請求上限 (services/async_search_service.py)
+DAILY_NEWS_SEARCH_QUERIES = ["今日國際焦點新聞", "今日台灣重要新聞"] # 每日新聞搜尋並行送出的查詢
+SEARCH_DISCOVERY_CACHE_PATH = os.path.join(BASE_DIR, "customsearch_discovery.json") # 內附文件不可用時，下載的 discovery 文件快取
+
+# --- 本地知識庫 (services/local_knowledge_service.py) ---
+LOCAL_KNOWLEDGE_MIN_COVERAGE = 0.7 # 查詢的字詞至少有多少比例出現在文件中才算命中，否則改用網路搜尋
+LOCAL_KNOWLEDGE_SNIPPET_CHARS = 120
+LOCAL_KNOWLEDGE_CHUNK_CHARS = 500 # 匯入文件時每個索引片段的最大長度
+LOCAL_KNOWLEDGE_SEARCH_MAX_AGE_SECONDS = 30 * 24 * 3600 # 網路搜尋結果在知識庫中可用來回答的最長時間，超過後刪除並重新搜尋
+LOCAL_KNOWLEDGE_MAX_SEARCH_DOCUMENTS = 2000 # 知識庫中保留的網路搜尋結果筆數上限 (保留最新的)
+
+# --- 閒置時預先搜尋 (core/search_prefetcher.py) ---
+SEARCH_PREFETCH_MIN_IDLE_SECONDS = 300 # 使用者閒置多久後才開始預取
+SEARCH_PREFETCH_RUN_INTERVAL_SECONDS = 1800 # 兩輪預取之間的最短間隔
+SEARCH_PREFETCH_MAX_TOPICS = 5 # 從最感興趣的幾個主題中挑選
+SEARCH_PREFETCH_MAX_TOPIC_CHARS = 20
+SEARCH_PREFETCH_TOPICS_PER_RUN = 3
+SEARCH_PREFETCH_DAILY_BUDGET = 8 # 每日預取最多使用的搜尋次數
+SEARCH_PREFETCH_MIN_QUOTA_HEADROOM = 10 # 背景可用的搜尋配額低於此值時不再預取
+SEARCH_PREFETCH_QUERY_TEMPLATE = "{topic} 最新消息"
+SEARCH_PREFETCH_RESULTS_PER_TOPIC = 3
+SEARCH_PREFETCH_REFRESH_AGE_SECONDS = 6 * 3600 # 預取結果超過此時間後重新搜尋
+SEARCH_PREFETCH_SERVE_MAX_AGE_SECONDS = 12 * 3600 # 超過此時間的預取結果不再用來回答
+SEARCH_PREFETCH_MATCH_MIN_COVERAGE = 0.8 # 工具查詢的特徵有多少比例落在預取查詢中才算命中
+RATE_LIMIT_MAX_WAIT_SECONDS = {"interactive": 15.0, "proactive": 5.0, "learning": 0.0, "maintenance": 0.0} # 等不到額度就捨棄
+RATE_LIMIT_PERSIST_INTERVAL_SECONDS = 10.0 # LLM 用量與快取統計寫入資料庫的最短間隔 (搜尋配額計數每次都寫入)
+
+# --- 對話回合管線 (core/turn_pipeline.py) ---
+TURN_POST_PROCESSING_WAIT_SECONDS = 2.0 # 擷取記憶前等待上一回合背景持久化的上限
+TURN_TIMINGS_HISTORY = 50 # 除錯報告中統計階段耗時的回合數
+
+# --- 對話歷史 (core/conversation_history.py) ---
+CONVERSATION_HISTORY_WINDOW = 10 # 保留原文的最近訊息數 (一問一答為兩則)
+CONVERSATION_SUMMARY_BATCH = 4 # 擠出視窗的訊息累積幾則後併入摘要
+CONVERSATION_PENDING_MAX = 20 # 無法摘要時最多保留幾則待摘要訊息
+CONVERSATION_SUMMARY_MAX_CHARS = 600
+
+# --- 系統提示的穩定前綴 (core/prompt_packer.py StablePrefixCache) ---
+CHARACTERISTICS_DESCRIPTION_REFRESH_SECONDS = 3600 # 個體特徵依時間衰減重新排序的間隔
+STABLE_PREFIX_CACHE_ENTRIES = 8
+# 服務端上下文快取 (Gemini CachedContent)：前綴夠長時才值得建立，且會產生儲存費用，預設關閉
+LLM_CONTEXT_CACHE_ENABLED = False
+LLM_CONTEXT_CACHE_MIN_TOKENS = 1024 # 低於服務端的最小可快取長度時不建立
+LLM_CONTEXT_CACHE_TTL_SECONDS = 3600
+
+# --- 離線後端 (services/offline_services.py)，以環境變數切換 ---
+# live = 真實 API；record = 呼叫真實 API 並錄製卡帶；replay = 只用卡帶；synthetic = 合成回應
+BACKEND_MODE = os.environ.get("DESKPET_BACKEND_MODE", "live").lower()
+CASSETTE_DIR = os.environ.get("DESKPET_CASSETTE_DIR", os.path.join(BASE_DIR, "cassettes"))
+REPLAY_LATENCY_MS = os.environ.get("DESKPET_REPLAY_LATENCY_MS") # 未設定時使用錄製時的延遲
+
+# --- 啟動 (main.py：視窗先顯示，LLM/搜尋/向量服務在背景建構) ---
+STARTUP_SERVICES_WAIT_SECONDS = 30.0 # 服務尚在建構時，使用者輸入最多等待多久
+
+# --- 背景工作池 (services/worker_pool.py)：所有背景工作都經由具名工作池派送 ---
+# policy：reject = 佇列滿時拒絕新工作；drop_oldest = 取消最舊的排隊工作；caller_runs = 由呼叫端執行緒直接執行
+WORKER_POOLS = {
+    "ui_submit": {"max_workers": 1, "max_queue": 1, "policy": "reject"}, # 使用者送出的訊息與回饋
+    "periodic": {"max_workers": 1, "max_queue": 0, "policy": "reject"}, # 定期維護；上一輪未結束時略過這一輪
+    "maintenance": {"max_workers": 2, "max_queue": 8, "policy": "reject"}, # 啟動服務建構、初始設定、每日新聞、閒置預取
+    "learning": {"max_workers": 2, "max_queue": 32, "policy": "drop_oldest"}, # 特徵學習、糾正、反思、對話摘要、情緒調節
+    "turn_stages": {"max_workers": 3, "max_queue": 8, "policy": "caller_runs"}, # 回合的平行前置階段 (core/turn_pipeline.py)
+    "post_turn": {"max_workers": 1, "max_queue": 32, "policy": "caller_runs", "drain_on_shutdown": True}, # 回合後的記憶寫入 (依序)
+    # 工具呼叫的逾時靠 Future 等待實作，不能由呼叫端執行；佇列滿時該呼叫以錯誤結果回報給模型
+    "tool_calls": {"max_workers": LLM_TOOL_MAX_PARALLEL, "max_queue": 16, "policy": "reject"},
+    "search_io": {"max_workers": SEARCH_MAX_CONCURRENT_REQUESTS, "max_queue": 32, "policy": "caller_runs"},
+    "llm_hedge": {"max_workers": 4, "max_queue": 8, "policy": "caller_runs"}, # 多模型路由的對沖請求
+}
+WORKER_POOL_IDLE_SECONDS = 60.0 # 閒置的工作執行緒多久後退出
+WORKER_POOL_SHUTDOWN_TIMEOUT_SECONDS = 5.0 # 關閉視窗時等待背景工作結束的上限
 
 # --- UI 顯示用列表 ---
 ALL_TRAIT_TYPES_DISPLAY = ["(所有類型)"] + [
@@ -0,0 +1,150 @@
+# core/conversation_history.py
+import json
+import logging
+import threading
+from collections import deque
+from typing import Dict, Any, List, Optional, Deque
+
+import config
+from database import DatabaseManager
+from services.base_services import LLMService
+from services.llm_scheduler import PRIORITY_LEARNING, with_priority
+from services.llm_tasks import TASK_CONVERSATION_SUMMARY
+from services.worker_pool import worker_pools
+
+_ROLE_NAMES = {"user": "使用者", "model": "小星"}
+
+
+def entry_text(entry: Dict[str, Any]) -> str:
+    """取出對話歷史條目中的文字內容"""
+    return "".join(part.get("text", "") for part in entry.get("parts", []) if isinstance(part, dict))
+
+
+class ConversationHistory:
+    """
+    有上限的對話歷史：最近 CONVERSATION_HISTORY_WINDOW 則訊息 + 一段滾動摘要。
+
+    被擠出視窗的訊息先放進 pending (提示中仍照常帶上)，累積 CONVERSATION_SUMMARY_BATCH 則後
+    在背景以輕量模型把它們併入既有摘要，完成後才從 pending 移除；沒有 LLM 或摘要失敗時，
+    pending 超過 CONVERSATION_PENDING_MAX 則的部分直接捨棄。
+    視窗、pending 與摘要存在 app_settings (SETTING_CONVERSATION_STATE)，重啟後直接恢復上下文，
+    不必重播原始對話紀錄。
+    """
+
+    def __init__(self, db_manager: DatabaseManager, llm_service: Optional[LLMService] = None,
+                 window: int = config.CONVERSATION_HISTORY_WINDOW):
+        self.db = db_manager
+        self.llm = llm_service
+        self._entries: Deque[Dict[str, Any]] = deque(maxlen=window)
+        self._pending: List[Dict[str, Any]] = []
+        self.summary = ""
+        self._lock = threading.Lock()
+        self._summarizing = threading.Lock()
+        self.stats = {"summaries": 0, "summarized_entries": 0, "dropped_entries": 0}
+        self._load()
+
+    def _load(self):
+        try:
+            state = json.loads(self.db.load_app_setting(config.SETTING_CONVERSATION_STATE, "") or "{}")
+        except json.JSONDecodeError:
+            logging.warning("Stored conversation state is corrupted; starting with an empty history.")
+            state = {}
+        self.summary = state.get("summary", "")
+        self._pending = list(state.get("pending", []))
+        for entry in state.get("entries", []):
+            self._append_locked(entry)
+        if state:
+            logging.info(f"Conversation history restored: {len(self._entries)} recent, "
+                         f"{len(self._pending)} pending, summary {len(self.summary)} chars.")
+
+    def save(self):
+        """把目前的視窗、pending 與摘要寫入資料庫"""
+        with self._lock:
+            state = {"entries": list(self._entries), "pending": list(self._pending), "summary": self.summary}
+        self.db.save_app_setting(config.SETTING_CONVERSATION_STATE, json.dumps(state, ensure_ascii=False))
+
+    def _append_locked(self, entry: Dict[str, Any]):
+        if len(self._entries) == self._entries.maxlen:
+            self._pending.append(self._entries[0])
+        self._entries.append(entry)
+
+    def append(self, entry: Dict[str, Any]):
+        """加入一則訊息 (不立即寫入資料庫，呼叫端在適當時機呼叫 save())"""
+        with self._lock:
+            self._append_locked(entry)
+            should_summarize = len(self._pending) >= config.CONVERSATION_SUMMARY_BATCH
+        if should_summarize:
+            self.summarize_async()
+
+    def context_entries(self) -> List[Dict[str, Any]]:
+        """提示用的訊息：尚未併入摘要的 pending 加上視窗內的訊息 (由舊到新)"""
+        with self._lock:
+            return self._pending + list(self._entries)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def summarize_async(self):
+        """在 learning 工作池中把 pending 併入摘要 (上一次尚未結束時略過)"""
+        if self._summarizing.locked():
+            return
+        worker_pools.dispatch("learning", self._summarize_worker)
+
+    @with_priority(PRIORITY_LEARNING)
+    def _summarize_worker(self):
+        if not self._summarizing.acquire(blocking=False):
+            return
+        try:
+            self.summarize_pending()
+        except Exception as e:
+            logging.error(f"WORKER: Conversation summary update failed: {e}", exc_info=True)
+        finally:
+            self._summarizing.release()
+
+    def summarize_pending(self) -> bool:
+        """以 LLM 把 pending 的訊息增量併入摘要，成功返回 True"""
+        with self._lock:
+            batch = list(self._pending)
+            previous_summary = self.summary
+        if not batch:
+            return False
+        new_summary = self._request_summary(previous_summary, batch) if self.llm else None
+        with self._lock:
+            if new_summary:
+                self.summary = new_summary[-config.CONVERSATION_SUMMARY_MAX_CHARS:]
+                del self._pending[:len(batch)]
+                self.stats["summaries"] += 1
+                self.stats["summarized_entries"] += len(batch)
+            overflow = len(self._pending) - config.CONVERSATION_PENDING_MAX
+            if overflow > 0:
+                del self._pending[:overflow]
+                self.stats["dropped_entries"] += overflow
+                logging.warning(f"Conversation summary unavailable; dropped {overflow} old history entries.")
+        self.save()
+        return bool(new_summary)
+
+    def _request_summary(self, previous_summary: str, batch: List[Dict[str, Any]]) -> Optional[str]:
+        lines = [f"{_ROLE_NAMES.get(entry.get('role'), entry.get('role'))}: {entry_text(entry)}" for entry in batch]
+        prompt = (
+            f"你是桌寵「小星」的對話記錄員。請把「新的對話片段」併入「目前的對話摘要」，輸出更新後的摘要。\n"
+            f"保留使用者提到的重要事實、約定、正在進行的話題與情緒轉折，省略寒暄；以第三人稱、繁體中文書寫，"
+            f"不超過 {config.CONVERSATION_SUMMARY_MAX_CHARS} 字。只輸出摘要本身。\n\n"
+            f"目前的對話摘要：\n{previous_summary or '(尚無)'}\n\n"
+            f"新的對話片段：\n" + "\n".join(lines)
+        )
+        result = self.llm.generate_content({
+            "task": TASK_CONVERSATION_SUMMARY,
+            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+            "expect_structured_output": False,
+            "priority": PRIORITY_LEARNING,
+        })
+        if not result or result.get("error"):
+            logging.warning(f"Conversation summary request failed: {result.get('error') if result else 'no result'}")
+            return None
+        return (result.get("spoken_response") or "").strip() or None
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.stats, "recent": len(self._entries), "pending": len(self._pending),
+                    "summary_chars": len(self.summary)}
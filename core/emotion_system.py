@@ -3,20 +3,23 @@ import random
 import logging
 import math
 from typing import Dict, Optional
-import threading
 import config
 from database import DatabaseManager
 from services.base_services import LLMService
+from services.llm_scheduler import PRIORITY_MAINTENANCE
+from services.llm_tasks import TASK_REGULATION_THOUGHT
+from services.worker_pool import worker_pools
 import time
 class EmotionSystem:
     """管理寵物的所有情緒邏輯，包括離散情緒和核心情感模型。"""
 
-    def __init__(self, db_manager: DatabaseManager, user_id: str, settings: Dict, llm_service: Optional[LLMService], personality_system: 'PersonalitySystem'):
+    def __init__(self, db_manager: DatabaseManager, user_id: str, settings: Dict, llm_service: Optional[LLMService], personality_system: 'PersonalitySystem', memory_system: Optional['MemorySystem'] = None):
         self.db = db_manager
         self.user_id = user_id
         self.settings = settings
         self.llm = llm_service  # 新增
         self.personality_system = personality_system # 新增
+        self.memory_system = memory_system
         self.emotions = self.db.load_emotions(self.user_id)
         
         if not self.emotions or all(v == 0.5 for v in self.emotions.values()):
@@ -182,12 +185,11 @@ class EmotionSystem:
                 strongest_neg_emotion = emo
         
         if strongest_neg_emotion:
-            # 使用 threading.Timer 在短暫延遲後非阻塞地執行，避免卡住主流程
-            threading.Timer(
-                random.uniform(0.5, 1.5), 
-                self._attempt_emotion_regulation, 
-                args=(strongest_neg_emotion, max_intensity)
-            ).start()
+            # 短暫延遲後在 learning 工作池中執行，避免卡住主流程
+            worker_pools.schedule(
+                random.uniform(0.5, 1.5), "learning",
+                self._attempt_emotion_regulation, strongest_neg_emotion, max_intensity
+            )
 
     def _adjust_discrete_emotion(self, name: str, target: float, trigger: str, sensitivity_mod: float):
         """輔助函式，以一定速率調整單個離散情緒值"""
@@ -232,19 +234,26 @@ class EmotionSystem:
         
         try:
             prompt_details = {
+                "task": TASK_REGULATION_THOUGHT,
                 "contents": [{"role": "user", "parts": [{"text": coping_prompt}]}],
-                "generation_config": {"temperature": 0.6, "max_output_tokens": 50}
+                "priority": PRIORITY_MAINTENANCE
             }
             response = self.llm.generate_content(prompt_details)
             coping_thought = response.get("spoken_response", "").strip().replace("\"", "").replace("「", "").replace("」", "")
 
             if not coping_thought: return
 
-            self.db.save_memory(
-                user_id=self.user_id, content=f"小星的調節想法 ({dominant_negative_emotion}): {coping_thought}", 
-                is_long_term=False, importance=0, status='remembered', pet_emotions_json=None,
-                user_emotions_json=None, keywords=None, emotional_intensity=0.1
-            )
+            regulation_content = f"小星的調節想法 ({dominant_negative_emotion}): {coping_thought}"
+            if self.memory_system:
+                # 經由 MemorySystem 寫入以同步近期記憶緩衝區；寫入的欄位與直接寫資料庫時相同
+                self.memory_system.save_memory(content=regulation_content, importance=0, pet_emotions={},
+                                               emotional_intensity=0.1, derive_fields=False)
+            else:
+                self.db.save_memory(
+                    user_id=self.user_id, content=regulation_content,
+                    is_long_term=False, importance=0, status='remembered', pet_emotions_json=None,
+                    user_emotions_json=None, keywords=None, emotional_intensity=0.1
+                )
 
             effectiveness = (0.05 + (conscientiousness - 0.4) * 0.1) * (1.0 - (neuroticism - 0.5) * 0.6)
             effectiveness = max(0.01, min(0.15, effectiveness * intensity))
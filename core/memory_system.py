@@ -3,12 +3,20 @@ import time
 import logging
 import json
 import re
-from typing import Dict, Optional, List
+import threading
+from collections import deque
+from typing import Dict, Optional, List, Deque, Tuple
 from datetime import datetime
 
 import config
 from database import DatabaseManager
 from services.base_services import LLMService
+from services.llm_scheduler import PRIORITY_MAINTENANCE
+from services.llm_tasks import TASK_MEMORY_SUMMARY
+from core.similarity_index import SimHashIndex
+
+RECENT_STM_BUFFER_SIZE = 128
+RECENT_LTM_BUFFER_SIZE = 32
 
 class MemorySystem:
     """管理寵物的短期和長期記憶"""
@@ -19,6 +27,108 @@ class MemorySystem:
         self.user_id = user_id
         self.settings = settings
 
+        # 近似重複記憶的 LSH 索引 (SimHash)，插入時維護，避免重複內容不斷堆疊
+        self.dedup_index = SimHashIndex(max_hamming_distance=6, bands=8, min_jaccard=0.75, max_entries=2000)
+        self._warm_dedup_index()
+
+        # 每位使用者最近 STM/LTM 的環形緩衝區 (write-through)，讓提示建構與反思不必查詢 SQLite
+        # 鍵為 (user_id, is_long_term)；緩衝區內依時間由舊到新排列
+        self._recent_buffers: Dict[Tuple[str, bool], Deque[Dict]] = {}
+        self._buffer_complete: Dict[Tuple[str, bool], bool] = {}
+        self._buffer_lock = threading.Lock()
+        self.buffer_stats = {"hits": 0, "db_fallbacks": 0}
+        self._warm_recent_buffer(is_long_term=False)
+        self._warm_recent_buffer(is_long_term=True)
+
+    def _buffer_key(self, is_long_term: bool) -> Tuple[str, bool]:
+        return (self.user_id, is_long_term)
+
+    def _warm_recent_buffer(self, is_long_term: bool):
+        """從資料庫載入最近的記憶 (不分狀態) 填滿環形緩衝區"""
+        size = RECENT_LTM_BUFFER_SIZE if is_long_term else RECENT_STM_BUFFER_SIZE
+        rows = self.db.load_memory(self.user_id, is_long_term=is_long_term, limit=size, status_filter=None)
+        key = self._buffer_key(is_long_term)
+        with self._buffer_lock:
+            self._recent_buffers[key] = deque(reversed(rows), maxlen=size)
+            # 資料庫中的記憶少於緩衝區容量時，緩衝區即為完整資料
+            self._buffer_complete[key] = len(rows) < size
+        logging.info(f"Recent {'LTM' if is_long_term else 'STM'} buffer warmed with {len(rows)} records.")
+
+    def _buffer_append(self, is_long_term: bool, record: Dict):
+        key = self._buffer_key(is_long_term)
+        with self._buffer_lock:
+            buffer = self._recent_buffers.setdefault(key, deque(maxlen=RECENT_LTM_BUFFER_SIZE if is_long_term else RECENT_STM_BUFFER_SIZE))
+            if len(buffer) == buffer.maxlen:
+                # 有記錄被擠出緩衝區，之後超出範圍的查詢需回到資料庫
+                self._buffer_complete[key] = False
+            buffer.append(record)
+
+    def _buffer_reinforce(self, is_long_term: bool, mem_id: str, importance: int, emotional_intensity: float, timestamp: float):
+        """同步被強化 (合併) 的記憶，並將其移到最新的位置"""
+        key = self._buffer_key(is_long_term)
+        with self._buffer_lock:
+            buffer = self._recent_buffers.get(key)
+            if buffer is None: return
+            for record in buffer:
+                if record['id'] == mem_id:
+                    buffer.remove(record)
+                    record['timestamp'] = timestamp
+                    record['importance'] = max(record.get('importance') or 0, importance)
+                    record['emotional_intensity'] = max(record.get('emotional_intensity') or 0.0, emotional_intensity)
+                    record['mention_count'] = (record.get('mention_count') or 1) + 1
+                    buffer.append(record)
+                    return
+
+    def _buffer_update_status(self, mem_ids: List[str], new_status: str, is_long_term: bool = False):
+        ids = set(mem_ids)
+        with self._buffer_lock:
+            for record in self._recent_buffers.get(self._buffer_key(is_long_term), ()):
+                if record['id'] in ids:
+                    record['status'] = new_status
+
+    def get_recent_memories(self, is_long_term: bool = False, limit: int = 50, status_filter: Optional[str] = 'remembered') -> List[Dict]:
+        """
+        取得最近的記憶 (新到舊)，語意與 DatabaseManager.load_memory 相同。
+        緩衝區足以回答時直接從記憶體提供，否則退回資料庫查詢。
+        """
+        key = self._buffer_key(is_long_term)
+        with self._buffer_lock:
+            buffer = self._recent_buffers.get(key)
+            if buffer is not None:
+                matched = []
+                for record in reversed(buffer):
+                    if status_filter and record.get('status') != status_filter:
+                        continue
+                    matched.append(dict(record))
+                    if len(matched) >= limit:
+                        break
+                if len(matched) >= limit or self._buffer_complete.get(key, False):
+                    self.buffer_stats["hits"] += 1
+                    return matched
+            self.buffer_stats["db_fallbacks"] += 1
+        return self.db.load_memory(self.user_id, is_long_term=is_long_term, limit=limit, status_filter=status_filter)
+
+    @staticmethod
+    def _split_speaker_prefix(content: str):
+        """將「使用者說: ...」這類記憶拆成 (說話者前綴, 內容)，前綴作為索引的命名空間"""
+        match = re.match(r"^([^:：]{1,16})[:：]\s*(.*)$", content or "", re.DOTALL)
+        if match:
+            return match.group(1).strip(), match.group(2)
+        return "", content or ""
+
+    def _dedup_namespace(self, content: str, is_long_term: bool):
+        prefix, body = self._split_speaker_prefix(content)
+        return f"{'ltm' if is_long_term else 'stm'}:{prefix}", body
+
+    def _warm_dedup_index(self):
+        """啟動時從資料庫載入近期記憶，建立近似重複索引"""
+        for is_long_term, status, limit in ((False, 'remembered', 300), (True, 'summarized_from_stm', 100)):
+            # load_memory 依時間新到舊排序，反向插入讓最新的記憶最後被淘汰
+            for mem in reversed(self.db.load_memory(self.user_id, is_long_term=is_long_term, limit=limit, status_filter=status)):
+                namespace, body = self._dedup_namespace(mem['content'], is_long_term)
+                self.dedup_index.add(mem['id'], body, namespace, {"is_long_term": is_long_term})
+        logging.info(f"Memory dedup index warmed with {len(self.dedup_index)} entries.")
+
     def _extract_keywords(self, text_content: str) -> Optional[str]:
         """從文本中提取關鍵字"""
         if not text_content or not isinstance(text_content, str):
@@ -39,8 +149,14 @@ class MemorySystem:
         unique_keywords = sorted(list(set(valid_keywords)), key=len, reverse=True)
         return ",".join(unique_keywords[:5]) if unique_keywords else None
 
-    def save_memory(self, content: str, importance: int, pet_emotions: Dict, user_emotions: Optional[Dict] = None, is_long_term: bool = False, status: str = 'remembered'):
-        """將一條記憶儲存到資料庫，自動計算衍生欄位"""
+    def save_memory(self, content: str, importance: int, pet_emotions: Dict, user_emotions: Optional[Dict] = None, is_long_term: bool = False, status: str = 'remembered',
+                    emotional_intensity: Optional[float] = None, derive_fields: bool = True):
+        """
+        將一條記憶儲存到資料庫，自動計算衍生欄位。
+        emotional_intensity: 指定時直接使用，不從 pet_emotions 推算。
+        derive_fields: False 時照原樣寫入 (不提取關鍵字、不做近似重複合併)，只同步更新近期記憶緩衝區。
+        """
+        intensity_override = emotional_intensity
         pet_emotions_json: Optional[str] = None
         user_emotions_json: Optional[str] = None
         emotional_intensity = 0.0
@@ -65,12 +181,30 @@ class MemorySystem:
             if significant_user_emotions:
                 user_emotions_json = json.dumps(significant_user_emotions, ensure_ascii=False)
         
+        if intensity_override is not None:
+            emotional_intensity = intensity_override
         emotional_intensity = max(0.0, min(1.0, emotional_intensity))
         
+        # 近似重複檢查：命中時強化既有記憶，而不是新增一筆
+        dedup_eligible = derive_fields and status in ('remembered', 'summarized_from_stm')
+        namespace, body = self._dedup_namespace(content, is_long_term)
+        if dedup_eligible:
+            duplicate = self.dedup_index.find_near_duplicate(body, namespace)
+            if duplicate:
+                dup_id = duplicate[0]
+                now = time.time()
+                if self.db.reinforce_memory(dup_id, is_long_term, importance, emotional_intensity, now):
+                    self._buffer_reinforce(is_long_term, dup_id, importance, emotional_intensity, now)
+                    logging.debug(f"Near-duplicate memory merged into {dup_id[:8]} (jaccard={duplicate[2]:.2f}).")
+                    return
+                # 既有記憶已被歸檔或遺忘，從索引移除後照常新增
+                self.dedup_index.remove(dup_id)
+
         # 關鍵字提取
-        keywords = self._extract_keywords(content) if not is_long_term and len(content) > 10 else None
+        keywords = self._extract_keywords(content) if derive_fields and not is_long_term and len(content) > 10 else None
         
-        self.db.save_memory(
+        timestamp = time.time()
+        mem_id = self.db.save_memory(
             user_id=self.user_id,
             content=content,
             is_long_term=is_long_term,
@@ -79,14 +213,24 @@ class MemorySystem:
             pet_emotions_json=pet_emotions_json,
             user_emotions_json=user_emotions_json,
             keywords=keywords,
-            emotional_intensity=emotional_intensity
+            emotional_intensity=emotional_intensity,
+            timestamp=timestamp
         )
+        if mem_id:
+            self._buffer_append(is_long_term, {
+                'id': mem_id, 'user_id': self.user_id, 'content': content, 'timestamp': timestamp,
+                'importance': importance, 'status': status,
+                'pet_emotions_snapshot': pet_emotions_json, 'user_emotions_snapshot': user_emotions_json,
+                'keywords': keywords, 'emotional_intensity': emotional_intensity, 'mention_count': 1
+            })
+        if mem_id and dedup_eligible:
+            self.dedup_index.add(mem_id, body, namespace, {"is_long_term": is_long_term})
 
     def get_memories_for_prompt(self, stm_limit: int = 6, ltm_limit: int = 2) -> Dict[str, List[Dict]]:
         """獲取最近的、經過篩選的短期和長期記憶，用於LLM提示"""
         # 這裡可以實現原檔案 get_llm_prompt 中更複雜的情緒關聯篩選邏輯
-        recent_stms = self.db.load_memory(self.user_id, is_long_term=False, limit=stm_limit, status_filter='remembered')
-        recent_ltms = self.db.load_memory(self.user_id, is_long_term=True, limit=ltm_limit, status_filter='summarized_from_stm')
+        recent_stms = self.get_recent_memories(is_long_term=False, limit=stm_limit, status_filter='remembered')
+        recent_ltms = self.get_recent_memories(is_long_term=True, limit=ltm_limit, status_filter='summarized_from_stm')
         
         return {"stm": recent_stms, "ltm": recent_ltms}
 
@@ -94,12 +238,15 @@ class MemorySystem:
         """執行定期的記憶體維護"""
         # 1. 清理舊的 STM
         retention_days = self.settings.get(config.SETTING_STM_RETENTION_DAYS, 30)
-        self.db.clean_short_term_memory(
+        changed_count = self.db.clean_short_term_memory(
             self.user_id,
             retention_days=int(retention_days),
             importance_threshold_for_archive=2,
             emotional_intensity_threshold_for_archive=0.65
         )
+        if changed_count:
+            # 狀態在資料庫端批次變更，重新載入緩衝區以保持一致
+            self._warm_recent_buffer(is_long_term=False)
         logging.info("Short-term memory cleanup check performed.")
 
         # 2. 將待歸檔的 STM 總結成 LTM (這是一個耗時操作)
@@ -137,9 +284,10 @@ class MemorySystem:
         # 注意：llm_service 應該要有一個專門處理這種請求的方法
         # 這裡我們假設 generate_content 可以處理
         prompt_details = {
+            "task": TASK_MEMORY_SUMMARY,
             "contents": [{"role": "user", "parts": [{"text": summarization_prompt}]}],
-            "generation_config": {"temperature": 0.5, "max_output_tokens": 300},
-            "expect_structured_output": True # 假設我們需要結構化輸出
+            "expect_structured_output": True, # 假設我們需要結構化輸出
+            "priority": PRIORITY_MAINTENANCE
         }
         
         summary_result = self.llm.generate_content(prompt_details)
@@ -159,4 +307,5 @@ class MemorySystem:
                 # 更新被處理過的STM的狀態
                 processed_ids = [s['id'] for s in stms_to_process]
                 self.db.update_stms_status(processed_ids, 'summarized_to_ltm')
+                self._buffer_update_status(processed_ids, 'summarized_to_ltm')
                 logging.info(f"Successfully summarized {len(processed_ids)} STMs into one LTM.")
\ No newline at end of file
@@ -7,21 +7,33 @@ import json
 import uuid
 import math
 import threading
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Callable, Tuple
 from datetime import datetime
 
 import config
 from database import DatabaseManager
 from services.base_services import LLMService
+from services.structured_output import extract_json
+from services.llm_scheduler import PRIORITY_LEARNING, with_priority
+from services.llm_tasks import TASK_USER_TEXT_LEARNING, TASK_THOUGHT_REFLECTION
+from services.worker_pool import worker_pools
+from core.similarity_index import SimHashIndex, extract_shingles, jaccard_similarity, normalize_text_for_fingerprint
 
 class PersonalitySystem:
     """管理寵物的個性、特徵和長期發展"""
 
-    def __init__(self, db_manager: DatabaseManager, user_id: str, settings: Dict, llm_service: Optional[LLMService]):
+    def __init__(self, db_manager: DatabaseManager, user_id: str, settings: Dict, llm_service: Optional[LLMService], memory_system: Optional['MemorySystem'] = None):
         self.db = db_manager
         self.user_id = user_id
         self.settings = settings
         self.llm = llm_service
+        self.memory_system = memory_system
+
+        # 提示描述的版本計數：底層狀態改變時遞增，各描述文字依版本快取，不必每回合重算
+        self.state_versions: Dict[str, int] = {
+            "traits": 0, "demographics": 0, "attachment": 0, "efficacy": 0, "neuro": 0, "characteristics": 0
+        }
+        self._description_cache: Dict[str, Tuple[tuple, str]] = {}
         
         self.character_traits: Dict[str, float] = {}
         self.attachment_score: float = 0.4
@@ -32,6 +44,10 @@ class PersonalitySystem:
         
         self.characteristics_cache: Dict[str, List[Dict]] = {}
         self.load_characteristics_cache()
+
+        # 特徵值的近似重複索引，命名空間為 trait_type
+        self.trait_index = SimHashIndex(max_hamming_distance=6, bands=8, min_jaccard=0.7, max_entries=3000)
+        self._rebuild_trait_index()
         
         # --- [新增] 模擬神經化學狀態 ---
         self.sim_neuro_state = {
@@ -47,10 +63,11 @@ class PersonalitySystem:
         self._apply_sim_neuro_effects() # 首次計算
         
         self._last_thought_reflection_time = 0
-        self.active_user_text_analysis_threads = 0
-        self.active_pet_text_analysis_threads = 0
         self.MAX_CONCURRENT_USER_TEXT_ANALYSIS = 1
         self.MAX_CONCURRENT_PET_TEXT_ANALYSIS = 1
+        # 同類分析同時最多幾個 (含排隊中)；由工作完成或被捨棄時的回呼釋放
+        self._user_text_analysis_slots = threading.BoundedSemaphore(self.MAX_CONCURRENT_USER_TEXT_ANALYSIS)
+        self._pet_text_analysis_slots = threading.BoundedSemaphore(self.MAX_CONCURRENT_PET_TEXT_ANALYSIS)
 
     def _load_character_data(self):
         """從資料庫載入核心角色數據"""
@@ -76,9 +93,85 @@ class PersonalitySystem:
             if type_key not in self.characteristics_cache:
                 self.characteristics_cache[type_key] = []
             self.characteristics_cache[type_key].append(char)
+        self.mark_state_changed("characteristics")
         logging.info(f"Characteristics cache reloaded with {len(raw_chars)} items.")
 
+    def _rebuild_trait_index(self):
+        """從資料庫重建特徵值的近似重複索引"""
+        self.trait_index.clear()
+        for char in reversed(self.db.get_individual_characteristics(self.user_id, min_relevance=0.0, limit=3000)):
+            self.trait_index.add(char['trait_id'], str(char['trait_value']), char['trait_type'])
+        logging.info(f"Trait dedup index rebuilt with {len(self.trait_index)} items.")
+
+    def forget_characteristics(self, trait_ids: List[str]):
+        """特徵從資料庫刪除後呼叫：同步移除近似重複索引中的項目 (不重新讀取資料表)"""
+        for trait_id in trait_ids:
+            self.trait_index.remove(trait_id)
+        if trait_ids:
+            logging.debug(f"Removed {len(trait_ids)} deleted characteristics from trait dedup index.")
+
+    def _find_near_duplicate_characteristic(self, trait_type: str, trait_key: Optional[str], trait_value: str) -> Optional[Dict]:
+        """
+        透過 LSH 索引尋找同類型中值近似的既有特徵。
+        不同 trait_key 之間只有在兩邊的值都夠長 (至少 min_shingles 個 shingle)、且 key 只是用字不同時才合併；
+        短值 (如 "25"、"貓") 在不同 key 下很可能是不同的事實 (年齡與幸運數字)，不跨 key 合併。
+        """
+        duplicate = self.trait_index.find_near_duplicate(trait_value, trait_type)
+        if not duplicate:
+            return None
+        existing = self.db.get_characteristic(duplicate[0])
+        if not existing:
+            # 特徵已被刪除 (例如使用者在設定視窗中移除)
+            self.trait_index.remove(duplicate[0])
+            return None
+        if trait_key is None or existing.get('trait_key') in (None, trait_key):
+            return existing
+        min_shingles = self.trait_index.min_shingles
+        if (self._shingle_count(trait_value) < min_shingles
+                or self._shingle_count(str(existing['trait_value'])) < min_shingles
+                or not self._keys_are_rewordings(trait_key, existing['trait_key'])):
+            return None
+        return existing
+
+    @staticmethod
+    def _shingle_count(text: str) -> int:
+        return len(extract_shingles(normalize_text_for_fingerprint(text)))
+
+    def _keys_are_rewordings(self, key_a: str, key_b: str) -> bool:
+        """兩個 trait_key 是否只是寫法不同 (如 favorite_food / favourite_food)"""
+        shingles_a = extract_shingles(normalize_text_for_fingerprint(key_a.replace("_", " ")))
+        shingles_b = extract_shingles(normalize_text_for_fingerprint(key_b.replace("_", " ")))
+        return jaccard_similarity(shingles_a, shingles_b) >= self.trait_index.min_jaccard
+
+    def mark_state_changed(self, *names: str):
+        """通知某些狀態已改變 (例如設定視窗直接修改了 character_traits / demographics)，使對應的描述快取失效"""
+        for name in names:
+            self.state_versions[name] += 1
+
+    def _memoized_description(self, section: str, key: tuple, builder: Callable[[], str]) -> str:
+        """key 與上次相同時直接返回快取的描述文字"""
+        cached = self._description_cache.get(section)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        text = builder()
+        self._description_cache[section] = (key, text)
+        return text
+
+    def prompt_state_key(self) -> tuple:
+        """所有提示描述的版本組合；相同時代表整段人格相關提示不變"""
+        return (tuple(self.state_versions.values()),
+                int(bool(self.settings.get(config.SETTING_SEARCH_API_ENABLED, 0))),
+                self._characteristics_time_bucket())
+
+    @staticmethod
+    def _characteristics_time_bucket() -> int:
+        # 特徵的時間衰減很慢，每個時間區間只重新排序一次
+        return int(time.time() // config.CHARACTERISTICS_DESCRIPTION_REFRESH_SECONDS)
+
     def get_personality_description(self) -> str:
+        return self._memoized_description("personality", (self.state_versions["traits"],), self._build_personality_description)
+
+    def _build_personality_description(self) -> str:
         descriptions = []
         o = self.character_traits.get(config.SETTING_OCEAN_OPENNESS, 0.5)
         c = self.character_traits.get(config.SETTING_OCEAN_CONSCIENTIOUSNESS, 0.5)
@@ -99,6 +192,9 @@ class PersonalitySystem:
         return "你的核心性格特質傾向於：" + " ".join(descriptions)
         
     def get_demographic_description(self) -> str:
+        return self._memoized_description("demographics", (self.state_versions["demographics"],), self._build_demographic_description)
+
+    def _build_demographic_description(self) -> str:
         parts = []
         culture = self.demographics.get(config.SETTING_DEMO_CULTURE)
         age_group = self.demographics.get(config.SETTING_DEMO_AGE_GROUP)
@@ -110,6 +206,9 @@ class PersonalitySystem:
         return " ".join(parts) + " 這些背景會影響你的說話方式和觀點。"
 
     def get_attachment_description_for_llm(self) -> str:
+        return self._memoized_description("attachment", (self.state_versions["attachment"],), self._build_attachment_description)
+
+    def _build_attachment_description(self) -> str:
         score = self.attachment_score
         if score >= 0.85:
             return f"你對使用者的依戀程度是「極度親密與依賴」(指數:{score:.2f})。你會充滿溫情，非常主動分享感受，並對使用者的情緒表現出強烈的關心。"
@@ -123,6 +222,10 @@ class PersonalitySystem:
             return f"你對使用者的依戀程度是「警惕或漠不關心」(指數:{score:.2f})。你的語氣可能非常冷淡簡短，對使用者的話題漠不關心。"
             
     def get_self_efficacy_description_for_llm(self) -> str:
+        key = (self.state_versions["efficacy"], int(bool(self.settings.get(config.SETTING_SEARCH_API_ENABLED, 0))))
+        return self._memoized_description("efficacy", key, self._build_self_efficacy_description)
+
+    def _build_self_efficacy_description(self) -> str:
         hints = []
         general = self.self_efficacy.get("general", 0.5)
         social = self.self_efficacy.get("social", 0.5)
@@ -143,6 +246,9 @@ class PersonalitySystem:
     # --- [新增] 模擬神經化學狀態的LLM提示 ---
     def get_neuro_state_description_for_llm(self) -> str:
         """根據模擬神經化學狀態產生給LLM的行為指導"""
+        return self._memoized_description("neuro", (self.state_versions["neuro"],), self._build_neuro_state_description)
+
+    def _build_neuro_state_description(self) -> str:
         neuro_state_desc_parts = []
         motivation = self.sim_neuro_state.get("motivation", 0.5)
         stress = self.sim_neuro_state.get("stress_level", 0.1)
@@ -159,6 +265,10 @@ class PersonalitySystem:
         return "關於你當前的內在狀態：「" + " ".join(neuro_state_desc_parts) + "」這會強烈影響你的想法和行為。"
 
     def get_characteristics_description_for_llm(self) -> str:
+        key = (self.state_versions["characteristics"], self._characteristics_time_bucket())
+        return self._memoized_description("characteristics", key, self._build_characteristics_description)
+
+    def _build_characteristics_description(self) -> str:
         all_relevant_chars: List[Dict] = []
         for char_list in self.characteristics_cache.values():
             all_relevant_chars.extend(char_list)
@@ -181,6 +291,18 @@ class PersonalitySystem:
         if not desc_parts: return "你仍在學習和塑造自己的特點中。"
         return "關於你和使用者的個體特徵與記憶摘要：\n- " + "\n- ".join(desc_parts)
 
+    def get_top_interests(self, limit: int = 5) -> List[str]:
+        """使用者最感興趣的主題 (favorite_topic 優先，其次 preference)，依關聯度排序並去除重複"""
+        interests: List[str] = []
+        for trait_type in (config.TRAIT_TYPE_FAVORITE_TOPIC, config.TRAIT_TYPE_PREFERENCE):
+            chars = sorted(self.characteristics_cache.get(trait_type, []),
+                           key=lambda char: char.get('relevance_score', 0.5), reverse=True)
+            for char in chars:
+                value = (char.get('trait_value') or "").strip()
+                if value and value not in interests:
+                    interests.append(value)
+        return interests[:limit]
+
     def update_attachment_score(self, event_type: str, magnitude_factor: float = 1.0):
         prev_score = self.attachment_score
         delta = 0.0
@@ -199,6 +321,7 @@ class PersonalitySystem:
         elif delta < 0: delta *= (prev_score ** 1.2)
         self.attachment_score = max(0.0, min(1.0, prev_score + delta))
         if abs(self.attachment_score - prev_score) > 0.0001:
+            self.mark_state_changed("attachment")
             self._save_character_data()
             logging.info(f"Attachment score updated: {prev_score:.4f} -> {self.attachment_score:.4f} (Event: '{event_type}')")
 
@@ -214,6 +337,7 @@ class PersonalitySystem:
         new_efficacy = prev_efficacy + (success_delta * success_mod) - (failure_delta * failure_mod)
         self.self_efficacy[domain] = max(0.0, min(1.0, new_efficacy))
         if abs(self.self_efficacy[domain] - prev_efficacy) > 0.001:
+            self.mark_state_changed("efficacy")
             self._save_character_data()
             logging.info(f"Self-efficacy for '{domain}' changed: {prev_efficacy:.4f} -> {self.self_efficacy[domain]:.4f}")
 
@@ -260,6 +384,7 @@ class PersonalitySystem:
                     logging.info(f"Personality trait {trait_key} changed: {current_value:.4f} -> {new_value:.4f}")
 
         if changed_any_trait:
+            self.mark_state_changed("traits")
             self._save_character_data()
             self.db.save_last_personality_event_time(self.user_id, current_time)
         
@@ -278,24 +403,37 @@ class PersonalitySystem:
         neuroticism = self.character_traits.get(config.SETTING_OCEAN_NEUROTICISM, 0.5)
         
         existing_trait = self.db.find_characteristic(self.user_id, trait_type, trait_key, trait_value_str)
+        is_near_duplicate = False
+        if not existing_trait:
+            existing_trait = self._find_near_duplicate_characteristic(trait_type, trait_key, trait_value_str)
+            is_near_duplicate = existing_trait is not None
 
         if existing_trait:
-            if str(existing_trait['trait_value']).strip().lower() == trait_value_str.lower():
+            if is_near_duplicate or str(existing_trait['trait_value']).strip().lower() == trait_value_str.lower():
                 current_relevance_increment = relevance_increment_base * (1.0 + (conscientiousness - 0.5) * 0.20)
                 new_relevance = min(1.0, existing_trait['relevance_score'] + current_relevance_increment)
                 self.db.reinforce_characteristic(existing_trait['trait_id'], new_relevance, source, now)
-                logging.info(f"Reinforced characteristic '{trait_key}'. New relevance: {new_relevance:.3f}")
+                if is_near_duplicate:
+                    if trait_key is not None and trait_key != existing_trait['trait_key']:
+                        # 保留新的 key 作為別名，之後以它查詢仍會找到這筆特徵
+                        self.db.add_characteristic_key_alias(existing_trait['trait_id'], trait_key)
+                    logging.info(f"Merged near-duplicate characteristic '{trait_key}' into '{existing_trait['trait_key']}'. New relevance: {new_relevance:.3f}")
+                else:
+                    logging.info(f"Reinforced characteristic '{trait_key}'. New relevance: {new_relevance:.3f}")
             else:
                 if openness > 0.6:
                     effective_initial_relevance = initial_relevance_base * (1.0 - (neuroticism - 0.5) * 0.15)
                     update_data = {'trait_id': existing_trait['trait_id'], 'trait_value': trait_value_str, 'relevance_score': effective_initial_relevance, 'source': source, 'timestamp': now}
                     self.db.raw_update_characteristic(update_data)
+                    self.trait_index.add(existing_trait['trait_id'], trait_value_str, trait_type)
                     logging.info(f"Updated conflicting characteristic '{trait_key}' due to high openness.")
         else:
             effective_initial_relevance = initial_relevance_base * (1.0 + (openness - 0.5) * 0.20)
             effective_initial_relevance *= (1.0 - (neuroticism - 0.5) * 0.15)
             insert_data = {'user_id': self.user_id, 'trait_type': trait_type, 'trait_key': trait_key, 'trait_value': trait_value_str, 'relevance_score': effective_initial_relevance, 'source': source, 'timestamp': now}
-            self.db.raw_insert_characteristic(insert_data)
+            new_trait_id = self.db.raw_insert_characteristic(insert_data)
+            if new_trait_id:
+                self.trait_index.add(new_trait_id, trait_value_str, trait_type)
             logging.info(f"Added NEW characteristic '{trait_key}'. Relevance: {effective_initial_relevance:.3f}")
 
         self.load_characteristics_cache()
@@ -359,6 +497,7 @@ class PersonalitySystem:
 
     def _apply_sim_neuro_effects(self):
         """將模擬神經化學狀態應用到行為參數"""
+        self.mark_state_changed("neuro")
         motivation = self.sim_neuro_state.get("motivation", 0.5)
         mood_balance = self.sim_neuro_state.get("mood_balance", 0.5)
         stress_level = self.sim_neuro_state.get("stress_level", 0.1)
@@ -396,38 +535,45 @@ class PersonalitySystem:
     def periodic_maintenance(self):
         """執行定期的特徵維護，如衰減和清理"""
         self.db.decay_characteristics_relevance(self.user_id, decay_amount=0.007, decay_interval_days=1.5)
-        self.db.remove_low_relevance_characteristics(self.user_id, relevance_threshold=0.035, unused_days_threshold=35)
+        removed_ids = self.db.remove_low_relevance_characteristics(self.user_id, relevance_threshold=0.035, unused_days_threshold=35)
+        self.forget_characteristics(removed_ids)
         self.load_characteristics_cache(min_relevance=0.01)
         self._decay_sim_neuro_state() # --- [新增] 定期衰減神經狀態 ---
         logging.info("Periodic personality characteristics maintenance performed.")
 
+    @staticmethod
+    def _dispatch_analysis(slots: threading.BoundedSemaphore, worker: Callable[[str], None], text: str, kind: str):
+        """取得分析名額後派送到 learning 工作池；工作結束 (或被捨棄、拒絕) 時歸還名額"""
+        if not slots.acquire(blocking=False):
+            logging.warning(f"Max concurrent {kind} text analysis calls reached. Skipping.")
+            return
+        logging.debug(f"Dispatching {kind} text analysis to worker for: '{text[:50]}...'")
+        future = worker_pools.dispatch("learning", worker, text)
+        if future is None:
+            slots.release()
+            return
+        future.add_done_callback(lambda _: slots.release())
+
     def learn_from_user_text_async(self, text: str):
         if not self.llm or not text or len(text) < 8: return
-        if self.active_user_text_analysis_threads >= self.MAX_CONCURRENT_USER_TEXT_ANALYSIS:
-            logging.warning("Max concurrent user text analysis calls reached. Skipping.")
-            return
-        logging.debug(f"Dispatching user text analysis to worker for: '{text[:50]}...'")
-        self.active_user_text_analysis_threads += 1
-        thread = threading.Thread(target=self._learn_from_user_text_worker, args=(text,))
-        thread.daemon = True
-        thread.start()
+        self._dispatch_analysis(self._user_text_analysis_slots, self._learn_from_user_text_worker, text, "user")
 
+    @with_priority(PRIORITY_LEARNING)
     def _learn_from_user_text_worker(self, text: str):
         """在背景執行緒中執行使用者文本分析和學習。"""
         try:
             logging.info(f"WORKER: Analyzing user text: '{text[:50]}...'")
             analysis_prompt = self._construct_llm_analysis_prompt_for_user_text(text)
-            analysis_config = {"temperature": 0.30, "max_output_tokens": 1000}
-            
-            response = self.llm.model.generate_content(analysis_prompt, generation_config=analysis_config)
-            response_text = response.text.strip() if response.parts else ""
+            result = self.llm.generate_content({
+                "task": TASK_USER_TEXT_LEARNING,
+                "contents": [{"role": "user", "parts": [{"text": analysis_prompt}]}],
+            })
+            response_text = "" if result.get("error") else (result.get("spoken_response") or "").strip()
             
             if response_text:
                 self._process_llm_analysis_response(response_text, text)
         except Exception as e:
             logging.error(f"WORKER: Error during LLM characteristic analysis: {e}", exc_info=True)
-        finally:
-            self.active_user_text_analysis_threads = max(0, self.active_user_text_analysis_threads - 1)
 
     def _construct_llm_analysis_prompt_for_user_text(self, user_text: str) -> str:
         # (此方法在新舊版本中已存在且相似，此處保持不變)
@@ -440,15 +586,9 @@ class PersonalitySystem:
 
     def learn_from_pet_text_async(self, text: str):
         if not self.llm or not text or len(text) < 12: return
-        if self.active_pet_text_analysis_threads >= self.MAX_CONCURRENT_PET_TEXT_ANALYSIS:
-            logging.warning("Max concurrent pet text analysis calls reached. Skipping.")
-            return
-        logging.debug(f"Dispatching pet text analysis to worker for: '{text[:50]}...'")
-        self.active_pet_text_analysis_threads += 1
-        thread = threading.Thread(target=self._learn_from_pet_text_worker, args=(text,))
-        thread.daemon = True
-        thread.start()
+        self._dispatch_analysis(self._pet_text_analysis_slots, self._learn_from_pet_text_worker, text, "pet")
         
+    @with_priority(PRIORITY_LEARNING)
     def _learn_from_pet_text_worker(self, text: str):
         pass
 
@@ -464,14 +604,16 @@ class PersonalitySystem:
             return
 
         logging.info("Dispatching thought reflection to worker...")
-        thread = threading.Thread(target=self._reflect_on_thoughts_worker)
-        thread.daemon = True
-        thread.start()
+        worker_pools.dispatch("learning", self._reflect_on_thoughts_worker)
 
+    @with_priority(PRIORITY_LEARNING)
     def _reflect_on_thoughts_worker(self):
         """在背景執行緒中執行對內心思考的分析和學習。"""
         logging.info("WORKER: Starting reflection on recent internal thoughts.")
-        all_recent_stm = self.db.load_memory(self.user_id, is_long_term=False, limit=50)
+        if self.memory_system:
+            all_recent_stm = self.memory_system.get_recent_memories(is_long_term=False, limit=50)
+        else:
+            all_recent_stm = self.db.load_memory(self.user_id, is_long_term=False, limit=50)
         
         internal_thoughts = []
         for mem in all_recent_stm:
@@ -503,22 +645,21 @@ class PersonalitySystem:
         )
 
         try:
-            response = self.llm.model.generate_content(
-                reflection_prompt,
-                generation_config={"temperature": 0.4, "max_output_tokens": 600}
-            )
-            response_text = response.text.strip() if response.parts else ""
+            result = self.llm.generate_content({
+                "task": TASK_THOUGHT_REFLECTION,
+                "contents": [{"role": "user", "parts": [{"text": reflection_prompt}]}],
+            })
+            response_text = "" if result.get("error") else (result.get("spoken_response") or "").strip()
             if not response_text:
                 return
 
-            json_match = re.search(r"```json\s*(\[[\s\S]*?\])\s*```|(\[[\s\S]*?\])", response_text, re.DOTALL)
-            if not json_match: return
-            
-            insights = json.loads(json_match.group(1) or json_match.group(2))
-            if not isinstance(insights, list): return
+            insights = extract_json(response_text, expected_type=list)
+            if insights is None: return
 
             learned_count = 0
             for insight in insights:
+                if not isinstance(insight, dict):
+                    continue
                 suggestion = insight.get("trait_suggestion")
                 if isinstance(suggestion, dict) and suggestion.get("trait_type") and suggestion.get("trait_value"):
                     self.add_or_update_characteristic(
@@ -5,27 +5,47 @@ import random
 import uuid
 import re
 import json
+import os
 import threading
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Callable
 from datetime import datetime, time as dt_time
 
-import google.generativeai as genai
 import config
 from database import DatabaseManager
-from services.base_services import LLMService, SearchService
-from services.llm_service import GeminiService
+from services.base_services import LLMService, SearchService, EmbeddingService
+from services.llm_service import build_llm_service
+from services.llm_scheduler import PRIORITY_INTERACTIVE, PRIORITY_PROACTIVE, PRIORITY_LEARNING, with_priority
+from services.llm_tasks import TASK_CORRECTION_ANALYSIS
+from services.structured_output import extract_json
 from core.emotion_system import EmotionSystem
 from core.personality_system import PersonalitySystem
 from core.memory_system import MemorySystem
+from core.prompt_packer import PromptPacker, PromptSection, StablePrefixCache, format_token_report
+from core.search_prefetcher import SearchPrefetcher
+from core.turn_pipeline import TurnPipeline, TurnTimings
+from core.conversation_history import ConversationHistory, entry_text
+from services.lazy_loading import LazyModule, startup_timer
+from services.worker_pool import worker_pools
 from tkinter import messagebox
 
+genai = LazyModule("google.generativeai")
+
 class PetLogic:
     """應用程式的核心業務邏輯，不含UI。"""
 
-    def __init__(self, db_manager: DatabaseManager, llm_service: Optional[LLMService], search_service: Optional[SearchService]):
+    def __init__(self, db_manager: DatabaseManager, llm_service: Optional[LLMService], search_service: Optional[SearchService],
+                 embedding_service: Optional[EmbeddingService] = None, services_pending: bool = False):
+        """
+        services_pending=True 表示 LLM/搜尋/向量服務還在背景建構 (見 main.py)，
+        建構完成後由 attach_services() 補上；在那之前使用者輸入會先等待服務就緒。
+        """
         self.db = db_manager
         self.llm = llm_service
         self.search = search_service
+        self.embeddings = embedding_service
+        self.services_ready = threading.Event()
+        if not services_pending:
+            self.services_ready.set()
         
         self.settings = self._load_all_settings()
         self.user_id = self.settings.get(config.SETTING_USER_ID)
@@ -34,11 +54,12 @@ class PetLogic:
             self.db.save_app_setting(config.SETTING_USER_ID, self.user_id)
             self.settings[config.SETTING_USER_ID] = self.user_id
         
-        self.personality_system = PersonalitySystem(self.db, self.user_id, self.settings, self.llm)
-        self.emotion_system = EmotionSystem(self.db, self.user_id, self.settings, self.llm, self.personality_system)
         self.memory_system = MemorySystem(self.db, self.llm, self.user_id, self.settings)
+        self.personality_system = PersonalitySystem(self.db, self.user_id, self.settings, self.llm, memory_system=self.memory_system)
+        self.emotion_system = EmotionSystem(self.db, self.user_id, self.settings, self.llm, self.personality_system, memory_system=self.memory_system)
         
-        self.llm_history: List[Dict[str, Any]] = []
+        # 最近對話 (有上限) + 滾動摘要，持久化於資料庫，重啟後接續上下文
+        self.history = ConversationHistory(self.db, self.llm)
         self.last_interaction_time = time.time()
         self.last_proactive_chat_time = time.time()
         self.is_sleeping = False
@@ -46,21 +67,73 @@ class PetLogic:
         self.last_pet_spoken_response: Optional[str] = None
         self.last_pet_internal_thought: Optional[str] = None
         self.last_user_input_leading_to_response: Optional[str] = None
-
-        search_tool_func = genai.types.FunctionDeclaration(
-            name="custom_search",
-            description="當你需要查詢最新的、真實世界的資訊（例如新聞、天氣、特定主題的資料），或者你不確定的知識時，使用這個工具進行網路搜尋。",
-            parameters={
-                "type_": "OBJECT",
-                "properties": {"query": {"type_": "STRING", "description": "你想搜尋的關鍵字詞。"}},
-                "required": ["query"]
-            },
-        )
-        self.tool_kit = [genai.types.Tool(function_declarations=[search_tool_func])]
+        self.last_prompt_token_report: Optional[Dict[str, Any]] = None
+        self.stable_prefix_cache = StablePrefixCache(config.STABLE_PREFIX_CACHE_ENTRIES)
+        self.turn_pipeline = TurnPipeline()
+        self.last_turn_timings: Optional[Dict[str, float]] = None
+        self.search_prefetcher = SearchPrefetcher(self.db, self.search, self.personality_system)
+        # 本地知識庫 (搜尋服務為 LocalFirstSearchService 時才有)；第一次維護時補上既有的搜尋快取
+        self.local_knowledge = getattr(self.search, "local", None)
+        self._search_cache_synced = False
+
+        self._tool_kit: Optional[List[Any]] = None
         self.available_tools = {
-            "custom_search": self.search.search if self.search else lambda query: {"error": "Search service is not enabled."}
+            "custom_search": self._custom_search_tool
         }
-        logging.info("PetLogic native tools have been defined.")
+
+    @property
+    def tool_kit(self) -> List[Any]:
+        """工具宣告需要 genai.types，第一次帶工具呼叫模型時才建立 (避免啟動時載入 SDK)"""
+        if self._tool_kit is None:
+            search_tool_func = genai.types.FunctionDeclaration(
+                name="custom_search",
+                description="當你需要查詢最新的、真實世界的資訊（例如新聞、天氣、特定主題的資料），或者你不確定的知識時，使用這個工具進行網路搜尋。",
+                parameters={
+                    "type_": "OBJECT",
+                    "properties": {"query": {"type_": "STRING", "description": "你想搜尋的關鍵字詞。"}},
+                    "required": ["query"]
+                },
+            )
+            self._tool_kit = [genai.types.Tool(function_declarations=[search_tool_func])]
+            logging.info("PetLogic native tools have been defined.")
+        return self._tool_kit
+
+    def attach_services(self, llm_service: Optional[LLMService], search_service: Optional[SearchService],
+                        embedding_service: Optional[EmbeddingService] = None):
+        """背景建構的服務完成後接上 (任一項可為 None)，並通知等待中的使用者輸入"""
+        if llm_service is not None:  # 建構期間使用者可能已透過金鑰視窗啟動了 LLM，不要覆蓋成 None
+            self.llm = llm_service
+            self.memory_system.llm = llm_service
+            self.personality_system.llm = llm_service
+            self.emotion_system.llm = llm_service
+            self.history.llm = llm_service
+        self.search = search_service
+        self.search_prefetcher.search = search_service
+        self.local_knowledge = getattr(search_service, "local", None)
+        self.embeddings = embedding_service
+        self.services_ready.set()
+        logging.info(f"PetLogic services attached (llm={'ready' if llm_service else 'unavailable'}, "
+                     f"search={'enabled' if search_service and search_service.is_enabled else 'disabled'}).")
+
+    def _custom_search_tool(self, query: str) -> Dict[str, Any]:
+        """custom_search 工具：優先使用閒置時預取的結果，沒有才即時搜尋"""
+        prefetched = self.search_prefetcher.answer(query)
+        if prefetched:
+            return prefetched
+        if not self.search:
+            return {"error": "Search service is not enabled."}
+        return self.search.search(query)
+
+    def shutdown(self):
+        """關閉應用程式前呼叫：保存對話狀態與用量計數並關閉背景工作池 (回合後的記憶寫入會先完成)"""
+        logging.info("PetLogic shutting down background work...")
+        leftover = worker_pools.shutdown()
+        self.history.save()
+        rate_limiter = getattr(self.llm, "rate_limiter", None) or getattr(self.search, "rate_limiter", None)
+        if rate_limiter:
+            rate_limiter.flush()
+        if leftover:
+            logging.warning(f"Some background jobs did not finish before exit: {leftover}")
 
     def reinitialize_llm_service(self) -> bool:
         """嘗試使用資料庫中儲存的 API 金鑰重新初始化 LLM 服務。"""
@@ -74,9 +147,12 @@ class PetLogic:
                 config.SETTING_SELECTED_LLM,
                 config.DEFAULT_APP_SETTINGS[config.SETTING_SELECTED_LLM]
             )
-            self.llm = GeminiService(api_key=api_key, model_name=model_name)
+            self.llm = build_llm_service(self.db, api_key=api_key, model_name=model_name,
+                                         rate_limiter=getattr(self.search, "rate_limiter", None))
             self.memory_system.llm = self.llm
             self.personality_system.llm = self.llm
+            self.emotion_system.llm = self.llm
+            self.history.llm = self.llm
             logging.info("LLM service re-initialized successfully.")
             return True
         except Exception as e:
@@ -84,6 +160,8 @@ class PetLogic:
             self.llm = None
             self.memory_system.llm = None
             self.personality_system.llm = None
+            self.emotion_system.llm = None
+            self.history.llm = None
             return False
 
     def _load_all_settings(self) -> Dict[str, Any]:
@@ -102,14 +180,21 @@ class PetLogic:
             "dominant_emotion": dominant_emotion,
             "initial_message": "哈囉！今天想聊些什麼呀？",
             "is_sleeping": self.is_sleeping,
-            "llm_ready": self.llm is not None
+            # 服務仍在背景建構時，有金鑰就先顯示完整介面；建構失敗再由 UI 切換為受限模式
+            "llm_ready": self.llm is not None or (not self.services_ready.is_set() and bool(self.db.get_api_key('gemini_api_key'))),
+            "services_loading": not self.services_ready.is_set()
         }
 
-    def handle_user_input(self, user_text: str) -> Dict[str, Any]:
-        """處理使用者輸入的主流程，現在包含工具呼叫循環和對話後學習。"""
+    def handle_user_input(self, user_text: str, on_stream: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+        """
+        處理使用者輸入的主流程，現在包含工具呼叫循環和對話後學習。
+        on_stream: 可選的回呼，串流生成時會收到口頭回應的新增文字 (在背景執行緒中呼叫)。
+        """
         logging.info(f"--- 開始處理使用者輸入 --- : '{user_text}'")
         self.is_processing_llm = True
         try:
+            if not self.services_ready.wait(config.STARTUP_SERVICES_WAIT_SECONDS):
+                return {"display_text": "等我一下下，我還在醒來中...", "new_emotion_for_ui": "neutral", "tag": "pet"}
             if self.is_sleeping:
                 return {"display_text": "zzz... (小星還在睡覺)", "new_emotion_for_ui": "sleepy", "tag": "system"}
             if not self.llm:
@@ -117,62 +202,64 @@ class PetLogic:
 
             self.last_interaction_time = time.time()
             self.last_user_input_leading_to_response = user_text
-            
-            sensed_emotions = self.llm.analyze_text_for_emotions(user_text) if self.llm else {}
-            self.memory_system.save_memory(
-                content=f"使用者說: {user_text}", importance=2,
-                pet_emotions=self.emotion_system.get_current_emotions(), user_emotions=sensed_emotions
-            )
-            prompt_details = self._build_llm_prompt(user_text, sensed_emotions, request_type="user_submit")
-            llm_result = self.llm.generate_content(prompt_details)
-            
-            if llm_result.get("tool_call_request"):
-                tool_request = llm_result["tool_call_request"]
-                tool_name = tool_request["name"]
-                tool_args = tool_request["args"]
-                if tool_name in self.available_tools:
-                    logging.info(f"Executing tool '{tool_name}' with args: {tool_args}")
-                    tool_function = self.available_tools[tool_name]
-                    tool_result = tool_function(**tool_args)
-                else:
-                    logging.error(f"LLM called an unknown tool: {tool_name}")
-                    tool_result = {"error": f"Tool '{tool_name}' not found."}
-
-                logging.info(f"Tool '{tool_name}' executed. Result: {str(tool_result)[:200]}...")
-                messages_for_next_turn = llm_result["messages_history_for_next_turn"]
-                messages_for_next_turn.append({
-                    "role": "tool",
-                    "parts": [{"function_response": {"name": tool_name, "response": tool_result}}]
-                })
-                
-                logging.debug("LLMService: Second call to Gemini model with tool results.")
-                final_response = self.llm.model.generate_content(
-                    messages_for_next_turn,
-                    generation_config=prompt_details["generation_config"]
+            timings = TurnTimings()
+
+            # 單次呼叫模式：使用者情緒與事件評價由主要生成一併回傳，不再先呼叫分析模型
+            single_call_turn = bool(int(self.settings.get(config.SETTING_SINGLE_CALL_TURN, 1)))
+            # 彼此獨立的前置階段同時執行：記憶擷取、提示前綴描述，以及雙呼叫模式下的情緒分析
+            stages: Dict[str, Callable[[], Any]] = {
+                "memory_retrieval": self._load_prompt_memories,
+                "prompt_prefix": self._describe_prompt_prefix,
+            }
+            if not single_call_turn:
+                stages["emotion_analysis"] = lambda: self.llm.analyze_text_for_emotions(user_text)
+            prepared = self.turn_pipeline.run_parallel(stages, timings)
+            sensed_emotions: Dict[str, float] = prepared.get("emotion_analysis") or {}
+
+            with timings.stage("prompt_build"):
+                prompt_details = self._build_llm_prompt(
+                    user_text, sensed_emotions, request_type="user_submit", include_turn_analysis=single_call_turn,
+                    prompt_context={"memories": prepared["memory_retrieval"], **prepared["prompt_prefix"]}
                 )
-                raw_llm_output_text = final_response.text.strip()
-                parsed_output = self.llm._parse_structured_output(raw_llm_output_text)
-                spoken_response = parsed_output.get("spoken_response", raw_llm_output_text)
-                internal_thought = parsed_output.get("internal_thought", "(使用工具後進行總結)")
+            if on_stream and int(self.settings.get(config.SETTING_STREAMING_RESPONSES, 1)):
+                prompt_details["on_stream"] = on_stream
+            # 工具呼叫循環在服務層：同一輪的多個呼叫平行執行，最多 LLM_TOOL_MAX_DEPTH 輪
+            generation_started = time.perf_counter()
+            llm_result = self.llm.generate_with_tools(prompt_details, self.available_tools)
+            tool_seconds = llm_result.get("tool_seconds", 0.0)
+            timings.record("generation", time.perf_counter() - generation_started - tool_seconds)
+            if llm_result.get("tool_rounds"):
+                timings.record("tool_calls", tool_seconds)
+                spoken_response = llm_result.get("spoken_response") or "我...好像不知道該說什麼了。"
+                internal_thought = llm_result.get("internal_thought", "(使用工具後進行總結)")
             else:
                 spoken_response = llm_result.get("spoken_response", "我...好像不知道該說什麼了。")
                 internal_thought = llm_result.get("internal_thought")
+            turn_analysis = {"user_emotions": llm_result.get("user_emotions") or {}, "appraisal": llm_result.get("appraisal") or {}}
+
+            emotions_before_turn = dict(self.emotion_system.get_current_emotions())
+            if single_call_turn:
+                sensed_emotions = turn_analysis["user_emotions"]
+                if turn_analysis["appraisal"]:
+                    with timings.stage("emotion_update"):
+                        self.emotion_system.update_emotions_from_appraisals(
+                            turn_analysis["appraisal"], self.personality_system.character_traits,
+                            self.personality_system.effective_emo_sensitivity
+                        )
 
             self.last_pet_spoken_response = spoken_response
             self.last_pet_internal_thought = internal_thought
-            if internal_thought:
-                self.memory_system.save_memory(
-                    content=f"小星思考: {internal_thought}", importance=0,
-                    pet_emotions=self.emotion_system.get_current_emotions()
-                )
-            self.llm_history.append({"role": "user", "parts": [{"text": user_text}]})
-            self.llm_history.append({"role": "model", "parts": [{"text": spoken_response}]})
-            self.memory_system.save_memory(
-                content=f"小星說: {spoken_response}", importance=1,
-                pet_emotions=self.emotion_system.get_current_emotions()
-            )
-            self.personality_system.learn_from_user_text_async(user_text)
-            self.personality_system.learn_from_pet_text_async(spoken_response)
+            self.history.append({"role": "user", "parts": [{"text": user_text}]})
+            self.history.append({"role": "model", "parts": [{"text": spoken_response}]})
+
+            # 記憶寫入與學習不影響這次的回覆，交給背景執行緒在回覆顯示後進行
+            emotions_after_turn = dict(self.emotion_system.get_current_emotions())
+            self.turn_pipeline.submit_post_turn(lambda: self._persist_turn(
+                user_text, spoken_response, internal_thought, sensed_emotions,
+                analyze_if_missing=single_call_turn, emotions_before=emotions_before_turn, emotions_after=emotions_after_turn
+            ), timings)
+            self.last_turn_timings = timings.as_dict()
+            logging.info(f"Turn stages (ms): {self.last_turn_timings}; reply ready after {timings.total_ms()}ms.")
 
             return {
                 "display_text": spoken_response,
@@ -183,51 +270,148 @@ class PetLogic:
         finally:
             self.is_processing_llm = False
 
-    def _build_llm_prompt(self, user_message: str, user_sensed_emotions: Dict, request_type: str) -> Dict[str, Any]:
-        """建構完整的 LLM 提示"""
-        request_structured_output = request_type in ["user_submit", "proactive_chat", "self_talk"]
-        output_format_instruction = (
-            "\n\n重要輸出格式指示：\n"
-            "請嚴格以單一的 JSON 物件格式輸出你的完整回應。此 JSON 物件必須包含以下兩個鍵：\n"
-            "1. `internal_thought`: (字串) 代表你在說話前的內心思考、感受、意圖或簡要計畫。\n"
-            "2. `spoken_response`: (字串) 代表你最終決定對使用者說出的話。\n"
-            "```json\n"
-            "{\n"
-            "  \"internal_thought\": \"使用者聽起來很開心，我也跟著開心起來了！\",\n"
-            "  \"spoken_response\": \"聽起來是件很棒的事耶！我也為你感到高興！\"\n"
-            "}\n"
-            "```"
-        ) if request_structured_output else "\n\n請直接輸出你認為合適的回應文字。"
+    def _persist_turn(self, user_text: str, spoken_response: str, internal_thought: Optional[str],
+                      sensed_emotions: Dict[str, float], analyze_if_missing: bool,
+                      emotions_before: Dict[str, float], emotions_after: Dict[str, float]):
+        """回覆交給 UI 之後的持久化與學習 (在 TurnPipeline 的背景執行緒中依序執行)"""
+        if analyze_if_missing and not sensed_emotions and self.llm:
+            # 主要輸出缺少情緒欄位時才退回獨立的分析呼叫
+            logging.info("Single-call turn output lacked user_emotions; falling back to separate analysis.")
+            sensed_emotions = self.llm.analyze_text_for_emotions(user_text)
+        self.memory_system.save_memory(
+            content=f"使用者說: {user_text}", importance=2,
+            pet_emotions=emotions_before, user_emotions=sensed_emotions
+        )
+        if internal_thought:
+            self.memory_system.save_memory(
+                content=f"小星思考: {internal_thought}", importance=0, pet_emotions=emotions_after
+            )
+        self.memory_system.save_memory(
+            content=f"小星說: {spoken_response}", importance=1, pet_emotions=emotions_after
+        )
+        self.history.save()
+        self.personality_system.learn_from_user_text_async(user_text)
+        self.personality_system.learn_from_pet_text_async(spoken_response)
+
+    def _load_prompt_memories(self) -> Dict[str, List[Dict]]:
+        """提示用的近期記憶；先等上一回合的背景寫入完成，避免漏掉剛說過的話"""
+        self.turn_pipeline.wait_for_post_turn()
+        return self.memory_system.get_memories_for_prompt()
+
+    def _describe_prompt_prefix(self) -> Dict[str, Any]:
+        """穩定前綴中的個性與個體特徵描述 (各描述建構函式只讀取記憶體中的狀態與快取)"""
+        return {
+            "personality": [
+                self.personality_system.get_personality_description(),
+                self.personality_system.get_demographic_description(),
+                self.personality_system.get_attachment_description_for_llm(),
+                self.personality_system.get_self_efficacy_description_for_llm(),
+                self.personality_system.get_neuro_state_description_for_llm(),
+            ],
+            "characteristics": self.personality_system.get_characteristics_description_for_llm(),
+        }
 
+    def _build_llm_prompt(self, user_message: str, user_sensed_emotions: Dict, request_type: str,
+                          include_turn_analysis: bool = False, prompt_context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        建構完整的 LLM 提示。
+        prompt_context 為已平行取得的 {"memories", "personality", "characteristics"}；省略時在此依序取得。
+        """
+        request_structured_output = request_type in ["user_submit", "proactive_chat", "self_talk"]
+        if request_structured_output and include_turn_analysis:
+            output_format_instruction = (
+                "\n\n重要輸出格式指示：\n"
+                "請嚴格以單一的 JSON 物件格式輸出你的完整回應。此 JSON 物件必須包含以下四個鍵：\n"
+                "1. `internal_thought`: (字串) 代表你在說話前的內心思考、感受、意圖或簡要計畫。\n"
+                "2. `spoken_response`: (字串) 代表你最終決定對使用者說出的話。\n"
+                f"3. `user_emotions`: (物件) 使用者最新這句話表達的主要情緒 (最多5個，分數0~1)，情緒名稱只能從以下列表選擇：[{', '.join(config.EMOTIONS.keys())}]。\n"
+                "4. `appraisal`: (物件) 你對使用者這句話作為事件的評價，鍵為 novelty, pleasantness, goal_conduciveness, coping_potential, urgency，"
+                "pleasantness 與 goal_conduciveness 範圍 -1~1，其餘 0~1。\n"
+                "```json\n"
+                "{\n"
+                "  \"internal_thought\": \"使用者聽起來很開心，我也跟著開心起來了！\",\n"
+                "  \"spoken_response\": \"聽起來是件很棒的事耶！我也為你感到高興！\",\n"
+                "  \"user_emotions\": {\"joy\": 0.8, \"excitement\": 0.5},\n"
+                "  \"appraisal\": {\"novelty\": 0.4, \"pleasantness\": 0.8, \"goal_conduciveness\": 0.5, \"coping_potential\": 0.7, \"urgency\": 0.1}\n"
+                "}\n"
+                "```"
+            )
+        elif request_structured_output:
+            output_format_instruction = (
+                "\n\n重要輸出格式指示：\n"
+                "請嚴格以單一的 JSON 物件格式輸出你的完整回應。此 JSON 物件必須包含以下兩個鍵：\n"
+                "1. `internal_thought`: (字串) 代表你在說話前的內心思考、感受、意圖或簡要計畫。\n"
+                "2. `spoken_response`: (字串) 代表你最終決定對使用者說出的話。\n"
+                "```json\n"
+                "{\n"
+                "  \"internal_thought\": \"使用者聽起來很開心，我也跟著開心起來了！\",\n"
+                "  \"spoken_response\": \"聽起來是件很棒的事耶！我也為你感到高興！\"\n"
+                "}\n"
+                "```"
+            )
+        else:
+            output_format_instruction = "\n\n請直接輸出你認為合適的回應文字。"
+
+        if prompt_context is None:
+            prompt_context = {"memories": self.memory_system.get_memories_for_prompt(), **self._describe_prompt_prefix()}
+        memories = prompt_context["memories"]
+        recent_history = self.history.context_entries()
+        budget = int(self.settings.get(config.SETTING_PROMPT_TOKEN_BUDGET, 6000))
+
+        # 依優先度在 token 預算內填入各區段 (數字越小越優先)
+        sections = [
+            PromptSection("profile", [config.CHARACTER_PROFILE, "你擁有[搜尋]等工具，可以在需要時呼叫它們。"], priority=0, required=True),
+            PromptSection("format", [output_format_instruction], priority=0, required=True),
+            PromptSection("datetime", [f"現在是 {datetime.now().strftime('%Y年%m月%d日 %H:%M')}。"], priority=0, required=True),
+            # 使用者訊息完整送出；只有必要區段本身就超出預算時才截斷並標示
+            PromptSection("user_message", [user_message], priority=0, required=True, fit_remaining=True,
+                          truncation_marker="\n…(訊息過長，以下內容已省略)"),
+            PromptSection("personality", prompt_context["personality"], priority=1, truncatable=False),
+            PromptSection("history", [entry_text(entry) for entry in recent_history], priority=2, keep="tail", max_tokens=budget // 2),
+            PromptSection("conversation_summary", [self.history.summary] if self.history.summary else [], priority=3,
+                          header="\n之前的對話摘要："),
+            PromptSection("characteristics", [prompt_context["characteristics"]], priority=3),
+            PromptSection("stm", [f"- {(time.time() - mem['timestamp']) / 60:.0f}分鐘前: {mem['content']}" for mem in memories.get("stm", [])],
+                          priority=4, header="\n以下是你最近的一些重要對話片段："),
+            PromptSection("ltm", [f"- 我記得：『{mem['content']}』" for mem in memories.get("ltm", [])],
+                          priority=5, header="\n以下是你的一些長期記憶摘要："),
+        ]
+        packed, token_report = PromptPacker(budget).pack(sections)
+
+        def section_text(name: str, header: Optional[str] = None, joiner: str = "\n") -> str:
+            texts = [text for _, text in packed.get(name, [])]
+            if not texts: return ""
+            return joiner.join(([header] if header else []) + texts)
+
+        # 穩定前綴放在最前面，內容不變時跨回合共用同一個雜湊鍵 (可對應服務端上下文快取)
+        stable_prefix_key, stable_prefix = self.stable_prefix_cache.intern("\n\n".join(filter(None, [
+            section_text("profile", joiner="\n\n"),
+            section_text("personality", joiner="\n\n"),
+            section_text("characteristics"),
+        ])))
         system_prompt_parts: List[str] = [
-            config.CHARACTER_PROFILE,
-            "你擁有[搜尋]等工具，可以在需要時呼叫它們。",
-            self.personality_system.get_personality_description(),
-            self.personality_system.get_demographic_description(),
-            self.personality_system.get_attachment_description_for_llm(),
-            self.personality_system.get_self_efficacy_description_for_llm(),
-            self.personality_system.get_neuro_state_description_for_llm(), # --- [新增] 這一行 ---
-            self.personality_system.get_characteristics_description_for_llm(),
-            f"現在是 {datetime.now().strftime('%Y年%m月%d日 %H:%M')}。"
+            stable_prefix,
+            section_text("datetime"),
+            section_text("conversation_summary", header="\n之前的對話摘要："),
+            section_text("stm", header="\n以下是你最近的一些重要對話片段："),
+            section_text("ltm", header="\n以下是你的一些長期記憶摘要："),
+            section_text("format"),
         ]
-        
-        memories = self.memory_system.get_memories_for_prompt()
-        if memories.get("stm"):
-            formatted_stms = ["\n以下是你最近的一些重要對話片段："] + [f"- {(time.time() - mem['timestamp']) / 60:.0f}分鐘前: {mem['content']}" for mem in memories["stm"]]
-            system_prompt_parts.append("\n".join(formatted_stms))
-        if memories.get("ltm"):
-            formatted_ltms = ["\n以下是你的一些長期記憶摘要："] + [f"- 我記得：『{mem['content']}』" for mem in memories["ltm"]]
-            system_prompt_parts.append("\n".join(formatted_ltms))
-        
-        system_prompt_parts.append(output_format_instruction)
         final_system_prompt = "\n\n".join(filter(None, system_prompt_parts))
 
         messages_for_llm: List[Dict[str, Any]] = [
             {"role": "user", "parts": [{"text": final_system_prompt}]},
             {"role": "model", "parts": [{"text": "我明白了。我會基於以上所有資訊，扮演好「小星」這個角色，並嚴格按照要求的JSON格式來回應。"}]}
         ]
-        messages_for_llm.extend(self.llm_history[-10:])
-        messages_for_llm.append({"role": "user", "parts": [{"text": user_message}]})
+        for idx, text in packed.get("history", []):
+            messages_for_llm.append({"role": recent_history[idx]["role"], "parts": [{"text": text}]})
+        packed_user_message = section_text("user_message") or user_message
+        messages_for_llm.append({"role": "user", "parts": [{"text": packed_user_message}]})
+
+        if self.llm and int(self.settings.get(config.SETTING_PROMPT_EXACT_TOKEN_COUNT, 0)):
+            token_report["exact_total"] = self.llm.count_tokens(messages_for_llm)
+        self.last_prompt_token_report = token_report
+        logging.info(f"[{request_type}] {format_token_report(token_report)}")
         
         generation_config = {
             "temperature": self.settings.get(config.SETTING_LLM_TEMP, 0.75),
@@ -238,6 +422,8 @@ class PetLogic:
             "contents": messages_for_llm,
             "generation_config": generation_config,
             "expect_structured_output": request_structured_output,
+            "stable_prefix": {"key": stable_prefix_key, "text": stable_prefix},
+            "priority": PRIORITY_PROACTIVE if request_type in ["proactive_chat", "self_talk", "task_reminder_phrasing"] else PRIORITY_INTERACTIVE,
             "tools": self.tool_kit if self.search and self.search.is_enabled else None
         }
 
@@ -272,14 +458,21 @@ class PetLogic:
         logging.info("Proactive chat conditions met. Initiating.")
         self.last_proactive_chat_time = now
         prompt_theme = "你現在想要主動跟使用者說些話。請自然地、簡短地說幾句話。"
+        prefetched = self.search_prefetcher.store.freshest(self.personality_system.get_top_interests(config.SEARCH_PREFETCH_MAX_TOPICS))
+        if prefetched:
+            # 使用閒置時預取的資訊當話題，不必在開口時才連網搜尋
+            prompt_theme += (f"\n你稍早看到關於「{prefetched['topic']}」(使用者感興趣的主題) 的資訊，可以自然地提起：\n"
+                             + "\n".join(prefetched["results"][:2]))
         self.is_processing_llm = True
         try:
             prompt_details = self._build_llm_prompt(prompt_theme, {}, "proactive_chat")
-            llm_result = self.llm.generate_content(prompt_details)
+            # 主動聊天也可能想先查資料 (例如天氣)，以前工具呼叫會讓這次主動發言落空
+            llm_result = self.llm.generate_with_tools(prompt_details, self.available_tools)
             spoken_response = llm_result.get("spoken_response")
             if spoken_response:
                 self.memory_system.save_memory(f"小星(主動): {spoken_response}", 1, self.emotion_system.get_current_emotions())
-                self.llm_history.append({"role": "model", "parts": [{"text": spoken_response}]})
+                self.history.append({"role": "model", "parts": [{"text": spoken_response}]})
+                self.history.save()
                 return {"display_text": spoken_response, "new_emotion_for_ui": self.emotion_system.get_dominant_emotion_for_display(), "tag": "pet"}
             return None
         finally:
@@ -294,16 +487,43 @@ class PetLogic:
         self.personality_system.periodic_maintenance() 
 
         if not self.is_sleeping:
--
             self.emotion_system.decay_emotions(self.personality_system.effective_mood_stability)
             self.emotion_system.decay_core_affect(is_sleeping=False)
             self.emotion_system.apply_random_fluctuations(self.personality_system.effective_mood_stability)
             self.perform_daily_news_search_async()
+            if self.search_prefetcher.should_run(time.time() - self.last_interaction_time, self.is_sleeping):
+                self.search_prefetcher.run_async()
             
         self.memory_system.periodic_maintenance()
+        self._sync_local_knowledge()
         # self.personality_system.periodic_maintenance() 
         return {"new_emotion_for_ui": "sleepy" if self.is_sleeping else self.emotion_system.get_dominant_emotion_for_display()}
 
+    def _sync_local_knowledge(self):
+        """把新學到的使用者資訊與新聞摘要加入本地知識庫 (只處理有變動的項目)"""
+        if not self.local_knowledge or not self.local_knowledge.is_enabled:
+            return
+        try:
+            if not self._search_cache_synced:
+                self._search_cache_synced = True
+                indexed = self.local_knowledge.sync_search_cache()
+                if indexed:
+                    logging.info(f"Local knowledge: indexed {indexed} cached search results.")
+            chars = [char for char_list in self.personality_system.characteristics_cache.values() for char in char_list]
+            indexed = self.local_knowledge.sync_characteristics(chars)
+            if indexed:
+                logging.info(f"Local knowledge: indexed {indexed} learned facts/summaries.")
+        except Exception as e:
+            logging.error(f"Local knowledge sync failed: {e}", exc_info=True)
+
+    def import_knowledge_document(self, file_path: str) -> int:
+        """把文字檔匯入本地知識庫，返回索引的片段數 (知識庫不可用時返回 0)"""
+        if not self.local_knowledge or not self.local_knowledge.is_enabled:
+            return 0
+        with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+            text = f.read()
+        return self.local_knowledge.import_document(os.path.basename(file_path), text)
+
     def get_full_debug_status_report(self) -> str:
         """產生一份包含所有主要狀態的詳細報告字串，用於日誌記錄。"""
         report_parts = [
@@ -328,8 +548,51 @@ class PetLogic:
         report_parts.append(f"  - 依戀度 (Attachment): {self.personality_system.attachment_score:.3f}")
         report_parts.append("---")
         report_parts.append("**[記憶體]**")
-        report_parts.append(f"  - 對話歷史長度: {len(self.llm_history)} 條")
+        report_parts.append(f"  - 對話歷史: {self.history.get_stats()}")
         report_parts.append(f"  - 個體特徵快取數量: {sum(len(v) for v in self.personality_system.characteristics_cache.values())} 條")
+        if hasattr(self.embeddings, "get_stats"):
+            report_parts.append(f"  - 向量快取 ({self.embeddings.model_id}): {self.embeddings.get_stats()}")
+        if hasattr(self.search, "get_stats"):
+            report_parts.append(f"  - 搜尋 (本地知識庫 / 快取): {self.search.get_stats()}")
+        report_parts.append(f"  - 閒置預取: {self.search_prefetcher.get_stats()}")
+        report_parts.append(f"  - 近期記憶緩衝區: 命中 {self.memory_system.buffer_stats['hits']} 次, 回退資料庫 {self.memory_system.buffer_stats['db_fallbacks']} 次")
+        analysis_cache = getattr(self.llm, "analysis_cache", None)
+        if analysis_cache:
+            report_parts.append(f"  - 分析快取: {analysis_cache.get_stats()}")
+        if hasattr(self.llm, "get_reliability_stats"):
+            report_parts.append("---")
+            report_parts.append("**[LLM 呼叫可靠性]**")
+            report_parts.append(f"  - {self.llm.get_reliability_stats()}")
+        rate_limiter = getattr(self.llm, "rate_limiter", None)
+        if rate_limiter:
+            report_parts.append("**[速率限制與配額]**")
+            report_parts.append(f"  - {rate_limiter.get_stats()}")
+        scheduler = getattr(self.llm, "scheduler", None)
+        if scheduler:
+            report_parts.append("**[LLM 排程 (依優先等級)]**")
+            for priority, stats in scheduler.get_stats().items():
+                report_parts.append(
+                    f"  - {priority}: 執行中 {stats['running']}, 排隊 {stats['waiting']}, 放行 {stats['admitted']}, 捨棄 {stats['dropped']}, "
+                    f"排隊 p50/p95 {stats['queue_latency']['p50_ms']}/{stats['queue_latency']['p95_ms']} ms, "
+                    f"總延遲 p50/p95 {stats['total_latency']['p50_ms']}/{stats['total_latency']['p95_ms']} ms"
+                )
+        if self.last_prompt_token_report:
+            report_parts.append("---")
+            report_parts.append("**[最近一次提示 Token 用量]**")
+            report_parts.append(f"  - {format_token_report(self.last_prompt_token_report)}")
+            report_parts.append(f"  - 穩定前綴快取: {self.stable_prefix_cache.stats}")
+        if self.last_turn_timings:
+            report_parts.append("---")
+            report_parts.append("**[對話回合階段耗時 (ms)]**")
+            report_parts.append(f"  - 最近一回合: {self.last_turn_timings}")
+            report_parts.append(f"  - 近期統計: {self.turn_pipeline.get_stats()}")
+        report_parts.append("---")
+        report_parts.append("**[背景工作池]**")
+        for name, stats in worker_pools.get_stats().items():
+            report_parts.append(f"  - {name}: {stats}")
+        report_parts.append("---")
+        report_parts.append("**[啟動耗時]**")
+        report_parts.append(f"  - {startup_timer.format_report()}")
         report_parts.append("--- 報告結束 ---\n")
         return "\n".join(report_parts)
 
@@ -381,12 +644,12 @@ class PetLogic:
             self.personality_system.handle_significant_event("user_scolded_pet_critical", strength_modifier=1.2)
             return {"display_text": random.choice(["喔不...我會記下來，下次改進的。", "對不起，如果讓你感覺不好了..."]), "tag": "pet"}
         elif feedback_type == "correction" and self.llm:
-            thread = threading.Thread(target=self._learn_from_correction_worker, args=(self.last_pet_spoken_response, self.last_user_input_leading_to_response, feedback_text))
-            thread.daemon = True
-            thread.start()
+            worker_pools.dispatch("learning", self._learn_from_correction_worker,
+                                  self.last_pet_spoken_response, self.last_user_input_leading_to_response, feedback_text)
             return {"display_text": "啊，原來是這樣！非常感謝你的指正，我學到了！🧠✨", "tag": "pet"}
         return None
 
+    @with_priority(PRIORITY_LEARNING)
     def _learn_from_correction_worker(self, pet_original_response: str, user_original_input: str, user_correction: str):
         """在背景執行緒中，使用LLM分析使用者的糾正並學習。"""
         if not self.llm: return
@@ -407,8 +670,8 @@ class PetLogic:
             "```"
         )
         try:
-            analysis_result = self.llm.generate_content({"contents": [{"role": "user", "parts": [{"text": prompt}]}], "generation_config": {"temperature": 0.2}})
-            parsed_data = self.llm._parse_structured_output(analysis_result.get("spoken_response", ""))
+            analysis_result = self.llm.generate_content({"task": TASK_CORRECTION_ANALYSIS, "contents": [{"role": "user", "parts": [{"text": prompt}]}], "priority": PRIORITY_LEARNING})
+            parsed_data = extract_json(analysis_result.get("spoken_response", ""), expected_type=dict) or {}
             if parsed_data.get("corrected_fact"):
                 self.personality_system.add_or_update_characteristic(
                     trait_type=config.TRAIT_TYPE_USER_INFO,
@@ -426,10 +689,9 @@ class PetLogic:
             logging.info("Initial personality setup already done. Skipping.")
             return
         logging.info("Dispatching initial personality setup to worker...")
-        thread = threading.Thread(target=self._initial_personality_setup_worker)
-        thread.daemon = True
-        thread.start()
+        worker_pools.dispatch("maintenance", self._initial_personality_setup_worker)
 
+    @with_priority(PRIORITY_LEARNING)
     def _initial_personality_setup_worker(self):
         """在背景執行緒中執行搜尋並學習初始知識。"""
         if not self.search or not self.search.is_enabled:
@@ -443,9 +705,8 @@ class PetLogic:
         queries = [f"{user_culture}文化中的有趣習俗", "關於寵物的有趣知識", "一句隨機的勵志名言"]
         
         learned_facts_count = 0
-        for query in queries:
-            search_response = self.search.search(query, num_results=1)
-            time.sleep(1)
+        # 查詢彼此獨立，一次並行送出 (速率限制與配額由搜尋服務處理)
+        for query, search_response in zip(queries, self.search.search_many(queries, num_results=1)):
             if search_response and search_response.get("results"):
                 result_text = search_response["results"][0]
                 snippet_match = re.search(r"摘要:\s*(.*)", result_text)
@@ -471,10 +732,9 @@ class PetLogic:
         if (now_ts - last_search_ts) < (23 * 3600): return
         
         logging.info("Dispatching daily news search to worker...")
-        thread = threading.Thread(target=self._perform_daily_news_search_worker)
-        thread.daemon = True
-        thread.start()
+        worker_pools.dispatch("maintenance", self._perform_daily_news_search_worker)
 
+    @with_priority(PRIORITY_LEARNING)
     def _perform_daily_news_search_worker(self):
         """在背景執行緒中執行每日新聞搜尋並儲存摘要。"""
         if not self.search or not self.search.is_enabled:
@@ -482,10 +742,10 @@ class PetLogic:
             return
 
         logging.info("WORKER: Starting daily news search.")
-        query = "今日國際焦點新聞"
-        search_response = self.search.search(query, num_results=2)
-        if search_response and search_response.get("results"):
-            news_summary = "我今天瀏覽到一些資訊摘要：\n" + "\n".join(search_response["results"])
+        news_results = [result for search_response in self.search.search_many(config.DAILY_NEWS_SEARCH_QUERIES, num_results=2)
+                        for result in (search_response or {}).get("results", [])]
+        if news_results:
+            news_summary = "我今天瀏覽到一些資訊摘要：\n" + "\n".join(news_results)
             self.personality_system.add_or_update_characteristic(
                 trait_type=config.TRAIT_TYPE_KEY_MEMORY_SUMMARY,
                 trait_key="daily_news_summary_for_pet",
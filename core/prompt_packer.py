@@ -0,0 +1,176 @@
+# core/prompt_packer.py
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Callable, Tuple
+
+from services.tokens import estimate_tokens, truncate_to_tokens
+
+
+class PromptSection:
+    """
+    提示中的一個區段。
+
+    Args:
+        name: 區段名稱，用於用量報告。
+        items: 區段內的文字項目 (例如每條記憶、每則歷史訊息)。
+        priority: 數字越小越優先填入預算。
+        required: 必要區段永遠保留 (但仍受 max_tokens 限制)。
+        fit_remaining: 必要區段在其他必要區段之後填入；平常完整保留 (其他非必要區段先被裁減)，
+            只有必要區段加起來就超出預算時，才截斷到剩餘的預算。
+        keep: 預算不足時保留哪一端的項目，'head' 保留前面、'tail' 保留後面 (如對話歷史保留最新)。
+        truncatable: 是否允許截斷單一項目的文字；否則只能整條捨棄。
+        header: 區段標題，只有在至少保留一個項目時才會計入。
+        max_tokens: 此區段的上限 (可選)。
+        truncation_marker: 截斷項目時附加在結尾的標記，讓模型知道內容不完整 (可選)。
+    """
+
+    def __init__(self, name: str, items: List[str], priority: int, required: bool = False,
+                 keep: str = "head", truncatable: bool = True, header: Optional[str] = None,
+                 max_tokens: Optional[int] = None, min_item_tokens: int = 24, fit_remaining: bool = False,
+                 truncation_marker: Optional[str] = None):
+        self.name = name
+        self.items = [item for item in items if item]
+        self.priority = priority
+        self.required = required
+        self.keep = keep
+        self.truncatable = truncatable
+        self.header = header
+        self.max_tokens = max_tokens
+        self.min_item_tokens = min_item_tokens
+        self.fit_remaining = fit_remaining
+        self.truncation_marker = truncation_marker
+
+
+class PromptPacker:
+    """依優先順序在 token 預算內填入各區段，並回報每個區段的用量"""
+
+    def __init__(self, budget_tokens: int, token_counter: Callable[[str], int] = estimate_tokens):
+        self.budget_tokens = max(0, int(budget_tokens))
+        self.count = token_counter
+
+    def pack(self, sections: List[PromptSection]) -> Tuple[Dict[str, List[Tuple[int, str]]], Dict[str, Any]]:
+        """
+        Returns:
+            (packed, report)
+            packed: {區段名稱: [(原始索引, 文字), ...]}，依原始順序排列。
+            report: 包含預算、總用量與每個區段用量的字典。
+        """
+        remaining = self.budget_tokens
+        packed: Dict[str, List[Tuple[int, str]]] = {}
+        report_sections: Dict[str, Dict[str, Any]] = {}
+
+        # 必要區段先扣除 (fit_remaining 的排在其他必要區段之後)，其餘依優先度排序
+        ordered = sorted(sections, key=lambda s: (not s.required, s.fit_remaining, s.priority))
+        for section in ordered:
+            if section.required:
+                section_budget = section.max_tokens  # 必要區段不受剩餘預算限制，只受自身上限
+                if section.fit_remaining:
+                    room = max(remaining, section.min_item_tokens)
+                    section_budget = room if section_budget is None else min(section_budget, room)
+            else:
+                section_budget = max(0, remaining)
+                if section.max_tokens is not None:
+                    section_budget = min(section_budget, section.max_tokens)
+
+            kept, used, truncated = self._fill_section(section, section_budget)
+            packed[section.name] = kept
+            remaining -= used
+            original_tokens = sum(self.count(item) for item in section.items) + (self.count(section.header) if section.header and section.items else 0)
+            report_sections[section.name] = {
+                "tokens": used,
+                "original_tokens": original_tokens,
+                "items_kept": len(kept),
+                "items_total": len(section.items),
+                "truncated": truncated or len(kept) < len(section.items),
+            }
+
+        estimated_total = sum(s["tokens"] for s in report_sections.values())
+        report = {
+            "budget": self.budget_tokens,
+            "estimated_total": estimated_total,
+            "over_budget": estimated_total > self.budget_tokens,
+            "sections": report_sections,
+        }
+        return packed, report
+
+    def _fill_section(self, section: PromptSection, budget: Optional[int]) -> Tuple[List[Tuple[int, str]], int, bool]:
+        if not section.items:
+            return [], 0, False
+
+        header_cost = self.count(section.header) if section.header else 0
+        if budget is not None and budget <= header_cost:
+            return [], 0, False
+
+        used = header_cost
+        truncated = False
+        indices = list(range(len(section.items)))
+        if section.keep == "tail":
+            indices.reverse()
+
+        kept: List[Tuple[int, str]] = []
+        for idx in indices:
+            text = section.items[idx]
+            cost = self.count(text)
+            if budget is None or used + cost <= budget:
+                kept.append((idx, text))
+                used += cost
+                continue
+            room = budget - used
+            if section.truncatable and room >= section.min_item_tokens:
+                marker = section.truncation_marker or ""
+                shortened = truncate_to_tokens(text, room - (self.count(marker) if marker else 0))
+                if shortened:
+                    shortened += marker
+                    kept.append((idx, shortened))
+                    used += self.count(shortened)
+                    truncated = True
+            break
+
+        if not kept:
+            return [], 0, truncated
+        kept.sort(key=lambda pair: pair[0])
+        return kept, used, truncated
+
+
+def format_token_report(report: Dict[str, Any]) -> str:
+    """將用量報告整理成一行日誌文字"""
+    parts = [f"{name}={info['tokens']}" + ("*" if info["truncated"] else "")
+             for name, info in report.get("sections", {}).items()]
+    exact = report.get("exact_total")
+    exact_str = f", exact={exact}" if exact is not None else ""
+    return f"Prompt tokens ≈{report.get('estimated_total', 0)}/{report.get('budget', 0)}{exact_str} [{', '.join(parts)}] (*=truncated)"
+
+
+class StablePrefixCache:
+    """
+    系統提示中跨回合不變的前綴 (角色設定、人格描述、個體特徵) 的快取。
+
+    以內容雜湊為鍵保存組好的前綴文字；相同內容的回合會拿到同一個鍵與同一個字串物件，
+    服務層可用這個鍵對應到服務端的上下文快取 (見 GeminiService 的 stable_prefix 處理)。
+    """
+
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def content_key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()[:24]
+
+    def intern(self, text: str) -> Tuple[str, str]:
+        """返回 (內容雜湊, 快取中的前綴文字)"""
+        key = self.content_key(text)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return key, cached
+            self.stats["misses"] += 1
+            self._entries[key] = text
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return key, text
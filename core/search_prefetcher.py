@@ -0,0 +1,194 @@
+# core/search_prefetcher.py
+import json
+import time
+import logging
+import threading
+from datetime import date, datetime
+from typing import Dict, Any, Optional, List
+
+import config
+from database import DatabaseManager
+from services.base_services import SearchService
+from services.llm_scheduler import PRIORITY_MAINTENANCE, with_priority
+from services.search_cache import query_signature
+from services.worker_pool import worker_pools
+
+
+class PrefetchStore:
+    """
+    預先搜尋結果的本地儲存 (SQLite search_prefetch 表 + 記憶體副本)。
+    每個主題一筆，記錄查詢字串、結果與取得時間 (新鮮度戳記)。
+    """
+
+    def __init__(self, db_manager: DatabaseManager):
+        self.db = db_manager
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        for row in self.db.load_search_prefetch_entries():
+            try:
+                row["results"] = json.loads(row.pop("results_json"))
+            except json.JSONDecodeError:
+                continue
+            row["signature"] = query_signature(row["query"])
+            row["topic_signature"] = query_signature(row["topic"])
+            self._entries[row["topic"]] = row
+
+    def put(self, topic: str, query: str, results: List[str]):
+        fetched_at = time.time()
+        with self._lock:
+            self._entries[topic] = {"topic": topic, "query": query, "results": list(results),
+                                    "fetched_at": fetched_at, "signature": query_signature(query),
+                                    "topic_signature": query_signature(topic)}
+        self.db.save_search_prefetch_entry(topic, query, json.dumps(results, ensure_ascii=False), fetched_at)
+
+    def age_of(self, topic: str) -> Optional[float]:
+        with self._lock:
+            entry = self._entries.get(topic)
+        return time.time() - entry["fetched_at"] if entry else None
+
+    def lookup(self, query: str, max_age: float = config.SEARCH_PREFETCH_SERVE_MAX_AGE_SECONDS) -> Optional[Dict[str, Any]]:
+        """
+        找出能回答 query 的預取結果：查詢的特徵大部分 (SEARCH_PREFETCH_MATCH_MIN_COVERAGE) 落在某個預取查詢中、
+        至少提到該主題的一部分，且結果未超過 max_age。有多筆時取覆蓋率最高、最新的一筆。
+        """
+        signature = query_signature(query)
+        if not signature:
+            return None
+        now = time.time()
+        best, best_key = None, None
+        with self._lock:
+            for entry in self._entries.values():
+                if now - entry["fetched_at"] > max_age or not entry["results"]:
+                    continue
+                if not signature & entry["topic_signature"]:
+                    continue  # 只命中「最新消息」這類模板字，沒有提到主題
+                coverage = len(signature & entry["signature"]) / len(signature)
+                if coverage < config.SEARCH_PREFETCH_MATCH_MIN_COVERAGE:
+                    continue
+                key = (coverage, entry["fetched_at"])
+                if best_key is None or key > best_key:
+                    best, best_key = entry, key
+        return dict(best) if best else None
+
+    def freshest(self, topics: List[str], max_age: float = config.SEARCH_PREFETCH_SERVE_MAX_AGE_SECONDS) -> Optional[Dict[str, Any]]:
+        """指定主題中最新且未過期的一筆"""
+        now = time.time()
+        with self._lock:
+            candidates = [self._entries[topic] for topic in topics
+                          if topic in self._entries and now - self._entries[topic]["fetched_at"] <= max_age
+                          and self._entries[topic]["results"]]
+        return dict(max(candidates, key=lambda entry: entry["fetched_at"])) if candidates else None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class SearchPrefetcher:
+    """
+    使用者閒置且寵物醒著時，預先搜尋使用者最感興趣的主題 (favorite_topic / preference 特徵)。
+
+    結果存入 PrefetchStore，custom_search 工具與主動聊天可以直接使用，不必在寵物開口時才連網。
+    預取是投機性的工作：使用最低的 maintenance 優先等級，每日次數有獨立預算，
+    並且在搜尋配額所剩不多時停止，不和使用者的工具呼叫搶配額。
+    """
+
+    def __init__(self, db_manager: DatabaseManager, search_service: Optional[SearchService], personality_system):
+        self.db = db_manager
+        self.search = search_service
+        self.personality_system = personality_system
+        self.store = PrefetchStore(db_manager)
+        self.last_run_time = 0.0
+        self._running = threading.Lock()
+        self.stats = {"runs": 0, "searches": 0, "served": 0}
+
+    def _load_usage(self) -> Dict[str, Any]:
+        try:
+            usage = json.loads(self.db.load_app_setting(config.SETTING_SEARCH_PREFETCH_USAGE, "") or "{}")
+        except json.JSONDecodeError:
+            usage = {}
+        if usage.get("date") != date.today().isoformat():
+            usage = {"date": date.today().isoformat(), "searches": 0}
+        return usage
+
+    def remaining_budget(self) -> int:
+        return max(0, config.SEARCH_PREFETCH_DAILY_BUDGET - int(self._load_usage().get("searches", 0)))
+
+    def topics_to_refresh(self) -> List[str]:
+        """最感興趣、且沒有足夠新鮮預取結果的主題"""
+        topics = self.personality_system.get_top_interests(config.SEARCH_PREFETCH_MAX_TOPICS)
+        stale = []
+        for topic in topics:
+            if len(topic) > config.SEARCH_PREFETCH_MAX_TOPIC_CHARS:
+                continue  # 長句式的偏好不適合直接當搜尋主題
+            age = self.store.age_of(topic)
+            if age is None or age > config.SEARCH_PREFETCH_REFRESH_AGE_SECONDS:
+                stale.append(topic)
+        return stale
+
+    def should_run(self, idle_seconds: float, is_sleeping: bool) -> bool:
+        if not self.search or not self.search.is_enabled or is_sleeping:
+            return False
+        if idle_seconds < config.SEARCH_PREFETCH_MIN_IDLE_SECONDS:
+            return False
+        return time.time() - self.last_run_time >= config.SEARCH_PREFETCH_RUN_INTERVAL_SECONDS
+
+    def run_async(self):
+        """在 maintenance 工作池中執行一輪預取 (上一輪尚未結束時略過)"""
+        self.last_run_time = time.time()
+        worker_pools.dispatch("maintenance", self._run_worker)
+
+    @with_priority(PRIORITY_MAINTENANCE)
+    def _run_worker(self):
+        if not self._running.acquire(blocking=False):
+            return
+        try:
+            self.run_once()
+        except Exception as e:
+            logging.error(f"WORKER: Search prefetch failed: {e}", exc_info=True)
+        finally:
+            self._running.release()
+
+    def run_once(self) -> int:
+        """預取一輪，返回成功更新的主題數"""
+        topics = self.topics_to_refresh()
+        budget = min(self.remaining_budget(), config.SEARCH_PREFETCH_TOPICS_PER_RUN)
+        rate_limiter = getattr(self.search, "rate_limiter", None)
+        if rate_limiter:
+            headroom = rate_limiter.search_quota_remaining(PRIORITY_MAINTENANCE) - config.SEARCH_PREFETCH_MIN_QUOTA_HEADROOM
+            budget = min(budget, max(0, headroom))
+        topics = topics[:budget]
+        if not topics:
+            logging.debug("Search prefetch: nothing to refresh (or no budget left).")
+            return 0
+
+        queries = [config.SEARCH_PREFETCH_QUERY_TEMPLATE.format(topic=topic) for topic in topics]
+        logging.info(f"Search prefetch: refreshing {len(topics)} topics: {topics}")
+        responses = self.search.search_many(queries, num_results=config.SEARCH_PREFETCH_RESULTS_PER_TOPIC)
+        usage = self._load_usage()
+        usage["searches"] = int(usage.get("searches", 0)) + len(queries)
+        self.db.save_app_setting(config.SETTING_SEARCH_PREFETCH_USAGE, json.dumps(usage))
+
+        refreshed = 0
+        for topic, query, response in zip(topics, queries, responses):
+            if response and not response.get("error"):
+                self.store.put(topic, query, response.get("results", []))
+                refreshed += 1
+        self.stats["runs"] += 1
+        self.stats["searches"] += len(queries)
+        return refreshed
+
+    def answer(self, query: str) -> Optional[Dict[str, Any]]:
+        """以預取結果回答搜尋查詢；結果附上取得時間，讓模型知道資料的新鮮度"""
+        entry = self.store.lookup(query)
+        if not entry:
+            return None
+        self.stats["served"] += 1
+        logging.info(f"Search prefetch: answered '{query}' from prefetched topic '{entry['topic']}'.")
+        return {
+            "results": entry["results"],
+            "fetched_at": datetime.fromtimestamp(entry["fetched_at"]).strftime("%Y-%m-%d %H:%M"),
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "topics": len(self.store), "budget_left_today": self.remaining_budget()}
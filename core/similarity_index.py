@@ -0,0 +1,174 @@
+# core/similarity_index.py
+import re
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict, Counter
+from typing import Dict, Any, Optional, List, Tuple, FrozenSet
+
+FINGERPRINT_BITS = 64
+
+
+def normalize_text_for_fingerprint(text: str) -> str:
+    """將文字正規化 (全半形、大小寫、空白與標點)，讓近似內容得到相同的特徵"""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", str(text)).lower()
+    text = re.sub(r"[\s　]+", " ", text)
+    # 移除大部分標點，保留中英文與數字
+    text = re.sub(r"[^\w一-鿿 ]+", "", text)
+    return text.strip()
+
+
+def extract_shingles(text: str, size: int = 2) -> FrozenSet[str]:
+    """以字元 n-gram (預設雙字) 產生 shingle 集合，對中文短句也能運作"""
+    compact = text.replace(" ", "")
+    if len(compact) <= size:
+        return frozenset([compact]) if compact else frozenset()
+    return frozenset(compact[i:i + size] for i in range(len(compact) - size + 1))
+
+
+def _feature_hash(feature: str) -> int:
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def simhash(text: str, shingle_size: int = 2) -> Tuple[int, FrozenSet[str]]:
+    """計算 64 位元 SimHash 指紋，同時返回用於精確驗證的 shingle 集合"""
+    normalized = normalize_text_for_fingerprint(text)
+    compact = normalized.replace(" ", "")
+    shingles = extract_shingles(normalized, shingle_size)
+    if not shingles:
+        return 0, shingles
+
+    weights = [0] * FINGERPRINT_BITS
+    counts = Counter(compact[i:i + shingle_size] for i in range(max(1, len(compact) - shingle_size + 1)))
+    for feature, weight in counts.items():
+        h = _feature_hash(feature)
+        for bit in range(FINGERPRINT_BITS):
+            weights[bit] += weight if (h >> bit) & 1 else -weight
+
+    fingerprint = 0
+    for bit, value in enumerate(weights):
+        if value > 0:
+            fingerprint |= 1 << bit
+    return fingerprint, shingles
+
+
+def jaccard_similarity(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a and not b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class SimHashIndex:
+    """
+    以 SimHash + LSH 分段 (bands) 建立的近似重複索引。
+
+    64 位元指紋切成 `bands` 段，每段作為雜湊桶的鍵。依鴿籠原理，
+    漢明距離不超過 bands-1 的兩個指紋至少有一段完全相同，因此查詢只需
+    檢查少數候選，期望時間為 O(1)。候選會再以 shingle 的 Jaccard 相似度驗證，
+    避免短句因共同前綴而被誤判。
+    """
+
+    def __init__(self, max_hamming_distance: int = 3, bands: int = 4, min_jaccard: float = 0.7,
+                 min_shingles: int = 4, max_entries: int = 5000):
+        if FINGERPRINT_BITS % bands != 0:
+            raise ValueError("bands must evenly divide the fingerprint size.")
+        if max_hamming_distance >= bands:
+            raise ValueError("max_hamming_distance must be smaller than bands to guarantee recall.")
+        self.max_hamming_distance = max_hamming_distance
+        self.bands = bands
+        self.band_bits = FINGERPRINT_BITS // bands
+        self.min_jaccard = min_jaccard
+        self.min_shingles = min_shingles
+        self.max_entries = max_entries
+
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, int, int], set] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return list(self._entries.keys())
+
+    def _band_keys(self, namespace: str, fingerprint: int) -> List[Tuple[str, int, int]]:
+        mask = (1 << self.band_bits) - 1
+        return [(namespace, band, (fingerprint >> (band * self.band_bits)) & mask) for band in range(self.bands)]
+
+    def add(self, key: str, text: str, namespace: str = "default", payload: Optional[Dict[str, Any]] = None):
+        """將一筆內容加入索引；相同 key 會覆蓋舊的條目"""
+        fingerprint, shingles = simhash(text)
+        with self._lock:
+            if key in self._entries:
+                self._remove_locked(key)
+            self._entries[key] = {
+                "namespace": namespace, "fingerprint": fingerprint,
+                "shingles": shingles, "payload": payload or {}
+            }
+            for band_key in self._band_keys(namespace, fingerprint):
+                self._buckets.setdefault(band_key, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                oldest_key = next(iter(self._entries))
+                self._remove_locked(oldest_key)
+
+    def remove(self, key: str):
+        with self._lock:
+            self._remove_locked(key)
+
+    def _remove_locked(self, key: str):
+        entry = self._entries.pop(key, None)
+        if not entry:
+            return
+        for band_key in self._band_keys(entry["namespace"], entry["fingerprint"]):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def find_near_duplicate(self, text: str, namespace: str = "default") -> Optional[Tuple[str, Dict[str, Any], float]]:
+        """
+        尋找與 text 近似重複的既有條目。
+
+        Returns:
+            (key, payload, jaccard) 或 None。
+        """
+        fingerprint, shingles = simhash(text)
+        exact_only = len(shingles) < self.min_shingles
+        best: Optional[Tuple[str, Dict[str, Any], float]] = None
+        with self._lock:
+            candidates = set()
+            for band_key in self._band_keys(namespace, fingerprint):
+                candidates.update(self._buckets.get(band_key, ()))
+            for key in candidates:
+                entry = self._entries.get(key)
+                if not entry:
+                    continue
+                if exact_only:
+                    if entry["shingles"] != shingles:
+                        continue
+                    similarity = 1.0
+                else:
+                    if bin(entry["fingerprint"] ^ fingerprint).count("1") > self.max_hamming_distance:
+                        continue
+                    similarity = jaccard_similarity(entry["shingles"], shingles)
+                    if similarity < self.min_jaccard:
+                        continue
+                if best is None or similarity > best[2]:
+                    best = (key, dict(entry["payload"]), similarity)
+            if best:
+                self._entries.move_to_end(best[0])
+        if best:
+            logging.debug(f"SimHashIndex: near-duplicate found in '{namespace}' (jaccard={best[2]:.2f}).")
+        return best
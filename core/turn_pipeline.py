@@ -0,0 +1,145 @@
+# core/turn_pipeline.py
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, Any, Callable, Optional, List, Deque
+
+import config
+from services.llm_scheduler import PRIORITY_LEARNING, current_priority, request_priority
+from services.worker_pool import RejectedJobError, worker_pools
+
+
+class TurnTimings:
+    """一個對話回合中各階段的耗時 (毫秒)；階段可以在不同執行緒中同時記錄"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.stages[name] = round(self.stages.get(name, 0.0) + seconds * 1000, 1)
+
+    def stage(self, name: str) -> "_Stage":
+        """with timings.stage("generation"): ... 記錄區塊耗時"""
+        return _Stage(self, name)
+
+    def total_ms(self) -> float:
+        return round((time.perf_counter() - self.started_at) * 1000, 1)
+
+    def as_dict(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self.stages)
+
+
+class _Stage:
+    def __init__(self, timings: TurnTimings, name: str):
+        self.timings = timings
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.timings.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class TurnPipeline:
+    """
+    handle_user_input 的階段管線。
+
+    - run_parallel()：彼此獨立的前置階段 (記憶擷取、提示前綴描述、情緒分析) 同時在 turn_stages 工作池中執行，
+      呼叫端的優先等級會帶進工作執行緒，LLM 排程器仍能正確分類。
+    - submit_post_turn()：回覆交給 UI 之後才做的持久化與學習，以 learning 優先等級在單一執行緒的 post_turn 工作池依序執行，
+      保持「使用者說 → 小星思考 → 小星說」的記憶寫入順序；下一回合擷取記憶前可用 wait_for_post_turn() 等它寫完。
+      工作池已關閉時改在呼叫端同步執行，不會讓已產生回覆的回合失敗。
+    - 每回合的階段耗時記錄在 TurnTimings，並保留最近 TURN_TIMINGS_HISTORY 回合供除錯報告統計。
+    """
+
+    def __init__(self):
+        self._last_post_turn: Optional[Future] = None
+        self._history: Deque[Dict[str, Any]] = deque(maxlen=config.TURN_TIMINGS_HISTORY)
+        self._history_lock = threading.Lock()
+
+    def _wrap(self, name: str, func: Callable[[], Any], timings: TurnTimings, priority: Optional[str] = None) -> Callable[[], Any]:
+        priority = priority or current_priority()
+
+        def run():
+            with request_priority(priority), timings.stage(name):
+                return func()
+        return run
+
+    def run_parallel(self, stages: Dict[str, Callable[[], Any]], timings: TurnTimings) -> Dict[str, Any]:
+        """同時執行多個階段，返回 {階段名稱: 結果}；任一階段失敗時重新拋出它的例外"""
+        if len(stages) == 1:
+            name, func = next(iter(stages.items()))
+            return {name: self._wrap(name, func, timings)()}
+        pool = worker_pools.get("turn_stages")
+        futures: Dict[str, Future] = {}
+        inline: Dict[str, Callable[[], Any]] = {}
+        for name, func in stages.items():
+            try:
+                futures[name] = pool.submit(self._wrap(name, func, timings))
+            except RejectedJobError:
+                inline[name] = self._wrap(name, func, timings)  # 工作池已關閉：在呼叫端執行
+        results = {name: stage() for name, stage in inline.items()}
+        results.update({name: future.result() for name, future in futures.items()})
+        return {name: results[name] for name in stages}
+
+    def submit_post_turn(self, func: Callable[[], None], timings: TurnTimings) -> Future:
+        """排入回覆後的背景工作；完成時把該回合的完整耗時記入歷史"""
+        wrapped = self._wrap("post_turn", func, timings, priority=PRIORITY_LEARNING)
+
+        def run():
+            try:
+                wrapped()
+            except Exception as e:
+                logging.error(f"Post-turn processing failed: {e}", exc_info=True)
+            finally:
+                self._remember(timings)
+
+        try:
+            future = worker_pools.get("post_turn").submit(run)
+        except RejectedJobError:
+            # 工作池已關閉 (回合在 PetLogic.shutdown() 之後才結束)：直接在這裡寫入，回合的記憶不會遺失
+            logging.info("Post-turn pool is shut down; persisting the turn synchronously.")
+            future = Future()
+            run()
+            future.set_result(None)
+        self._last_post_turn = future
+        return future
+
+    def wait_for_post_turn(self, timeout: float = config.TURN_POST_PROCESSING_WAIT_SECONDS) -> bool:
+        """等待上一回合的背景持久化完成；逾時返回 False (不阻擋本回合)"""
+        future = self._last_post_turn
+        if future is None or future.done():
+            return True
+        try:
+            future.result(timeout=timeout)
+            return True
+        except Exception:
+            return future.done()
+
+    def _remember(self, timings: TurnTimings):
+        with self._history_lock:
+            self._history.append(timings.as_dict())
+
+    def get_stats(self) -> Dict[str, Any]:
+        """最近幾回合各階段的平均與最大耗時 (毫秒)"""
+        with self._history_lock:
+            history: List[Dict[str, float]] = list(self._history)
+        stages: Dict[str, List[float]] = {}
+        for turn in history:
+            for name, ms in turn.items():
+                stages.setdefault(name, []).append(ms)
+        return {
+            "turns": len(history),
+            "stages_ms": {name: {"avg": round(sum(values) / len(values), 1), "max": max(values)}
+                          for name, values in stages.items()},
+        }
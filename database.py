@@ -107,6 +107,37 @@ class DatabaseManager:
                             )''')
                 c.execute('''CREATE INDEX IF NOT EXISTS idx_emotion_history_user_time
                              ON emotion_history(user_id, timestamp DESC)''')
+                c.execute('''CREATE TABLE IF NOT EXISTS llm_analysis_cache (
+                                cache_key TEXT PRIMARY KEY, kind TEXT, result_json TEXT NOT NULL,
+                                created_at REAL, expires_at REAL, last_accessed REAL
+                             )''')
+                c.execute('''CREATE INDEX IF NOT EXISTS idx_llm_analysis_cache_accessed
+                             ON llm_analysis_cache(last_accessed)''')
+                c.execute('''CREATE TABLE IF NOT EXISTS embedding_cache (
+                                cache_key TEXT PRIMARY KEY, model_id TEXT, vector BLOB NOT NULL,
+                                created_at REAL, last_accessed REAL
+                             )''')
+                c.execute('''CREATE INDEX IF NOT EXISTS idx_embedding_cache_accessed
+                             ON embedding_cache(last_accessed)''')
+                c.execute('''CREATE TABLE IF NOT EXISTS search_cache (
+                                cache_key TEXT PRIMARY KEY, query TEXT NOT NULL, num INTEGER, lr TEXT, query_class TEXT,
+                                result_json TEXT NOT NULL, created_at REAL, expires_at REAL, last_accessed REAL
+                             )''')
+                c.execute('''CREATE INDEX IF NOT EXISTS idx_search_cache_accessed
+                             ON search_cache(last_accessed)''')
+                c.execute('''CREATE TABLE IF NOT EXISTS search_prefetch (
+                                topic TEXT PRIMARY KEY, query TEXT NOT NULL, results_json TEXT NOT NULL, fetched_at REAL
+                             )''')
+                c.execute('''CREATE TABLE IF NOT EXISTS knowledge_documents (
+                                doc_id INTEGER PRIMARY KEY AUTOINCREMENT, doc_key TEXT UNIQUE NOT NULL, source TEXT,
+                                title TEXT, body TEXT NOT NULL, link TEXT, updated_at REAL
+                             )''')
+                try:
+                    # 本地知識庫的全文索引；詞彙由 services/local_knowledge_service.py 預先切成雙字詞
+                    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS knowledge_fts
+                                 USING fts5(title_terms, body_terms, tokenize='unicode61')''')
+                except sqlite3.OperationalError as e:
+                    logging.warning(f"SQLite FTS5 is unavailable; local knowledge search is disabled: {e}")
 
                 # --- 欄位遷移 (Schema migrations) ---
                 # 將原始檔案中的所有 ALTER TABLE 邏輯遷移至此
@@ -135,11 +166,16 @@ class DatabaseManager:
                         c.execute(f"ALTER TABLE {table} ADD COLUMN keywords TEXT DEFAULT NULL")
                     if not self._column_exists(c, table, 'emotional_intensity'):
                         c.execute(f"ALTER TABLE {table} ADD COLUMN emotional_intensity REAL DEFAULT 0.0")
+                    if not self._column_exists(c, table, 'mention_count'):
+                        c.execute(f"ALTER TABLE {table} ADD COLUMN mention_count INTEGER DEFAULT 1")
 
                 if not self._column_exists(c, 'individual_characteristics', 'source'):
                     c.execute("ALTER TABLE individual_characteristics ADD COLUMN source TEXT")
                 if not self._column_exists(c, 'individual_characteristics', 'version'):
                     c.execute("ALTER TABLE individual_characteristics ADD COLUMN version INTEGER DEFAULT 1")
+                if not self._column_exists(c, 'individual_characteristics', 'key_aliases'):
+                    # 近似重複合併時保留的其他 trait_key，格式為 "|別名1|別名2|"
+                    c.execute("ALTER TABLE individual_characteristics ADD COLUMN key_aliases TEXT DEFAULT ''")
                 if not self._column_exists(c, 'individual_characteristics', 'last_reinforced_timestamp'):
                     c.execute("ALTER TABLE individual_characteristics ADD COLUMN last_reinforced_timestamp REAL")
 
@@ -270,8 +306,9 @@ class DatabaseManager:
     # --- 記憶管理 ---
     def save_memory(self, user_id: str, content: str, is_long_term: bool, importance: int, status: str,
                     pet_emotions_json: Optional[str], user_emotions_json: Optional[str],
-                    keywords: Optional[str], emotional_intensity: float):
-        """將一條記憶儲存到資料庫"""
+                    keywords: Optional[str], emotional_intensity: float,
+                    timestamp: Optional[float] = None) -> Optional[str]:
+        """將一條記憶儲存到資料庫，成功時返回新記憶的 ID"""
         table = 'long_term_memory' if is_long_term else 'short_term_memory'
         try:
             with self._get_connection() as conn:
@@ -282,13 +319,34 @@ class DatabaseManager:
                                pet_emotions_snapshot, user_emotions_snapshot,
                                keywords, emotional_intensity)
                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                          (mem_id, user_id, content, time.time(),
+                          (mem_id, user_id, content, timestamp if timestamp is not None else time.time(),
                            importance, status, pet_emotions_json, user_emotions_json,
                            keywords, emotional_intensity))
                 conn.commit()
                 logging.debug(f"Saved memory to {table} (ID: {mem_id[:8]}) for user {user_id}.")
+                return mem_id
         except sqlite3.Error as e:
             logging.error(f"Failed to save memory to {table} for user {user_id}: {e}")
+            return None
+
+    def reinforce_memory(self, mem_id: str, is_long_term: bool, importance: int,
+                         emotional_intensity: float, timestamp: float) -> bool:
+        """強化一條既有的記憶 (近似重複時合併)，只對仍在使用中的記憶生效"""
+        table = 'long_term_memory' if is_long_term else 'short_term_memory'
+        try:
+            with self._get_connection() as conn:
+                c = conn.cursor()
+                c.execute(f"""UPDATE {table}
+                              SET timestamp=?, importance=MAX(COALESCE(importance, 0), ?),
+                                  emotional_intensity=MAX(COALESCE(emotional_intensity, 0.0), ?),
+                                  mention_count=COALESCE(mention_count, 1) + 1
+                              WHERE id=? AND status IN ('remembered', 'summarized_from_stm')""",
+                          (timestamp, importance, emotional_intensity, mem_id))
+                conn.commit()
+                return c.rowcount > 0
+        except sqlite3.Error as e:
+            logging.error(f"Failed to reinforce memory {mem_id} in {table}: {e}")
+            return False
 
     def load_memory(self, user_id: str, is_long_term: bool = False, limit: int = 50, status_filter: Optional[str] = 'remembered') -> List[Dict]:
         """從資料庫載入記憶"""
@@ -331,8 +389,8 @@ class DatabaseManager:
 
     def clean_short_term_memory(self, user_id: str, retention_days: int,
                                 importance_threshold_for_archive: int,
-                                emotional_intensity_threshold_for_archive: float):
-        """清理舊的短期記憶，標記為'forgotten'或'to_be_archived'"""
+                                emotional_intensity_threshold_for_archive: float) -> int:
+        """清理舊的短期記憶，標記為'forgotten'或'to_be_archived'，返回狀態被變更的筆數"""
         if retention_days <= 0:
             retention_days = 1
 
@@ -372,6 +430,7 @@ class DatabaseManager:
 
         except sqlite3.Error as e:
             logging.error(f"Failed to clean short-term memory for user {user_id}: {e}")
+        return archived_count + forgotten_count
 
     # --- 角色、人口統計、個體特徵 ---
 
@@ -528,8 +587,8 @@ class DatabaseManager:
                 query = "SELECT * FROM individual_characteristics WHERE user_id=? AND trait_type=?"
                 params: List[Any] = [user_id, trait_type]
                 if trait_key is not None:
-                    query += " AND trait_key=?"
-                    params.append(trait_key)
+                    query += " AND (trait_key=? OR instr(IFNULL(key_aliases, ''), ?) > 0)"
+                    params.extend([trait_key, f"|{trait_key}|"])
                 else: # 對於沒有key的類型，用value來比對
                     query += " AND trait_value=?"
                     params.append(trait_value)
@@ -541,6 +600,32 @@ class DatabaseManager:
             logging.error(f"Error finding characteristic for user '{user_id}': {e}", exc_info=True)
             return None
 
+    def add_characteristic_key_alias(self, trait_id: str, alias: str):
+        """為特徵加上另一個 trait_key 別名 (之後以別名查詢也會找到同一筆)"""
+        try:
+            with self._get_connection() as conn:
+                c = conn.cursor()
+                c.execute('''UPDATE individual_characteristics
+                             SET key_aliases = CASE WHEN IFNULL(key_aliases, '') = '' THEN ? ELSE key_aliases || ? END
+                             WHERE trait_id=? AND trait_key != ? AND instr(IFNULL(key_aliases, ''), ?) = 0''',
+                          (f"|{alias}|", f"{alias}|", trait_id, alias, f"|{alias}|"))
+                conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to add key alias '{alias}' to characteristic '{trait_id}': {e}")
+
+    def get_characteristic(self, trait_id: str) -> Optional[Dict]:
+        """以 trait_id 取得單一特徵"""
+        try:
+            with self._get_connection() as conn:
+                conn.row_factory = sqlite3.Row
+                c = conn.cursor()
+                c.execute("SELECT * FROM individual_characteristics WHERE trait_id=?", (trait_id,))
+                row = c.fetchone()
+                return dict(row) if row else None
+        except sqlite3.Error as e:
+            logging.error(f"Error getting characteristic '{trait_id}': {e}", exc_info=True)
+            return None
+
     def raw_insert_characteristic(self, data: Dict) -> Optional[str]:
         """底層的新增特徵方法"""
         trait_id = str(uuid.uuid4())
@@ -624,25 +709,311 @@ class DatabaseManager:
         except sqlite3.Error as e:
             logging.error(f"Failed to decay characteristic relevance for '{user_id}': {e}")
 
-    def remove_low_relevance_characteristics(self, user_id: str, relevance_threshold: float, unused_days_threshold: int):
-        """移除相關性過低且長時間未使用的特徵"""
+    def remove_low_relevance_characteristics(self, user_id: str, relevance_threshold: float, unused_days_threshold: int) -> List[str]:
+        """移除相關性過低且長時間未使用的特徵，返回被刪除的 trait_id"""
         now = time.time()
         unused_timestamp_threshold = now - (unused_days_threshold * 24 * 3600)
         try:
             with self._get_connection() as conn:
                 c = conn.cursor()
-                c.execute("""DELETE FROM individual_characteristics
+                c.execute("""SELECT trait_id FROM individual_characteristics
                              WHERE user_id = ?
                                AND relevance_score < ?
                                AND (last_accessed_timestamp IS NULL OR last_accessed_timestamp < ?)
                                AND (last_reinforced_timestamp IS NULL OR last_reinforced_timestamp < ?)""",
                           (user_id, relevance_threshold, unused_timestamp_threshold, unused_timestamp_threshold))
-                if c.rowcount > 0:
-                    logging.info(f"Removed {c.rowcount} low-relevance, old characteristics for user '{user_id}'.")
+                removed_ids = [row[0] for row in c.fetchall()]
+                c.executemany("DELETE FROM individual_characteristics WHERE trait_id = ?", [(trait_id,) for trait_id in removed_ids])
+                if removed_ids:
+                    logging.info(f"Removed {len(removed_ids)} low-relevance, old characteristics for user '{user_id}'.")
                 conn.commit()
+                return removed_ids
         except sqlite3.Error as e:
             logging.error(f"Failed to remove low-relevance characteristics for '{user_id}': {e}")
+            return []
+
+
+    # --- LLM 分析結果快取 ---
+    def load_analysis_cache_entry(self, cache_key: str, now: float) -> Optional[Dict]:
+        """讀取未過期的分析快取 ({'result_json', 'expires_at'})，並更新最後存取時間"""
+        try:
+            with self._get_connection() as conn:
+                c = conn.cursor()
+                c.execute("SELECT result_json, expires_at FROM llm_analysis_cache WHERE cache_key=? AND expires_at > ?", (cache_key, now))
+                row = c.fetchone()
+                if row:
+                    c.execute("UPDATE llm_analysis_cache SET last_accessed=? WHERE cache_key=?", (now, cache_key))
+                    conn.commit()
+                return {"result_json": row[0], "expires_at": float(row[1])} if row else None
+        except sqlite3.Error as e:
+            logging.error(f"Failed to load analysis cache entry: {e}")
+            return None
+
+    def save_analysis_cache_entry(self, cache_key: str, kind: str, result_json: str, created_at: float, expires_at: float):
+        """寫入或覆蓋一筆分析快取"""
+        try:
+            with self._get_connection() as conn:
+                c = conn.cursor()
+                c.execute('''INSERT OR REPLACE INTO llm_analysis_cache
+                             (cache_key, kind, result_json, created_at, expires_at, last_accessed)
+                             VALUES (?, ?, ?, ?, ?, ?)''',
+                          (cache_key, kind, result_json, created_at, expires_at, created_at))
+                conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to save analysis cache entry: {e}")
+
+    def prune_analysis_cache(self, max_entries: int, now: float) -> int:
+        """刪除過期的快取，並只保留最近存取的 max_entries 筆，返回刪除筆數"""
+        try:
+            with self._get_connection() as conn:
+                c = conn.cursor()
+                c.execute("DELETE FROM llm_analysis_cache WHERE expires_at <= ?", (now,))
+                removed = c.rowcount
+                c.execute('''DELETE FROM llm_analysis_cache WHERE cache_key IN (
+                                 SELECT cache_key FROM llm_analysis_cache
+                                 ORDER BY last_accessed DESC LIMIT -1 OFFSET ?)''', (max_entries,))
+                removed += c.rowcount
+                conn.commit()
+                return removed
+        except sqlite3.Error as e:
+            logging.error(f"Failed to prune analysis cache: {e}")
+            return 0
+
+    # --- 文字向量快取 ---
+    def load_embeddings(self, cache_keys: List[str], now: float) -> Dict[str, bytes]:
+        """批次讀取向量快取 ({cache_key: 向量位元組})，並更新最後存取時間"""
+        if not cache_keys:
+            return {}
+        found: Dict[str, bytes] = {}
+        try:
+            with self._get_connection() as conn:
+                c = conn.cursor()
+                for start in range(0, len(cache_keys), 500):  # SQLite 參數數量上限
+                    batch = cache_keys[start:start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    c.execute(f"SELECT cache_key, vector FROM embedding_cache WHERE cache_key IN ({placeholders})", batch)
+                    found.update({row[0]: bytes(row[1]) for row in c.fetchall()})
+                if found:
+                    c.executemany("UPDATE embedding_cache SET last_accessed=? WHERE cache_key=?", [(now, key) for key in found])
+                    conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to load embeddings from cache: {e}")
+        return found
+
+    def save_embeddings(self, rows: List[tuple], now: float):
+        """批次寫入向量快取，rows 為 (cache_key, model_id, 向量位元組)"""
+        if not rows:
+            return
+        try:
+            with self._get_connection() as conn:
+                conn.executemany('''INSERT OR REPLACE INTO embedding_cache
+                                    (cache_key, model_id, vector, created_at, last_accessed) VALUES (?, ?, ?, ?, ?)''',
+                                 [(key, model_id, sqlite3.Binary(blob), now, now) for key, model_id, blob in rows])
+                conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to save embeddings to cache: {e}")
+
+    def prune_embedding_cache(self, max_entries: int) -> int:
+        """只保留最近存取的 max_entries 筆向量，返回刪除筆數"""
+        try:
+            with self._get_connection() as conn:
+                c = conn.cursor()
+                c.execute('''DELETE FROM embedding_cache WHERE cache_key IN (
+                                 SELECT cache_key FROM embedding_cache
+                                 ORDER BY last_accessed DESC LIMIT -1 OFFSET ?)''', (max_entries,))
+                conn.commit()
+                return c.rowcount
+        except sqlite3.Error as e:
+            logging.error(f"Failed to prune embedding cache: {e}")
+            return 0
+
+    # --- 搜尋結果快取 ---
+    def load_search_cache_entry(self, cache_key: str, min_expires_at: float) -> Optional[Dict]:
+        """讀取 expires_at 晚於 min_expires_at 的搜尋快取 (可能已過期但仍在寬限期內)，並更新最後存取時間"""
+        try:
+            with self._get_connection() as conn:
+                conn.row_factory = sqlite3.Row
+                c = conn.cursor()
+                c.execute('''SELECT cache_key, query, num, lr, query_class, result_json, expires_at
+                             FROM search_cache WHERE cache_key=? AND expires_at > ?''', (cache_key, min_expires_at))
+                row = c.fetchone()
+                if row:
+                    c.execute("UPDATE search_cache SET last_accessed=? WHERE cache_key=?", (time.time(), cache_key))
+                    conn.commit()
+                return dict(row) if row else None
+        except sqlite3.Error as e:
+            logging.error(f"Failed to load search cache entry: {e}")
+            return None
+
+    def load_recent_search_cache_entries(self, min_expires_at: float, limit: int) -> List[Dict]:
+        """依最後存取時間由新到舊讀取搜尋快取 (用於預熱程序內快取)"""
+        try:
+            with self._get_connection() as conn:
+                conn.row_factory = sqlite3.Row
+                c = conn.cursor()
+                c.execute('''SELECT cache_key, query, num, lr, query_class, result_json, created_at, expires_at
+                             FROM search_cache WHERE expires_at > ? ORDER BY last_accessed DESC LIMIT ?''',
+                          (min_expires_at, limit))
+                return [dict(row) for row in c.fetchall()]
+        except sqlite3.Error as e:
+            logging.error(f"Failed to load recent search cache entries: {e}")
+            return []
+
+    def save_search_cache_entry(self, cache_key: str, query: str, num: int, lr: str, query_class: str,
+                                result_json: str, created_at: float, expires_at: float):
+        """寫入或覆蓋一筆搜尋快取"""
+        try:
+            with self._get_connection() as conn:
+                conn.execute('''INSERT OR REPLACE INTO search_cache
+                                (cache_key, query, num, lr, query_class, result_json, created_at, expires_at, last_accessed)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                             (cache_key, query, num, lr, query_class, result_json, created_at, expires_at, created_at))
+                conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to save search cache entry: {e}")
+
+    def prune_search_cache(self, max_entries: int, expired_before: float) -> int:
+        """刪除在 expired_before 之前就已過期的快取，並只保留最近存取的 max_entries 筆，返回刪除筆數"""
+        try:
+            with self._get_connection() as conn:
+                c = conn.cursor()
+                c.execute("DELETE FROM search_cache WHERE expires_at <= ?", (expired_before,))
+                removed = c.rowcount
+                c.execute('''DELETE FROM search_cache WHERE cache_key IN (
+                                 SELECT cache_key FROM search_cache
+                                 ORDER BY last_accessed DESC LIMIT -1 OFFSET ?)''', (max_entries,))
+                removed += c.rowcount
+                conn.commit()
+                return removed
+        except sqlite3.Error as e:
+            logging.error(f"Failed to prune search cache: {e}")
+            return 0
+
+    # --- 閒置時預先搜尋的結果 ---
+    def load_search_prefetch_entries(self) -> List[Dict]:
+        """讀取所有預取結果 ({'topic', 'query', 'results_json', 'fetched_at'})"""
+        try:
+            with self._get_connection() as conn:
+                conn.row_factory = sqlite3.Row
+                c = conn.cursor()
+                c.execute("SELECT topic, query, results_json, fetched_at FROM search_prefetch")
+                return [dict(row) for row in c.fetchall()]
+        except sqlite3.Error as e:
+            logging.error(f"Failed to load search prefetch entries: {e}")
+            return []
+
+    def save_search_prefetch_entry(self, topic: str, query: str, results_json: str, fetched_at: float):
+        """寫入或覆蓋一個主題的預取結果"""
+        try:
+            with self._get_connection() as conn:
+                conn.execute('''INSERT OR REPLACE INTO search_prefetch (topic, query, results_json, fetched_at)
+                                VALUES (?, ?, ?, ?)''', (topic, query, results_json, fetched_at))
+                conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to save search prefetch entry: {e}")
 
+    # --- 本地知識庫 (FTS5) ---
+    def has_knowledge_index(self) -> bool:
+        """全文索引表是否存在 (SQLite 未編譯 FTS5 時不存在)"""
+        try:
+            with self._get_connection() as conn:
+                c = conn.cursor()
+                c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='knowledge_fts'")
+                return c.fetchone() is not None
+        except sqlite3.Error as e:
+            logging.error(f"Failed to check knowledge index: {e}")
+            return False
+
+    def upsert_knowledge_documents(self, docs: List[Dict[str, Any]]) -> int:
+        """
+        以 doc_key 新增或更新文件並同步全文索引，返回寫入筆數。
+        每筆包含 doc_key、source、title、body、link、updated_at、title_terms、body_terms。
+        """
+        if not docs:
+            return 0
+        try:
+            with self._get_connection() as conn:
+                c = conn.cursor()
+                for doc in docs:
+                    c.execute("SELECT doc_id FROM knowledge_documents WHERE doc_key=?", (doc["doc_key"],))
+                    row = c.fetchone()
+                    if row:
+                        doc_id = row[0]
+                        c.execute('''UPDATE knowledge_documents SET source=?, title=?, body=?, link=?, updated_at=?
+                                     WHERE doc_id=?''',
+                                  (doc["source"], doc["title"], doc["body"], doc.get("link"), doc["updated_at"], doc_id))
+                        c.execute("DELETE FROM knowledge_fts WHERE rowid=?", (doc_id,))
+                    else:
+                        c.execute('''INSERT INTO knowledge_documents (doc_key, source, title, body, link, updated_at)
+                                     VALUES (?, ?, ?, ?, ?, ?)''',
+                                  (doc["doc_key"], doc["source"], doc["title"], doc["body"], doc.get("link"), doc["updated_at"]))
+                        doc_id = c.lastrowid
+                    c.execute("INSERT INTO knowledge_fts (rowid, title_terms, body_terms) VALUES (?, ?, ?)",
+                              (doc_id, doc["title_terms"], doc["body_terms"]))
+                conn.commit()
+                return len(docs)
+        except sqlite3.Error as e:
+            logging.error(f"Failed to upsert knowledge documents: {e}")
+            return 0
+
+    def load_knowledge_document_versions(self, source: str) -> Dict[str, float]:
+        """某來源所有文件的 {doc_key: updated_at}，用於判斷是否需要重新索引"""
+        try:
+            with self._get_connection() as conn:
+                c = conn.cursor()
+                c.execute("SELECT doc_key, updated_at FROM knowledge_documents WHERE source=?", (source,))
+                return {row[0]: float(row[1] or 0) for row in c.fetchall()}
+        except sqlite3.Error as e:
+            logging.error(f"Failed to load knowledge document versions: {e}")
+            return {}
+
+    def search_knowledge_documents(self, match_expression: str, limit: int, title_weight: float = 2.0) -> List[Dict]:
+        """以 FTS5 MATCH 搜尋並依 bm25 排序 (分數越小越相關)"""
+        try:
+            with self._get_connection() as conn:
+                conn.row_factory = sqlite3.Row
+                c = conn.cursor()
+                c.execute('''SELECT d.doc_key, d.source, d.title, d.body, d.link, d.updated_at,
+                                    f.title_terms, f.body_terms, bm25(knowledge_fts, ?, 1.0) AS score
+                             FROM knowledge_fts f JOIN knowledge_documents d ON d.doc_id = f.rowid
+                             WHERE knowledge_fts MATCH ? ORDER BY score LIMIT ?''',
+                          (title_weight, match_expression, limit))
+                return [dict(row) for row in c.fetchall()]
+        except sqlite3.Error as e:
+            logging.error(f"Failed to search knowledge documents: {e}")
+            return []
+
+    def prune_knowledge_documents(self, source: str, max_entries: int, older_than: float) -> int:
+        """刪除某來源中 updated_at 早於 older_than 的文件，並只保留最新的 max_entries 筆 (同步刪除全文索引)，返回刪除筆數"""
+        try:
+            with self._get_connection() as conn:
+                c = conn.cursor()
+                c.execute("SELECT doc_id FROM knowledge_documents WHERE source=? AND updated_at < ?", (source, older_than))
+                doc_ids = {row[0] for row in c.fetchall()}
+                c.execute('''SELECT doc_id FROM knowledge_documents WHERE source=?
+                             ORDER BY updated_at DESC LIMIT -1 OFFSET ?''', (source, max_entries))
+                doc_ids.update(row[0] for row in c.fetchall())
+                if not doc_ids:
+                    return 0
+                params = [(doc_id,) for doc_id in doc_ids]
+                c.executemany("DELETE FROM knowledge_fts WHERE rowid=?", params)
+                c.executemany("DELETE FROM knowledge_documents WHERE doc_id=?", params)
+                conn.commit()
+                return len(doc_ids)
+        except sqlite3.Error as e:
+            logging.error(f"Failed to prune knowledge documents: {e}")
+            return 0
+
+    def count_knowledge_documents(self) -> Dict[str, int]:
+        """各來源的文件數"""
+        try:
+            with self._get_connection() as conn:
+                c = conn.cursor()
+                c.execute("SELECT source, COUNT(*) FROM knowledge_documents GROUP BY source")
+                return {row[0]: row[1] for row in c.fetchall()}
+        except sqlite3.Error as e:
+            logging.error(f"Failed to count knowledge documents: {e}")
+            return {}
 
     # --- 任務管理 ---
     def add_task(self, user_id: str, description: str, due_at: Optional[float] = None) -> Dict[str, Any]:
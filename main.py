@@ -3,10 +3,18 @@ import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
 import logging
 import os
+from typing import Optional, Tuple
 import config
+from services.lazy_loading import startup_timer
 from database import DatabaseManager
-from services.llm_service import GeminiService
-from services.search_service import GoogleSearchService
+from services.llm_service import build_llm_service
+from services.async_search_service import AsyncGoogleSearchService
+from services.search_cache import CachedSearchService
+from services.local_knowledge_service import LocalKnowledgeSearchService, LocalFirstSearchService
+from services.rate_limiter import RateLimiter
+from services.worker_pool import worker_pools
+from services.embedding_service import build_embedding_service
+from services.offline_services import MODE_LIVE, LatencyModel, build_offline_services
 from core.pet_logic import PetLogic
 from ui.main_window import MainWindow
 
@@ -47,51 +55,106 @@ def ensure_assets_exist():
         except Exception as e:
             logging.error(f"Error handling missing default image: {e}")
 
-def main():
-    """應用程式的主入口點，負責組裝所有元件。"""
-    setup_logging()
-    ensure_assets_exist()
-
-    root = tk.Tk()
-    root.withdraw()
-
-    try:
-        db_manager = DatabaseManager(config.DB_PATH)
-    except Exception as e:
-        logging.critical(f"FATAL: Failed to initialize DatabaseManager: {e}", exc_info=True)
-        messagebox.showerror("嚴重錯誤", f"無法初始化資料庫，應用程式無法啟動。\n錯誤: {e}")
-        root.destroy()
-        return
-
+def build_services(db_manager: DatabaseManager) -> Tuple[Optional[object], object, object, Optional[str]]:
+    """
+    建構 LLM、搜尋與向量服務 (在背景執行緒中呼叫，SDK 也在這裡才真正載入)。
+    返回 (llm_service, search_service, embedding_service, llm_error)；LLM 初始化失敗時 llm_error 為錯誤訊息。
+    """
     gemini_api_key = db_manager.get_api_key('gemini_api_key')
     search_api_key = db_manager.get_api_key('custom_search_api_key')
     search_cx_id = db_manager.get_api_key('custom_search_cx_id')
 
-    llm_service = None
+    # LLM 與搜尋共用同一個速率限制器，每日計數存於資料庫
+    rate_limiter = RateLimiter(db_manager)
+
+    llm_service, llm_error = None, None
     if gemini_api_key:
         try:
             model_name = db_manager.load_app_setting(
                 config.SETTING_SELECTED_LLM,
                 config.DEFAULT_APP_SETTINGS[config.SETTING_SELECTED_LLM]
             )
-            llm_service = GeminiService(api_key=gemini_api_key, model_name=model_name)
+            with startup_timer.phase("llm service"):
+                llm_service = build_llm_service(db_manager, api_key=gemini_api_key, model_name=model_name,
+                                                rate_limiter=rate_limiter)
         except Exception as e:
             logging.error(f"Failed to initialize GeminiService on startup: {e}", exc_info=True)
-            messagebox.showwarning("LLM 警告", f"啟動時初始化 Gemini 模型失敗：{e}\n將以有限模式啟動，請檢查設定。")
-            llm_service = None
+            llm_service, llm_error = None, str(e)
+
+    search_service = AsyncGoogleSearchService(api_key=search_api_key, cx_id=search_cx_id, rate_limiter=rate_limiter)
+    if config.BACKEND_MODE == MODE_LIVE:
+        search_service.warm_up()  # 以內附的 discovery 文件建立客戶端，不需連網
+
+    if config.BACKEND_MODE != MODE_LIVE:
+        # 離線後端：錄製、重播或合成回應 (見 services/offline_services.py)
+        model_name = db_manager.load_app_setting(
+            config.SETTING_SELECTED_LLM, config.DEFAULT_APP_SETTINGS[config.SETTING_SELECTED_LLM]
+        )
+        latency = LatencyModel(fixed_ms=float(config.REPLAY_LATENCY_MS)) if config.REPLAY_LATENCY_MS else LatencyModel()
+        llm_service, search_service = build_offline_services(
+            config.BACKEND_MODE, db_manager, model_name, config.CASSETTE_DIR, api_key=gemini_api_key,
+            live_search=search_service, latency=latency, rate_limiter=rate_limiter
+        )
+        logging.warning(f"Running with offline '{config.BACKEND_MODE}' backends (cassettes: {config.CASSETTE_DIR}).")
+
+    # 搜尋結果快取：相同或近似的查詢不重複消耗每日配額
+    search_service = CachedSearchService(search_service, db_manager, rate_limiter=rate_limiter)
+    # 先查本地知識庫 (FTS5)，沒有命中才使用網路搜尋
+    search_service = LocalFirstSearchService(LocalKnowledgeSearchService(db_manager), search_service)
+
+    # 離線後端模式下不呼叫向量 API
+    with startup_timer.phase("embedding service"):
+        embedding_service = build_embedding_service(
+            db_manager, api_key=gemini_api_key if config.BACKEND_MODE == MODE_LIVE else None, rate_limiter=rate_limiter
+        )
+    return llm_service, search_service, embedding_service, llm_error
+
+def start_services_in_background(root: tk.Tk, db_manager: DatabaseManager, pet_logic: PetLogic, app_ui: MainWindow):
+    """視窗顯示後才建構服務，完成後接上 PetLogic 並通知 UI"""
+    def worker():
+        try:
+            with startup_timer.phase("services"):
+                llm_service, search_service, embedding_service, llm_error = build_services(db_manager)
+        except Exception as e:
+            logging.error(f"Failed to build services on startup: {e}", exc_info=True)
+            llm_service, search_service, embedding_service, llm_error = None, None, None, str(e)
+        pet_logic.attach_services(llm_service, search_service, embedding_service)
+        startup_timer.mark("services ready")
+        logging.info(f"Startup timing: {startup_timer.format_report()}")
 
-    search_service = GoogleSearchService(api_key=search_api_key, cx_id=search_cx_id)
+        # 服務就緒後，觸發一次性的個性化搜尋
+        pet_logic.initial_personality_setup_async()
+        root.after(0, app_ui.on_services_ready, llm_error)
 
-    pet_logic = PetLogic(
-        db_manager=db_manager,
-        llm_service=llm_service,
-        search_service=search_service
-    )
+    worker_pools.dispatch("maintenance", worker)
+
+def main():
+    """
+    應用程式的主入口點，負責組裝所有元件。
+    視窗先以資料庫中的狀態顯示出來，LLM/搜尋/向量服務 (以及它們的 SDK) 在背景建構後再接上。
+    """
+    setup_logging()
+    ensure_assets_exist()
+
+    root = tk.Tk()
+    root.withdraw()
 
-    # --- *** 新增的觸發點 *** ---
-    # 在 PetLogic 初始化後，立即觸發一次性的個性化搜尋
-    pet_logic.initial_personality_setup_async()
-    # --- *** 觸發點結束 *** ---
+    try:
+        with startup_timer.phase("database"):
+            db_manager = DatabaseManager(config.DB_PATH)
+    except Exception as e:
+        logging.critical(f"FATAL: Failed to initialize DatabaseManager: {e}", exc_info=True)
+        messagebox.showerror("嚴重錯誤", f"無法初始化資料庫，應用程式無法啟動。\n錯誤: {e}")
+        root.destroy()
+        return
+
+    with startup_timer.phase("pet logic"):
+        pet_logic = PetLogic(
+            db_manager=db_manager,
+            llm_service=None,
+            search_service=None,
+            services_pending=True
+        )
 
     style = ttk.Style(root)
     available_themes = style.theme_names()
@@ -100,9 +163,14 @@ def main():
     else:
         if available_themes: style.theme_use(available_themes[0])
 
-    app_ui = MainWindow(root, pet_logic)
+    with startup_timer.phase("main window"):
+        app_ui = MainWindow(root, pet_logic)
     
     root.deiconify()
+    root.update_idletasks()
+    startup_timer.mark("window shown")
+
+    start_services_in_background(root, db_manager, pet_logic, app_ui)
 
     logging.info("Application startup successful. Entering main loop.")
     root.mainloop()
@@ -0,0 +1,113 @@
+# services/analysis_cache.py
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+import config
+from database import DatabaseManager
+
+
+def normalize_analysis_text(text: str) -> str:
+    """正規化待分析文字：全半形統一、轉小寫、合併空白"""
+    text = unicodedata.normalize("NFKC", str(text or "")).lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class AnalysisCache:
+    """
+    LLM 分析結果的兩層快取：程序內 LRU (L1) + SQLite (L2)。
+
+    鍵由分析種類、模型名稱、提示版本與正規化後的文字組成；
+    提示或模型改變時舊的結果自然失效。每筆資料都有 TTL，
+    L1 以容量淘汰最久未用的項目，L2 在寫入時定期修剪。
+    """
+
+    def __init__(self, db_manager: Optional[DatabaseManager],
+                 ttl_seconds: float = config.ANALYSIS_CACHE_TTL_SECONDS,
+                 memory_entries: int = config.ANALYSIS_CACHE_MEMORY_ENTRIES,
+                 max_db_entries: int = config.ANALYSIS_CACHE_MAX_DB_ENTRIES):
+        self.db = db_manager
+        self.ttl_seconds = ttl_seconds
+        self.memory_entries = memory_entries
+        self.max_db_entries = max_db_entries
+        self._lru: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes_since_prune = 0
+        self.stats = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(kind: str, text: str, model_name: str, prompt_version: str) -> str:
+        raw = "\x1f".join([kind, model_name, prompt_version, normalize_analysis_text(text)])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, kind: str, text: str, model_name: str, prompt_version: str) -> Optional[Dict[str, Any]]:
+        key = self.make_key(kind, text, model_name, prompt_version)
+        now = time.time()
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._lru.move_to_end(key)
+                    self.stats["l1_hits"] += 1
+                    return dict(value)
+                del self._lru[key]
+
+        if self.db:
+            row = self.db.load_analysis_cache_entry(key, now)
+            if row:
+                try:
+                    value = json.loads(row["result_json"])
+                    self._remember(key, value, row["expires_at"])
+                    with self._lock:
+                        self.stats["l2_hits"] += 1
+                    return dict(value)
+                except json.JSONDecodeError:
+                    logging.warning("AnalysisCache: corrupted L2 entry ignored.")
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, kind: str, text: str, model_name: str, prompt_version: str, value: Dict[str, Any]):
+        if not value:
+            return  # 不快取空結果 (通常代表 API 錯誤)
+        key = self.make_key(kind, text, model_name, prompt_version)
+        now = time.time()
+        expires_at = now + self.ttl_seconds
+        self._remember(key, value, expires_at)
+        with self._lock:
+            self.stats["stores"] += 1
+            self._writes_since_prune += 1
+            should_prune = self._writes_since_prune >= 100
+            if should_prune:
+                self._writes_since_prune = 0
+        if self.db:
+            self.db.save_analysis_cache_entry(key, kind, json.dumps(value, ensure_ascii=False), now, expires_at)
+            if should_prune:
+                removed = self.db.prune_analysis_cache(self.max_db_entries, now)
+                if removed:
+                    logging.info(f"AnalysisCache: pruned {removed} expired/overflow entries from SQLite.")
+
+    def _remember(self, key: str, value: Dict[str, Any], expires_at: float):
+        with self._lock:
+            self._lru[key] = (expires_at, dict(value))
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.memory_entries:
+                self._lru.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """返回命中/未命中統計與命中率"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["l1_size"] = len(self._lru)
+        lookups = stats["l1_hits"] + stats["l2_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["l1_hits"] + stats["l2_hits"]) / lookups, 3) if lookups else 0.0
+        return stats
@@ -0,0 +1,133 @@
+# services/async_llm_service.py
+import asyncio
+import logging
+import threading
+from typing import Dict, Any, Optional, Callable
+
+import config
+from services import async_runtime
+from services.analysis_cache import AnalysisCache
+from services.llm_service import GeminiService
+from services.llm_scheduler import LLMScheduler
+from services.rate_limiter import RateLimiter
+from services.resilience import CircuitBreaker, is_retryable_error, backoff_delay
+
+
+class AsyncGeminiService(GeminiService):
+    """
+    以 asyncio 實作傳輸層的 Gemini 服務。
+
+    每個請求在共用事件迴圈 (services.async_runtime) 上執行，具備：
+    - 每次呼叫的總期限 (含所有重試)；
+    - 可重試錯誤 (429、5xx、連線中斷) 的指數退避與完整抖動；
+    - 服務中斷時快速失敗的斷路器；
+    - 所有後端共用的全域同時請求上限 (async_runtime.llm_semaphore()，退避等待期間會釋放名額)。
+
+    同步的 LLMService 介面 (generate_content 等) 保持不變：
+    _invoke_model 是執行緒安全的阻塞外觀，既有的背景執行緒呼叫端不需修改。
+    """
+
+    def __init__(self, api_key: str, model_name: str, analysis_cache: Optional[AnalysisCache] = None,
+                 scheduler: Optional[LLMScheduler] = None,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 max_retries: int = config.LLM_MAX_RETRIES,
+                 base_delay: float = config.LLM_RETRY_BASE_DELAY_SECONDS,
+                 max_delay: float = config.LLM_RETRY_MAX_DELAY_SECONDS):
+        super().__init__(api_key=api_key, model_name=model_name, analysis_cache=analysis_cache, scheduler=scheduler,
+                         rate_limiter=rate_limiter)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.circuit_breaker = CircuitBreaker(
+            "gemini", failure_threshold=config.LLM_CIRCUIT_FAILURE_THRESHOLD,
+            reset_timeout=config.LLM_CIRCUIT_RESET_SECONDS
+        )
+        self._stats_lock = threading.Lock()
+        self.call_stats = {"calls": 0, "succeeded": 0, "retries": 0, "timeouts": 0, "failed": 0, "rejected": 0}
+
+    def _invoke_model(self, model, contents: Any, timeout: Optional[float] = None,
+                      on_chunk: Optional[Callable[[str], None]] = None, **kwargs):
+        """阻塞外觀：把請求交給事件迴圈並等待結果"""
+        timeout = timeout or config.LLM_CALL_TIMEOUT_SECONDS
+        # 外層等待多留一點時間，讓協程自己的期限先觸發並回報正確的錯誤
+        return async_runtime.run_blocking(
+            self.call_model_async(model, contents, timeout=timeout, on_chunk=on_chunk, **kwargs),
+            timeout=timeout + 5.0
+        )
+
+    async def call_model_async(self, model, contents: Any, timeout: float,
+                               on_chunk: Optional[Callable[[str], None]] = None, **kwargs):
+        """
+        非同步送出一次模型請求 (含重試)。必須在共用事件迴圈中執行。
+        串流請求一旦已經回呼過文字就不再重試，以免重複輸出。
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self._bump("calls")
+        try:
+            self.circuit_breaker.before_call()
+        except Exception:
+            self._bump("rejected")
+            raise
+
+        delivered = {"any": False}
+
+        def forward_chunk(chunk_text: str):
+            delivered["any"] = True
+            on_chunk(chunk_text)
+
+        attempt = 0
+        while True:
+            remaining = deadline - loop.time()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                async with async_runtime.llm_semaphore():
+                    response = await asyncio.wait_for(
+                        self._attempt_async(model, contents, forward_chunk if on_chunk else None, kwargs),
+                        timeout=remaining
+                    )
+                self.circuit_breaker.record_success()
+                self._bump("succeeded")
+                return response
+            except Exception as e:
+                timed_out = isinstance(e, asyncio.TimeoutError)
+                if not is_retryable_error(e):
+                    # 參數錯誤、內容被阻擋等不代表服務中斷，不計入斷路器
+                    self.circuit_breaker.release_trial()
+                    self._bump("failed")
+                    raise
+                delay = backoff_delay(attempt, self.base_delay, self.max_delay)
+                can_retry = (not timed_out and not delivered["any"] and attempt < self.max_retries
+                             and loop.time() + delay < deadline)
+                if not can_retry:
+                    self.circuit_breaker.record_failure()
+                    self._bump("timeouts" if timed_out else "failed")
+                    if timed_out:
+                        raise asyncio.TimeoutError(f"LLM call exceeded its {timeout:.1f}s deadline.") from e
+                    raise
+                attempt += 1
+                self._bump("retries")
+                logging.warning(f"LLM call failed with retryable error ({type(e).__name__}: {e}); "
+                                f"retry {attempt}/{self.max_retries} in {delay:.2f}s.")
+                await asyncio.sleep(delay)
+
+    async def _attempt_async(self, model, contents: Any, on_chunk: Optional[Callable[[str], None]], kwargs: Dict[str, Any]):
+        response = await model.generate_content_async(contents, stream=bool(on_chunk), **kwargs)
+        if on_chunk:
+            async for chunk in response:
+                chunk_text = self._chunk_text(chunk)
+                if chunk_text:
+                    on_chunk(chunk_text)
+        return response
+
+    def _bump(self, key: str):
+        with self._stats_lock:
+            self.call_stats[key] += 1
+
+    def get_reliability_stats(self) -> Dict[str, Any]:
+        """返回呼叫次數、重試、逾時與斷路器狀態，用於除錯報告"""
+        with self._stats_lock:
+            stats = dict(self.call_stats)
+        stats["circuit"] = self.circuit_breaker.get_stats()
+        return stats
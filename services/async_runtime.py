@@ -0,0 +1,80 @@
+# services/async_runtime.py
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from typing import Any, Awaitable, Optional
+
+import config
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
+# 所有 LLM 後端共用的同時請求上限；只在事件迴圈執行緒中存取，迴圈重新建立時一併重建
+_llm_semaphore: Optional[asyncio.Semaphore] = None
+_llm_semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """取得 (必要時啟動) 在背景常駐執行緒中運行的共用事件迴圈"""
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_run_loop, args=(_loop,), name="AsyncRuntimeLoop", daemon=True)
+            _loop_thread.start()
+            logging.info("Async runtime event loop started.")
+        return _loop
+
+
+def _run_loop(loop: asyncio.AbstractEventLoop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def in_loop_thread() -> bool:
+    return _loop_thread is not None and threading.current_thread() is _loop_thread
+
+
+def llm_semaphore() -> asyncio.Semaphore:
+    """
+    全域的 LLM 同時請求上限 (LLM_MAX_CONCURRENT_CALLS)。
+    路由服務下的每個後端、以及對沖請求的兩個分支都共用這一個名額池。必須在共用事件迴圈中呼叫。
+    """
+    global _llm_semaphore, _llm_semaphore_loop
+    loop = asyncio.get_running_loop()
+    if _llm_semaphore is None or _llm_semaphore_loop is not loop:
+        _llm_semaphore = asyncio.Semaphore(config.LLM_MAX_CONCURRENT_CALLS)
+        _llm_semaphore_loop = loop
+    return _llm_semaphore
+
+
+def run_blocking(coro: Awaitable[Any], timeout: Optional[float] = None) -> Any:
+    """
+    從任意一般執行緒提交協程到共用事件迴圈，並阻塞等待結果 (執行緒安全)。
+    不可在事件迴圈執行緒本身呼叫，否則會自我死結。
+    """
+    if in_loop_thread():
+        raise RuntimeError("run_blocking() cannot be called from the async runtime loop thread.")
+    future = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+    try:
+        return future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
+def shutdown(timeout: float = 2.0):
+    """停止共用事件迴圈 (應用程式關閉時呼叫)"""
+    global _loop, _loop_thread
+    with _loop_lock:
+        loop, thread = _loop, _loop_thread
+        _loop, _loop_thread = None, None
+    if loop is None:
+        return
+    loop.call_soon_threadsafe(loop.stop)
+    if thread is not None:
+        thread.join(timeout)
+    if not loop.is_running():
+        loop.close()
+    logging.info("Async runtime event loop stopped.")
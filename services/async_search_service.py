@@ -0,0 +1,67 @@
+# services/async_search_service.py
+import asyncio
+import logging
+from typing import Dict, Any, Optional, List
+
+import config
+from services import async_runtime
+from services.llm_scheduler import current_priority, request_priority
+from services.rate_limiter import RateLimiter
+from services.search_service import GoogleSearchService
+from services.worker_pool import worker_pools
+
+
+class AsyncGoogleSearchService(GoogleSearchService):
+    """
+    可並行搜尋的 Google 搜尋服務。
+
+    googleapiclient 的 execute() 會阻塞，因此 search_async 把單次搜尋交給 search_io 工作池，
+    並在共用事件迴圈 (services.async_runtime) 上以 semaphore 限制同時進行的請求數。
+    每次搜尋仍經過 search()：RateLimiter 的每分鐘限制與每日配額照常生效，
+    呼叫端的優先等級 (interactive / learning ...) 也會帶到執行緒池中。
+    """
+
+    def __init__(self, api_key: Optional[str], cx_id: Optional[str], rate_limiter: Optional[RateLimiter] = None,
+                 max_concurrent: int = config.SEARCH_MAX_CONCURRENT_REQUESTS):
+        super().__init__(api_key=api_key, cx_id=cx_id, rate_limiter=rate_limiter)
+        self.max_concurrent = max(1, max_concurrent)
+        self._executor = worker_pools.get("search_io")  # semaphore 已限制同時數，池的大小見 config.WORKER_POOLS
+        self._semaphore: Optional[asyncio.Semaphore] = None  # 需在事件迴圈中建立
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphore
+
+    def _search_with_priority(self, query: str, num_results: int, priority: str) -> Dict[str, Any]:
+        with request_priority(priority):
+            return self.search(query, num_results=num_results)
+
+    async def search_async(self, query: str, num_results: int = 3, priority: Optional[str] = None) -> Dict[str, Any]:
+        """在事件迴圈中執行一次搜尋 (不阻塞迴圈)"""
+        priority = priority or current_priority()
+        async with self._get_semaphore():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self._search_with_priority, query, num_results, priority)
+
+    async def search_many_async(self, queries: List[str], num_results: int = 3,
+                                priority: Optional[str] = None) -> List[Dict[str, Any]]:
+        priority = priority or current_priority()
+        unique = list(dict.fromkeys(queries))
+        outcomes = await asyncio.gather(*(self.search_async(query, num_results, priority) for query in unique),
+                                        return_exceptions=True)
+        by_query: Dict[str, Dict[str, Any]] = {}
+        for query, outcome in zip(unique, outcomes):
+            if isinstance(outcome, BaseException):
+                logging.error(f"Parallel search for '{query}' failed: {outcome}", exc_info=outcome)
+                outcome = {"error": f"未知的搜尋錯誤: {outcome}"}
+            by_query[query] = outcome
+        return [dict(by_query[query]) for query in queries]
+
+    def search_many(self, queries: List[str], num_results: int = 3) -> List[Dict[str, Any]]:
+        """並行搜尋多個查詢 (最多 max_concurrent 個同時進行)，返回與輸入同順序的結果"""
+        if not queries:
+            return []
+        if len(queries) == 1 or async_runtime.in_loop_thread():
+            return super().search_many(queries, num_results=num_results)
+        return async_runtime.run_blocking(self.search_many_async(queries, num_results, current_priority()))
@@ -1,6 +1,9 @@
 # services/base_services.py
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Callable
+
+import config
+from services.tool_loop import ToolExecutor, run_tool_loop
 
 class LLMService(ABC):
     """
@@ -15,12 +18,37 @@ class LLMService(ABC):
         
         Args:
             prompt_details: 一個包含 'contents', 'generation_config' 等鍵的字典。
+                可選的 'on_stream' (Callable[[str], None]) 會在串流時收到口頭回應的新增文字。
+                可選的 'priority' 指定排程等級 (interactive / proactive / learning / maintenance)。
+                可選的 'task' 為任務名稱 (見 services.llm_tasks)，決定使用的模型分級與預設生成參數；
+                未指定時視為一般對話。
+                可選的 'stable_prefix' ({'key': 內容雜湊, 'text': 前綴}) 標示第一則訊息開頭跨回合不變的部分，
+                服務可據此使用服務端的上下文快取。
         
         Returns:
             一個包含 'internal_thought', 'spoken_response', 'error' 等鍵的標準化字典。
+            結構化輸出時可另外包含 'user_emotions' 與 'appraisal' (單次呼叫回合模式)。
+            模型要求呼叫工具時改為返回 'tool_call_requests' (所有呼叫) 與 'messages_history_for_next_turn'。
         """
         pass
 
+    def generate_with_tools(self, prompt_details: Dict[str, Any], tools: Dict[str, Callable[..., Dict[str, Any]]],
+                            max_depth: int = config.LLM_TOOL_MAX_DEPTH,
+                            tool_timeouts: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+        """
+        生成內容並執行模型要求的工具，直到得到文字回答 (見 services/tool_loop.py)。
+
+        Args:
+            prompt_details: 同 generate_content；'tools' 為提供給模型的工具宣告。
+            tools: 工具名稱 -> 實作函式 (以關鍵字參數呼叫，返回字典)。
+            max_depth: 最多幾輪工具呼叫。
+            tool_timeouts: 個別工具的逾時覆寫 (秒)。
+
+        Returns:
+            與 generate_content 相同的字典，另附 'tool_calls' 執行紀錄與 'tool_rounds' 輪數。
+        """
+        return run_tool_loop(self, prompt_details, ToolExecutor(tools, timeouts=tool_timeouts), max_depth=max_depth)
+
     @abstractmethod
     def analyze_text_for_emotions(self, text: str) -> Dict[str, float]:
         """
@@ -47,6 +75,29 @@ class LLMService(ABC):
         """
         pass
 
+    def analyze_texts_for_emotions_batch(self, texts: List[str]) -> List[Dict[str, float]]:
+        """
+        批次分析多段文字的情緒，返回與輸入同順序的列表。
+        預設逐筆呼叫 analyze_text_for_emotions；服務可覆寫為單次打包的呼叫。
+        """
+        return [self.analyze_text_for_emotions(text) for text in texts]
+
+    def appraise_events_batch(self, event_texts: List[str]) -> List[Dict[str, float]]:
+        """
+        批次評價多個事件，返回與輸入同順序的列表。
+        預設逐筆呼叫 appraise_event；服務可覆寫為單次打包的呼叫。
+        """
+        return [self.appraise_event(text) for text in event_texts]
+
+    def count_tokens(self, contents: Any) -> Optional[int]:
+        """
+        (可選) 由服務端精確計算內容的 token 數。
+
+        Returns:
+            token 數；服務不支援或失敗時返回 None，呼叫端應改用本地估算。
+        """
+        return None
+
 
 class SearchService(ABC):
     """
@@ -74,4 +125,39 @@ class SearchService(ABC):
         """
         檢查服務是否已啟用 (例如，是否已設定 API 金鑰)。
         """
-        pass
\ No newline at end of file
+        pass
+
+    def search_many(self, queries: List[str], num_results: int = 3) -> List[Dict[str, Any]]:
+        """
+        搜尋多個查詢，返回與輸入同順序的結果列表。
+        預設逐筆呼叫 search；服務可覆寫為並行的實作。
+        """
+        return [self.search(query, num_results=num_results) for query in queries]
+
+
+class EmbeddingService(ABC):
+    """
+    文字向量 (embedding) 服務的抽象基礎類別。
+    用於記憶召回、特徵去重、主題分群等語意比對，不需要完整的生成呼叫。
+    """
+
+    @property
+    @abstractmethod
+    def model_id(self) -> str:
+        """
+        向量模型的識別字串 (含維度與版本)；不同 model_id 的向量不可互相比較，也用於快取鍵。
+        """
+        pass
+
+    @abstractmethod
+    def embed(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        批次計算多段文字的向量。
+
+        Args:
+            texts: 要計算向量的文字列表。
+
+        Returns:
+            與輸入同順序的向量列表；個別項目失敗時為 None。
+        """
+        pass
@@ -0,0 +1,212 @@
+# services/embedding_service.py
+import re
+import math
+import time
+import zlib
+import array
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import List, Optional, Dict
+
+import config
+from database import DatabaseManager
+from services.base_services import EmbeddingService
+from services.rate_limiter import RateLimiter
+from services.tokens import estimate_tokens
+from services.lazy_loading import LazyModule
+
+genai = LazyModule("google.generativeai")
+
+_CJK_RUN = re.compile(r"[぀-ヿ㐀-䶿一-鿿豈-﫿]+")
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    """兩個向量的餘弦相似度 (任一為零向量時返回 0)"""
+    dot = sum(x * y for x, y in zip(a, b))
+    norm_a = math.sqrt(sum(x * x for x in a))
+    norm_b = math.sqrt(sum(y * y for y in b))
+    if not norm_a or not norm_b:
+        return 0.0
+    return dot / (norm_a * norm_b)
+
+
+class GeminiEmbeddingService(EmbeddingService):
+    """使用 Gemini 向量模型 (embed_content) 的服務，每次請求最多送出 batch_size 段文字"""
+
+    def __init__(self, api_key: str, model_name: str = config.GEMINI_EMBEDDING_MODEL,
+                 batch_size: int = config.GEMINI_EMBEDDING_BATCH_SIZE,
+                 rate_limiter: Optional[RateLimiter] = None):
+        if not api_key:
+            raise ValueError("API key for GeminiEmbeddingService cannot be empty.")
+        genai.configure(api_key=api_key)
+        self.model_name = model_name
+        self.batch_size = max(1, batch_size)
+        self.rate_limiter = rate_limiter
+
+    @property
+    def model_id(self) -> str:
+        return f"gemini:{self.model_name}"
+
+    def embed(self, texts: List[str]) -> List[Optional[List[float]]]:
+        vectors: List[Optional[List[float]]] = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            try:
+                if self.rate_limiter:
+                    self.rate_limiter.acquire_llm(self.model_name.replace("models/", "", 1),
+                                                  sum(estimate_tokens(text) for text in batch))
+                result = genai.embed_content(model=self.model_name, content=batch, task_type="semantic_similarity")
+                embeddings = result["embedding"]
+                vectors.extend([list(map(float, vector)) for vector in embeddings])
+            except Exception as e:
+                logging.warning(f"Gemini embedding request failed for {len(batch)} texts: {e}")
+                vectors.extend([None] * len(batch))
+        return vectors
+
+
+class LocalHashedEmbeddingService(EmbeddingService):
+    """
+    完全本地、不需網路的向量：雜湊的字元 n-gram (中日文) 與單字/字元 n-gram (其他文字)。
+
+    以特徵雜湊映射到固定維度 (帶正負號以抵銷碰撞)，詞頻取 1 + log(tf)，
+    較長的 n-gram 權重較高 (近似 IDF：長片段較少見、較具辨識度)，最後做 L2 正規化。
+    結果是決定性的，同一段文字在任何機器上都得到相同向量。
+    """
+
+    _NGRAM_WEIGHTS = {1: 0.5, 2: 1.0, 3: 1.3}
+
+    def __init__(self, dimensions: int = config.LOCAL_EMBEDDING_DIMENSIONS):
+        self.dimensions = dimensions
+
+    @property
+    def model_id(self) -> str:
+        return f"local-hashed-ngram:{self.dimensions}:v1"
+
+    def embed(self, texts: List[str]) -> List[Optional[List[float]]]:
+        return [self._embed_one(text) for text in texts]
+
+    def _features(self, text: str) -> Counter:
+        text = unicodedata.normalize("NFKC", text or "").lower()
+        features: Counter = Counter()
+        for run in _CJK_RUN.findall(text):
+            for n in self._NGRAM_WEIGHTS:
+                for i in range(len(run) - n + 1):
+                    features[(n, run[i:i + n])] += 1
+        for word in _WORD.findall(text):
+            features[(2, "w:" + word)] += 1
+            padded = f"^{word}$"
+            for i in range(len(padded) - 2):
+                features[(1, "c:" + padded[i:i + 3])] += 1
+        return features
+
+    def _embed_one(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimensions
+        for (n, gram), tf in self._features(text).items():
+            digest = zlib.crc32(gram.encode("utf-8"))
+            sign = 1.0 if digest & 0x80000000 else -1.0
+            vector[digest % self.dimensions] += sign * self._NGRAM_WEIGHTS[n] * (1.0 + math.log(tf))
+        norm = math.sqrt(sum(x * x for x in vector))
+        return [x / norm for x in vector] if norm else vector
+
+
+class CachedEmbeddingService(EmbeddingService):
+    """
+    為任一 EmbeddingService 加上兩層快取：程序內 LRU + SQLite (embedding_cache 表)。
+    鍵為 model_id 與文字內容的雜湊，每段文字只需要計算一次向量；
+    同一批次中重複的文字也只送出一次。
+    """
+
+    def __init__(self, inner: EmbeddingService, db_manager: Optional[DatabaseManager],
+                 memory_entries: int = config.EMBEDDING_CACHE_MEMORY_ENTRIES,
+                 max_db_entries: int = config.EMBEDDING_CACHE_MAX_DB_ENTRIES):
+        self.inner = inner
+        self.db = db_manager
+        self.memory_entries = memory_entries
+        self.max_db_entries = max_db_entries
+        self._lru: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes_since_prune = 0
+        self.stats = {"l1_hits": 0, "l2_hits": 0, "computed": 0}
+
+    @property
+    def model_id(self) -> str:
+        return self.inner.model_id
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.inner.model_id}\x1f{text}".encode("utf-8")).hexdigest()
+
+    def embed(self, texts: List[str]) -> List[Optional[List[float]]]:
+        keys = [self._key(text) for text in texts]
+        vectors: Dict[str, List[float]] = {}
+        with self._lock:
+            for key in keys:
+                if key in self._lru and key not in vectors:
+                    self._lru.move_to_end(key)
+                    vectors[key] = self._lru[key]
+                    self.stats["l1_hits"] += 1
+
+        missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+        if missing and self.db:
+            for key, blob in self.db.load_embeddings(missing, time.time()).items():
+                vectors[key] = array.array("f", blob).tolist()
+                self._remember(key, vectors[key])
+                with self._lock:
+                    self.stats["l2_hits"] += 1
+
+        to_compute = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if to_compute:
+            computed = self.inner.embed(list(to_compute.values()))
+            rows = []
+            for key, vector in zip(to_compute, computed):
+                if vector is None:
+                    continue  # 失敗的項目不快取
+                vectors[key] = vector
+                self._remember(key, vector)
+                rows.append((key, self.inner.model_id, array.array("f", vector).tobytes()))
+            with self._lock:
+                self.stats["computed"] += len(rows)
+                self._writes_since_prune += len(rows)
+                should_prune = self._writes_since_prune >= 500
+                if should_prune:
+                    self._writes_since_prune = 0
+            if self.db:
+                self.db.save_embeddings(rows, time.time())
+                if should_prune:
+                    removed = self.db.prune_embedding_cache(self.max_db_entries)
+                    if removed:
+                        logging.info(f"EmbeddingCache: pruned {removed} least recently used vectors.")
+        return [vectors.get(key) for key in keys]
+
+    def _remember(self, key: str, vector: List[float]):
+        with self._lock:
+            self._lru[key] = vector
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.memory_entries:
+                self._lru.popitem(last=False)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self.stats, "l1_size": len(self._lru)}
+
+
+def build_embedding_service(db_manager: Optional[DatabaseManager], api_key: Optional[str] = None,
+                            rate_limiter: Optional[RateLimiter] = None) -> EmbeddingService:
+    """
+    依 EMBEDDING_BACKEND 組裝向量服務 (含磁碟快取)。
+    auto：有 Gemini 金鑰時使用 Gemini 向量模型，否則使用本地雜湊向量。
+    """
+    backend = config.EMBEDDING_BACKEND
+    if backend == "gemini" or (backend == "auto" and api_key):
+        try:
+            inner: EmbeddingService = GeminiEmbeddingService(api_key, rate_limiter=rate_limiter)
+        except Exception as e:
+            logging.warning(f"Gemini embeddings unavailable, using local embedder: {e}")
+            inner = LocalHashedEmbeddingService()
+    else:
+        inner = LocalHashedEmbeddingService()
+    logging.info(f"Embedding service: {inner.model_id}")
+    return CachedEmbeddingService(inner, db_manager)
@@ -0,0 +1,100 @@
+# services/lazy_loading.py
+import time
+import logging
+import importlib
+import threading
+from typing import Dict, Any, List, Tuple
+
+
+class StartupTimer:
+    """
+    記錄啟動各階段的耗時 (資料庫、介面、服務建構、延遲載入的 SDK 等)。
+    階段可以從不同執行緒記錄；report() 依完成順序列出，供日誌與除錯報告使用。
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self._phases: List[Tuple[str, float, float]] = []  # (名稱, 耗時, 完成時距啟動的秒數)
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self._phases.append((name, seconds, time.perf_counter() - self.started_at))
+
+    def phase(self, name: str) -> "_Phase":
+        """with startup_timer.phase("資料庫"): ... 記錄區塊耗時"""
+        return _Phase(self, name)
+
+    def mark(self, name: str):
+        """記錄一個里程碑 (例如「視窗已顯示」)，耗時為 0"""
+        self.record(name, 0.0)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            phases = sorted(self._phases, key=lambda phase: phase[2])
+        return {name: {"ms": round(seconds * 1000, 1), "at_ms": round(at * 1000, 1)} for name, seconds, at in phases}
+
+    def format_report(self) -> str:
+        return ", ".join(f"{name} {entry['ms']:.0f}ms (@{entry['at_ms']:.0f}ms)" for name, entry in self.report().items())
+
+
+class _Phase:
+    def __init__(self, timer: StartupTimer, name: str):
+        self.timer = timer
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.timer.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+# 整個行程共用一個計時器 (從第一次 import 本模組起算)
+startup_timer = StartupTimer()
+
+
+class LazyModule:
+    """
+    第一次存取屬性時才 import 的模組代理。
+
+    google.generativeai 與 googleapiclient 在 import 時就要花上百毫秒到一秒以上，
+    但啟動時並不需要它們；以 `genai = LazyModule("google.generativeai")` 取代頂層 import，
+    用到的程式碼不必改寫，實際載入延後到第一次呼叫 (通常在背景建構服務時)。
+    載入耗時記錄在 startup_timer。
+    """
+
+    def __init__(self, name: str):
+        self._lazy_name = name
+        self._lazy_module = None
+        self._lazy_lock = threading.Lock()
+
+    def _load(self):
+        module = self._lazy_module
+        if module is not None:
+            return module
+        with self._lazy_lock:
+            if self._lazy_module is None:
+                start = time.perf_counter()
+                self._lazy_module = importlib.import_module(self._lazy_name)
+                elapsed = time.perf_counter() - start
+                startup_timer.record(f"import {self._lazy_name}", elapsed)
+                logging.debug(f"Lazy import of '{self._lazy_name}' took {elapsed * 1000:.0f}ms.")
+            return self._lazy_module
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._lazy_module is not None
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.is_loaded else "not loaded"
+        return f"<LazyModule '{self._lazy_name}' ({state})>"
@@ -0,0 +1,205 @@
+# services/llm_scheduler.py
+import time
+import heapq
+import logging
+import threading
+import itertools
+import functools
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List
+
+import config
+
+# 優先等級 (數字越小越優先)
+PRIORITY_INTERACTIVE = "interactive"  # 使用者正在等待的回合
+PRIORITY_PROACTIVE = "proactive"      # 主動聊天、任務提醒
+PRIORITY_LEARNING = "learning"        # 文本學習、糾正學習、自我反思
+PRIORITY_MAINTENANCE = "maintenance"  # 情緒調節、記憶摘要等維護工作
+PRIORITY_ORDER = [PRIORITY_INTERACTIVE, PRIORITY_PROACTIVE, PRIORITY_LEARNING, PRIORITY_MAINTENANCE]
+_RANK = {name: rank for rank, name in enumerate(PRIORITY_ORDER)}
+
+# 延遲直方圖的桶上界 (毫秒)；最後一桶收納超過上界者
+LATENCY_BUCKETS_MS = [100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+_thread_context = threading.local()
+
+
+class LLMRequestDropped(RuntimeError):
+    """背景請求在佇列中等待超過期限，已被捨棄"""
+
+
+@contextmanager
+def request_priority(priority: str):
+    """在此區塊內 (同一執行緒) 發出的 LLM 請求預設使用指定的優先等級"""
+    previous = getattr(_thread_context, "priority", None)
+    _thread_context.priority = priority
+    try:
+        yield
+    finally:
+        _thread_context.priority = previous
+
+
+def with_priority(priority: str):
+    """裝飾器：讓背景工作函式內發出的 LLM / 搜尋請求都使用指定的優先等級"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with request_priority(priority):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_priority(default: str = PRIORITY_INTERACTIVE) -> str:
+    return getattr(_thread_context, "priority", None) or default
+
+
+class LatencyHistogram:
+    """固定桶的延遲直方圖"""
+
+    def __init__(self, bounds_ms: List[int] = LATENCY_BUCKETS_MS):
+        self.bounds_ms = bounds_ms
+        self.counts = [0] * (len(bounds_ms) + 1)
+        self.total_ms = 0.0
+        self.count = 0
+
+    def record(self, value_ms: float):
+        idx = 0
+        while idx < len(self.bounds_ms) and value_ms > self.bounds_ms[idx]:
+            idx += 1
+        self.counts[idx] += 1
+        self.total_ms += value_ms
+        self.count += 1
+
+    def percentile(self, q: float) -> Optional[int]:
+        """以桶上界估計百分位數 (毫秒)；超出最後一桶時返回 None"""
+        if not self.count:
+            return 0
+        threshold = q * self.count
+        running = 0
+        for idx, bucket_count in enumerate(self.counts):
+            running += bucket_count
+            if running >= threshold:
+                return self.bounds_ms[idx] if idx < len(self.bounds_ms) else None
+        return None
+
+    def snapshot(self) -> Dict[str, Any]:
+        labels = [f"<={b}" for b in self.bounds_ms] + [f">{self.bounds_ms[-1]}"]
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_ms / self.count, 1) if self.count else 0.0,
+            "p50_ms": self.percentile(0.5), "p95_ms": self.percentile(0.95),
+            "buckets": {label: c for label, c in zip(labels, self.counts) if c},
+        }
+
+
+class LLMScheduler:
+    """
+    LLM 請求的優先排程器 (給同步的工作執行緒使用)。
+
+    - 空出名額時，永遠先放行優先等級最高 (其次最早到) 且該等級尚未達上限的請求；
+    - 每個等級各有同時執行上限，且非互動請求最多只能用到 max_concurrent - interactive_reserve，
+      讓使用者的回合不必等背景工作讓出名額；
+    - 背景等級有佇列等待期限，逾時的請求直接捨棄 (LLMRequestDropped)；
+    - 每個等級記錄排隊時間與總延遲的直方圖。
+    """
+
+    def __init__(self, max_concurrent: int = config.LLM_MAX_CONCURRENT_CALLS,
+                 class_caps: Optional[Dict[str, int]] = None,
+                 queue_deadlines: Optional[Dict[str, Optional[float]]] = None,
+                 interactive_reserve: int = config.LLM_SCHEDULER_INTERACTIVE_RESERVE):
+        self.max_concurrent = max(1, max_concurrent)
+        self.class_caps = dict(class_caps or config.LLM_SCHEDULER_CLASS_CAPS)
+        self.queue_deadlines = dict(queue_deadlines or config.LLM_SCHEDULER_QUEUE_DEADLINES)
+        self.background_limit = max(1, self.max_concurrent - interactive_reserve)
+
+        self._cond = threading.Condition()
+        self._waiters: List[tuple] = []  # heap of (rank, seq, priority)
+        self._seq = itertools.count()
+        self._granted: set = set()
+        self._running: Dict[str, int] = {p: 0 for p in PRIORITY_ORDER}
+        self._stats: Dict[str, Dict[str, Any]] = {
+            p: {"admitted": 0, "dropped": 0, "queue": LatencyHistogram(), "total": LatencyHistogram()}
+            for p in PRIORITY_ORDER
+        }
+
+    def _normalize(self, priority: Optional[str]) -> str:
+        return priority if priority in _RANK else current_priority()
+
+    def _has_room_locked(self, priority: str) -> bool:
+        total_running = sum(self._running.values())
+        if total_running >= self.max_concurrent:
+            return False
+        if self._running[priority] >= self.class_caps.get(priority, self.max_concurrent):
+            return False
+        if priority != PRIORITY_INTERACTIVE:
+            background_running = total_running - self._running[PRIORITY_INTERACTIVE]
+            if background_running >= self.background_limit:
+                return False
+        return True
+
+    def _grant_locked(self):
+        """依優先順序放行所有目前可以執行的等待者"""
+        blocked: List[tuple] = []
+        while self._waiters:
+            entry = heapq.heappop(self._waiters)
+            if self._has_room_locked(entry[2]):
+                self._running[entry[2]] += 1
+                self._granted.add(entry[1])
+            else:
+                blocked.append(entry)
+        for entry in blocked:
+            heapq.heappush(self._waiters, entry)
+        if self._granted:
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority: Optional[str] = None):
+        """
+        取得一個執行名額，區塊結束時歸還。
+        等待超過該等級的佇列期限時拋出 LLMRequestDropped。
+        """
+        priority = self._normalize(priority)
+        enqueued_at = time.monotonic()
+        deadline_s = self.queue_deadlines.get(priority)
+        entry = (_RANK[priority], next(self._seq), priority)
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            self._grant_locked()
+            while entry[1] not in self._granted:
+                remaining = None if deadline_s is None else deadline_s - (time.monotonic() - enqueued_at)
+                if remaining is not None and remaining <= 0:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    self._stats[priority]["dropped"] += 1
+                    logging.warning(f"LLMScheduler: dropped stale '{priority}' request after {deadline_s:.0f}s in queue.")
+                    raise LLMRequestDropped(f"'{priority}' LLM request waited longer than {deadline_s:.0f}s and was dropped.")
+                self._cond.wait(remaining)
+            self._granted.discard(entry[1])
+            queue_ms = (time.monotonic() - enqueued_at) * 1000
+            self._stats[priority]["admitted"] += 1
+            self._stats[priority]["queue"].record(queue_ms)
+        if queue_ms > 1000:
+            logging.info(f"LLMScheduler: '{priority}' request waited {queue_ms:.0f} ms for a slot.")
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running[priority] -= 1
+                self._stats[priority]["total"].record((time.monotonic() - enqueued_at) * 1000)
+                self._grant_locked()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """每個等級的放行/捨棄次數、排隊中的數量與延遲直方圖"""
+        with self._cond:
+            waiting = {p: 0 for p in PRIORITY_ORDER}
+            for _, _, p in self._waiters:
+                waiting[p] += 1
+            return {
+                p: {
+                    "running": self._running[p], "waiting": waiting[p],
+                    "admitted": s["admitted"], "dropped": s["dropped"],
+                    "queue_latency": s["queue"].snapshot(), "total_latency": s["total"].snapshot(),
+                }
+                for p, s in self._stats.items()
+            }
@@ -1,87 +1,311 @@
 # services/llm_service.py
-import google.generativeai as genai
-import logging
-import re
 import json
-from typing import Dict, Any
+import logging
+import threading
+import time
+from typing import Dict, Any, Optional, Callable, List, Tuple
 
 import config
 from services.base_services import LLMService
+from services.analysis_cache import AnalysisCache
+from services.structured_output import SpokenResponseStreamExtractor, extract_json
+from services.llm_scheduler import LLMScheduler
+from services.llm_tasks import (TASK_CHAT, TASK_EMOTION_ANALYSIS, TASK_EVENT_APPRAISAL, TIER_CHAT,
+                                model_name_for_task, task_generation_config, task_tier)
+from services.rate_limiter import RateLimiter
+from services.tokens import estimate_tokens, estimate_contents_tokens
+from services.lazy_loading import LazyModule
+
+# SDK 載入要一秒左右，延後到第一次建立模型時 (啟動後在背景執行緒中)
+genai = LazyModule("google.generativeai")
+
+# 分析提示的版本號；修改對應提示內容時請一併遞增，讓舊的快取自動失效
+EMOTION_ANALYSIS_PROMPT_VERSION = "emotions-v1"
+EVENT_APPRAISAL_PROMPT_VERSION = "appraisal-v1"
+
+def extract_turn_analysis(parsed_output: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    """從單次回合的結構化輸出中取出並驗證使用者情緒 (user_emotions) 與事件評價 (appraisal)"""
+    user_emotions: Dict[str, float] = {}
+    raw_emotions = parsed_output.get("user_emotions")
+    if isinstance(raw_emotions, dict):
+        for k, v in raw_emotions.items():
+            if k in config.EMOTIONS and isinstance(v, (int, float)) and not isinstance(v, bool):
+                user_emotions[k] = max(0.0, min(1.0, float(v)))
+
+    appraisal: Dict[str, float] = {}
+    raw_appraisal = parsed_output.get("appraisal")
+    if isinstance(raw_appraisal, dict):
+        for k, v in raw_appraisal.items():
+            if k in config.APPRAISAL_DIMENSIONS and isinstance(v, (int, float)) and not isinstance(v, bool):
+                appraisal[k] = max(-1.0, min(1.0, float(v)))
+    return {"user_emotions": user_emotions, "appraisal": appraisal}
 
 class GeminiService(LLMService):
     """使用 Google Gemini API 的 LLM 服務"""
-    def __init__(self, api_key: str, model_name: str):
+    def __init__(self, api_key: str, model_name: str, analysis_cache: Optional[AnalysisCache] = None,
+                 scheduler: Optional[LLMScheduler] = None, rate_limiter: Optional[RateLimiter] = None):
         if not api_key:
             raise ValueError("API key for GeminiService cannot be empty.")
         genai.configure(api_key=api_key)
+        self.model_name = model_name
         self.model = genai.GenerativeModel(model_name)
-        # 建立一個專門用於分析任務的模型，可以使用較輕量的模型
-        self.analysis_model = genai.GenerativeModel("gemini-1.5-flash-latest") 
+        # 各分級的模型物件 (依任務的分級延遲建立)
+        self._models_by_name: Dict[str, Any] = {model_name: self.model}
+        self._models_lock = threading.Lock()
+        self.analysis_cache = analysis_cache
+        self.scheduler = scheduler
+        self.rate_limiter = rate_limiter
+        # 穩定前綴雜湊 -> 服務端上下文快取的模型 (None 表示建立失敗，不再重試)
+        self._context_caches: Dict[tuple, Tuple[Optional[Any], float]] = {}
+        self._context_cache_lock = threading.Lock()
         logging.info(f"GeminiService initialized with model: {model_name}")
 
     def generate_content(self, prompt_details: Dict[str, Any]) -> Dict[str, Any]:
         """根據結構化的提示詳情生成內容，包含工具呼叫邏輯"""
         try:
-            messages_history = prompt_details["contents"]
-            tools = prompt_details.get("tools")
-            generation_config = prompt_details.get("generation_config")
-            expect_structured_output = prompt_details.get("expect_structured_output", False)
-
-            # 第一次呼叫模型
-            logging.debug("LLMService: Initial call to Gemini model.")
-            response = self.model.generate_content(
-                messages_history,
-                generation_config=generation_config,
-                tools=tools
-            )
+            return self.generate_content_or_raise(prompt_details)
+        except Exception as e:
+            logging.error(f"Gemini API error during content generation: {e}", exc_info=True)
+            return self._error_result(e)
+
+    @staticmethod
+    def _error_result(error: Exception) -> Dict[str, Any]:
+        return {
+            "internal_thought": f"(API 錯誤: {error})",
+            "spoken_response": "哎呀，我的思考迴路短路了...",
+            "error": str(error)
+        }
 
-            response_part = response.candidates[0].content.parts[0]
+    def generate_content_or_raise(self, prompt_details: Dict[str, Any]) -> Dict[str, Any]:
+        """與 generate_content 相同，但呼叫失敗時直接拋出例外 (供路由服務判斷是否切換模型)"""
+        messages_history = prompt_details["contents"]
+        task = prompt_details.get("task", TASK_CHAT)
+        tools = prompt_details.get("tools")
+        generation_config = task_generation_config(task, prompt_details.get("generation_config"))
+        expect_structured_output = prompt_details.get("expect_structured_output", False)
+        on_stream = prompt_details.get("on_stream")
+        if task_tier(task) == TIER_CHAT:
+            model, call_contents, tools = self._apply_context_cache(messages_history, tools, prompt_details.get("stable_prefix"))
+        else:
+            model, call_contents = self.model_for_task(task), messages_history
 
-            # 檢查模型是否要求呼叫工具
-            if response_part.function_call:
-                function_call = response_part.function_call
-                function_name = function_call.name
-                
-                logging.info(f"LLM requested a tool call: {function_name} with args: {function_call.args}")
-                
-                # 將模型的「工具呼叫請求」加到歷史紀錄中
-                messages_history.append(response.candidates[0].content)
+        # 第一次呼叫模型；提供 on_stream 時改用串流，邊接收邊回報口頭回應
+        logging.debug("LLMService: Initial call to Gemini model.")
+        response = self._call_model(
+            model,
+            call_contents,
+            timeout=prompt_details.get("timeout", config.LLM_CALL_TIMEOUT_SECONDS),
+            priority=prompt_details.get("priority"),
+            on_chunk=self._make_stream_handler(on_stream, expect_structured_output) if on_stream else None,
+            generation_config=generation_config,
+            tools=tools
+        )
+
+        response_content = response.candidates[0].content
+        function_calls = [part.function_call for part in response_content.parts if getattr(part, "function_call", None)]
 
-                # 返回一個特殊的字典，通知 PetLogic 需要執行工具
+        # 檢查模型是否要求呼叫工具 (同一個回應可能同時要求多個)
+        if function_calls:
+            tool_call_requests = [{"name": call.name, "args": dict(call.args)} for call in function_calls]
+            logging.info(f"LLM requested {len(tool_call_requests)} tool call(s): {tool_call_requests}")
+            
+            # 將模型的「工具呼叫請求」加到歷史紀錄中
+            messages_history.append(response_content)
+
+            # 返回一個特殊的字典，通知呼叫端需要執行工具 (見 services/tool_loop.py)
+            return {
+                "tool_call_requests": tool_call_requests,
+                "tool_call_request": tool_call_requests[0],
+                "messages_history_for_next_turn": messages_history, # 傳遞更新後的歷史
+                "error": None
+            }
+        else:
+            # 模型沒有要求呼叫工具，直接給出了文字回答
+            raw_llm_output_text = response.text.strip()
+            if expect_structured_output:
+                parsed_output = self._parse_structured_output(raw_llm_output_text)
                 return {
-                    "tool_call_request": {
-                        "name": function_name,
-                        "args": dict(function_call.args)
-                    },
-                    "messages_history_for_next_turn": messages_history, # 傳遞更新後的歷史
+                    "internal_thought": parsed_output.get("internal_thought", "(未提供思考)"),
+                    "spoken_response": parsed_output.get("spoken_response", raw_llm_output_text),
+                    **extract_turn_analysis(parsed_output),
                     "error": None
                 }
             else:
-                # 模型沒有要求呼叫工具，直接給出了文字回答
-                raw_llm_output_text = response.text.strip()
-                if expect_structured_output:
-                    parsed_output = self._parse_structured_output(raw_llm_output_text)
-                    return {
-                        "internal_thought": parsed_output.get("internal_thought", "(未提供思考)"),
-                        "spoken_response": parsed_output.get("spoken_response", raw_llm_output_text),
-                        "error": None
-                    }
-                else:
-                    return {"spoken_response": raw_llm_output_text, "error": None}
+                return {"spoken_response": raw_llm_output_text, "error": None}
+
+    def model_name_for_task(self, task: Optional[str]) -> str:
+        return model_name_for_task(task, self.model_name)
+
+    def model_for_task(self, task: Optional[str]):
+        """返回任務分級對應的模型物件"""
+        name = self.model_name_for_task(task)
+        with self._models_lock:
+            model = self._models_by_name.get(name)
+            if model is None:
+                model = self._models_by_name[name] = genai.GenerativeModel(name)
+        return model
+
+    def _apply_context_cache(self, contents: List[Dict[str, Any]], tools: Any,
+                             stable_prefix: Optional[Dict[str, str]]) -> Tuple[Any, List[Dict[str, Any]], Any]:
+        """
+        若啟用服務端上下文快取且前綴夠長，以 CachedContent 保存穩定前綴 (與工具定義)，
+        並從第一則訊息中移除該前綴。返回 (模型, 實際送出的 contents, tools)。
+        原始的 contents 不會被修改，工具呼叫的後續回合仍拿到完整提示。
+        """
+        if not (config.LLM_CONTEXT_CACHE_ENABLED and stable_prefix and contents):
+            return self.model, contents, tools
+        prefix_text = stable_prefix.get("text") or ""
+        first_parts = contents[0].get("parts", []) if isinstance(contents[0], dict) else []
+        first_text = first_parts[0].get("text", "") if first_parts and isinstance(first_parts[0], dict) else ""
+        if not prefix_text or not first_text.startswith(prefix_text):
+            return self.model, contents, tools
+        if estimate_tokens(prefix_text) < config.LLM_CONTEXT_CACHE_MIN_TOKENS:
+            return self.model, contents, tools
+
+        cached_model = self._cached_model_for_prefix(stable_prefix["key"], prefix_text, tools)
+        if cached_model is None:
+            return self.model, contents, tools
+        remainder = first_text[len(prefix_text):].lstrip("\n") or "(以上為系統設定)"
+        call_contents = [{**contents[0], "parts": [{"text": remainder}] + list(first_parts[1:])}] + list(contents[1:])
+        return cached_model, call_contents, None  # 工具定義已包含在快取中
 
+    def _cached_model_for_prefix(self, prefix_key: str, prefix_text: str, tools: Any) -> Optional[Any]:
+        cache_key = (self.model_name, prefix_key, tools is not None)
+        now = time.time()
+        with self._context_cache_lock:
+            entry = self._context_caches.get(cache_key)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+        try:
+            from google.generativeai import caching
+            cached_content = caching.CachedContent.create(
+                model=self.model_name, display_name=f"deskpet-prefix-{prefix_key}",
+                system_instruction=prefix_text, tools=tools, ttl=config.LLM_CONTEXT_CACHE_TTL_SECONDS
+            )
+            cached_model = genai.GenerativeModel.from_cached_content(cached_content)
+            logging.info(f"Created provider context cache for stable prefix {prefix_key}.")
         except Exception as e:
-            logging.error(f"Gemini API error during content generation: {e}", exc_info=True)
-            return {
-                "internal_thought": f"(API 錯誤: {e})",
-                "spoken_response": "哎呀，我的思考迴路短路了...",
-                "error": str(e)
-            }
+            # 失敗 (例如前綴低於服務端的最小長度) 時在 TTL 內不再嘗試
+            logging.warning(f"Provider context caching unavailable for prefix {prefix_key}: {e}")
+            cached_model = None
+        with self._context_cache_lock:
+            for key in [k for k, (_, expires_at) in self._context_caches.items() if expires_at <= now]:
+                del self._context_caches[key]
+            # 提早一分鐘視為過期，避免送出時服務端的快取剛好失效
+            self._context_caches[cache_key] = (cached_model, now + max(60, config.LLM_CONTEXT_CACHE_TTL_SECONDS - 60))
+        return cached_model
+
+    def _call_model(self, model, contents: Any, timeout: Optional[float] = None,
+                    on_chunk: Optional[Callable[[str], None]] = None, priority: Optional[str] = None, **kwargs):
+        """
+        所有模型呼叫的唯一出口。
+        on_chunk 不為 None 時以串流方式呼叫，每收到一段文字就回呼一次；
+        返回的 response 在串流讀完後包含完整結果。
+        priority 為排程等級 (見 services.llm_scheduler)；未指定時使用目前執行緒的 request_priority。
+
+        先以預估用量預扣速率額度 (可能需要等待)，取得額度後才向排程器要名額，
+        等待速率額度的請求不會佔住排程名額；回應後依實際用量對帳。
+        """
+        reservation = self._reserve_rate_limit(model, contents, priority, kwargs)
+        try:
+            if self.scheduler is None:
+                response = self._invoke_model(model, contents, timeout=timeout, on_chunk=on_chunk, **kwargs)
+            else:
+                with self.scheduler.slot(priority):
+                    response = self._invoke_model(model, contents, timeout=timeout, on_chunk=on_chunk, **kwargs)
+        except BaseException:
+            # 排程器捨棄、逾時、伺服器錯誤或改由其他後端重試：預扣的 token 不應留在 TPM 與每日計數中
+            if reservation is not None:
+                self.rate_limiter.refund_llm(reservation)
+            raise
+        if reservation is not None:
+            self.rate_limiter.reconcile_llm(reservation, self._usage_tokens(response))
+        return response
+
+    def _reserve_rate_limit(self, model, contents: Any, priority: Optional[str], kwargs: Dict[str, Any]):
+        """以預估 token 數 (輸入 + max_output_tokens) 取得速率額度；未設定速率限制時返回 None"""
+        if self.rate_limiter is None:
+            return None
+        generation_config = kwargs.get("generation_config") or {}
+        max_output = generation_config.get("max_output_tokens", 1024) if isinstance(generation_config, dict) else 1024
+        return self.rate_limiter.acquire_llm(
+            self._model_name_of(model), estimate_contents_tokens(contents) + int(max_output), priority
+        )
+
+    @staticmethod
+    def _model_name_of(model) -> str:
+        return str(getattr(model, "model_name", "") or "").replace("models/", "", 1)
+
+    @staticmethod
+    def _usage_tokens(response) -> Optional[int]:
+        """從回應的 usage_metadata 取得實際 token 總數 (取不到時返回 None)"""
+        try:
+            total = response.usage_metadata.total_token_count
+            return int(total) if total else None
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    def _invoke_model(self, model, contents: Any, timeout: Optional[float] = None,
+                      on_chunk: Optional[Callable[[str], None]] = None, **kwargs):
+        """實際送出請求 (同步版本)；子類別可覆寫以改變傳輸方式"""
+        request_options = {"timeout": timeout} if timeout else None
+        response = model.generate_content(contents, stream=bool(on_chunk), request_options=request_options, **kwargs)
+        if on_chunk:
+            for chunk in response:
+                chunk_text = self._chunk_text(chunk)
+                if chunk_text:
+                    on_chunk(chunk_text)
+        return response
+
+    @staticmethod
+    def _chunk_text(chunk) -> str:
+        try:
+            return chunk.text
+        except ValueError:
+            return ""  # 工具呼叫的區塊沒有文字
+
+    def _make_stream_handler(self, on_stream: Callable[[str], None], expect_structured_output: bool) -> Callable[[str], None]:
+        """
+        建立串流區塊的處理函式，將口頭回應的新增文字交給 on_stream。
+        結構化輸出只轉發 `spoken_response` 欄位的內容。
+        """
+        extractor = SpokenResponseStreamExtractor() if expect_structured_output else None
+        started_at = time.monotonic()
+        state = {"first_text_logged": False}
+
+        def handle_chunk(chunk_text: str):
+            delta = extractor.feed(chunk_text) if extractor else chunk_text
+            if not delta:
+                return
+            if not state["first_text_logged"]:
+                state["first_text_logged"] = True
+                logging.info(f"LLM stream: first spoken text after {(time.monotonic() - started_at) * 1000:.0f} ms.")
+            try:
+                on_stream(delta)
+            except Exception as e:
+                logging.warning(f"LLM stream callback failed: {e}")
+
+        return handle_chunk
+
+    def count_tokens(self, contents: Any) -> Optional[int]:
+        """使用 Gemini 的 count_tokens API 精確計算 token 數"""
+        try:
+            return int(self.model.count_tokens(contents).total_tokens)
+        except Exception as e:
+            logging.warning(f"Gemini count_tokens failed, falling back to local estimate: {e}")
+            return None
 
     def analyze_text_for_emotions(self, text: str) -> Dict[str, float]:
         """分析給定文本，返回一個包含情緒及其分數的字典"""
         if not text or len(text) < 5:
             return {}
 
+        if self.analysis_cache:
+            cached = self.analysis_cache.get("emotions", text, self.model_name_for_task(TASK_EMOTION_ANALYSIS), EMOTION_ANALYSIS_PROMPT_VERSION)
+            if cached is not None:
+                logging.debug("Emotion analysis served from cache.")
+                return cached
+
         emotion_list_str = ", ".join(config.EMOTIONS.keys())
         prompt = (
             f"請只用繁體中文回答。仔細分析以下文字，判斷其主要表達了哪些情緒。\n"
@@ -90,9 +314,11 @@ class GeminiService(LLMService):
             f"待分析的文字： \"{text}\""
         )
         try:
-            response = self.analysis_model.generate_content(
+            response = self._call_model(
+                self.model_for_task(TASK_EMOTION_ANALYSIS),
                 prompt,
-                generation_config={"temperature": 0.1, "max_output_tokens": 500}
+                timeout=config.LLM_ANALYSIS_TIMEOUT_SECONDS,
+                generation_config=task_generation_config(TASK_EMOTION_ANALYSIS)
             )
             parsed_json = self._parse_structured_output(response.text)
             
@@ -101,6 +327,8 @@ class GeminiService(LLMService):
                 k: float(v) for k, v in parsed_json.items()
                 if k in config.EMOTIONS and isinstance(v, (int, float))
             }
+            if self.analysis_cache:
+                self.analysis_cache.put("emotions", text, self.model_name_for_task(TASK_EMOTION_ANALYSIS), EMOTION_ANALYSIS_PROMPT_VERSION, valid_emotions)
             return valid_emotions
         except Exception as e:
             logging.error(f"Gemini API error during emotion analysis: {e}", exc_info=True)
@@ -110,6 +338,12 @@ class GeminiService(LLMService):
         """根據評價理論分析事件文本"""
         if not event_text or len(event_text) < 3:
             return {}
+
+        if self.analysis_cache:
+            cached = self.analysis_cache.get("appraisal", event_text, self.model_name_for_task(TASK_EVENT_APPRAISAL), EVENT_APPRAISAL_PROMPT_VERSION)
+            if cached is not None:
+                logging.debug("Event appraisal served from cache.")
+                return cached
             
         # ... 此處應包含原檔案中 _appraise_event_with_llm 的完整 appraisal_prompt ...
         prompt = f"""
@@ -119,51 +353,186 @@ class GeminiService(LLMService):
         請只輸出 JSON。
         """
         try:
-            response = self.analysis_model.generate_content(
+            response = self._call_model(
+                self.model_for_task(TASK_EVENT_APPRAISAL),
                 prompt,
-                generation_config={"temperature": 0.2, "max_output_tokens": 200}
+                timeout=config.LLM_ANALYSIS_TIMEOUT_SECONDS,
+                generation_config=task_generation_config(TASK_EVENT_APPRAISAL)
             )
             parsed_json = self._parse_structured_output(response.text)
             
             # 驗證並轉換為浮點數
             valid_appraisals = {k: float(v) for k, v in parsed_json.items() if isinstance(v, (int, float))}
+            if self.analysis_cache:
+                self.analysis_cache.put("appraisal", event_text, self.model_name_for_task(TASK_EVENT_APPRAISAL), EVENT_APPRAISAL_PROMPT_VERSION, valid_appraisals)
             return valid_appraisals
         except Exception as e:
             logging.error(f"Gemini API error during event appraisal: {e}", exc_info=True)
             return {}
 
+    # --- 批次分析 ---
+    def analyze_texts_for_emotions_batch(self, texts: List[str]) -> List[Dict[str, float]]:
+        """一次呼叫分析多段文字的情緒；返回與輸入同順序的列表"""
+        return self._run_analysis_batch(
+            texts, kind="emotions", task=TASK_EMOTION_ANALYSIS, prompt_version=EMOTION_ANALYSIS_PROMPT_VERSION,
+            min_length=5, build_prompt=self._emotion_batch_prompt, validate=self._validate_batch_emotions,
+            single=self.analyze_text_for_emotions
+        )
+
+    def appraise_events_batch(self, event_texts: List[str]) -> List[Dict[str, float]]:
+        """一次呼叫評價多個事件；返回與輸入同順序的列表"""
+        return self._run_analysis_batch(
+            event_texts, kind="appraisal", task=TASK_EVENT_APPRAISAL, prompt_version=EVENT_APPRAISAL_PROMPT_VERSION,
+            min_length=3, build_prompt=self._appraisal_batch_prompt, validate=self._validate_batch_appraisal,
+            single=self.appraise_event
+        )
+
+    def _run_analysis_batch(self, texts: List[str], kind: str, task: str, prompt_version: str, min_length: int,
+                            build_prompt: Callable[[List[str]], str],
+                            validate: Callable[[Any], Optional[Dict[str, float]]],
+                            single: Callable[[str], Dict[str, float]]) -> List[Dict[str, float]]:
+        """
+        共用的批次流程：先查快取，相同文字只分析一次，其餘依 token 預算分塊，
+        每塊一次結構化呼叫 (以 t1, t2... 對應各項目)，逐項驗證；
+        缺漏或格式錯誤的項目改用單筆呼叫。
+        批次結果與單筆結果意義相同，因此共用同一個快取鍵 (單筆呼叫之後也能命中)。
+        """
+        results: List[Dict[str, float]] = [{} for _ in texts]
+        model_name = self.model_name_for_task(task)
+        pending: Dict[str, List[int]] = {}
+        for idx, text in enumerate(texts):
+            if not text or len(text) < min_length:
+                continue
+            if self.analysis_cache:
+                cached = self.analysis_cache.get(kind, text, model_name, prompt_version)
+                if cached is not None:
+                    results[idx] = cached
+                    continue
+            pending.setdefault(text, []).append(idx)
+
+        def store(text: str, value: Dict[str, float]):
+            for idx in pending[text]:
+                results[idx] = value
+
+        failed: List[str] = []
+        for chunk in self._chunk_by_token_budget(list(pending)):
+            if len(chunk) == 1:
+                failed.extend(chunk)  # 單項不值得包成批次格式
+                continue
+            parsed = self._call_analysis_batch(task, build_prompt(chunk), len(chunk))
+            for item_no, text in enumerate(chunk, start=1):
+                value = validate(parsed.get(f"t{item_no}")) if parsed else None
+                if value is None:
+                    failed.append(text)
+                    continue
+                store(text, value)
+                if self.analysis_cache:
+                    self.analysis_cache.put(kind, text, model_name, prompt_version, value)
+
+        if failed:
+            logging.info(f"Batch {kind} analysis: {len(failed)}/{len(pending)} items handled by single calls.")
+        for text in failed:
+            store(text, single(text))
+        return results
+
+    @staticmethod
+    def _chunk_by_token_budget(texts: List[str]) -> List[List[str]]:
+        chunks: List[List[str]] = []
+        current: List[str] = []
+        used = 0
+        for text in texts:
+            cost = estimate_tokens(text) + 8  # 編號與引號
+            if current and (used + cost > config.LLM_BATCH_ANALYSIS_INPUT_TOKENS
+                            or len(current) >= config.LLM_BATCH_ANALYSIS_MAX_ITEMS):
+                chunks.append(current)
+                current, used = [], 0
+            current.append(text)
+            used += cost
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _call_analysis_batch(self, task: str, prompt: str, item_count: int) -> Optional[Dict[str, Any]]:
+        max_output = config.LLM_BATCH_OUTPUT_TOKENS_PER_ITEM * item_count + 100
+        try:
+            response = self._call_model(
+                self.model_for_task(task),
+                prompt,
+                timeout=config.LLM_BATCH_ANALYSIS_TIMEOUT_SECONDS,
+                generation_config=task_generation_config(task, {"max_output_tokens": max_output})
+            )
+            return extract_json(response.text, expected_type=dict)
+        except Exception as e:
+            logging.warning(f"Batch analysis call failed ({item_count} items), falling back to single calls: {e}")
+            return None
+
+    @staticmethod
+    def _numbered_items(texts: List[str]) -> str:
+        return "\n".join(f"[t{item_no}] {json.dumps(text, ensure_ascii=False)}" for item_no, text in enumerate(texts, start=1))
+
+    def _emotion_batch_prompt(self, texts: List[str]) -> str:
+        return (
+            "請只用繁體中文回答。仔細分析以下每一段文字，分別判斷其主要表達了哪些情緒。\n"
+            f"可參考的情緒列表：[{', '.join(config.EMOTIONS.keys())}]。\n"
+            "請以單一 JSON 物件輸出，鍵為項目編號 (例如 \"t1\")，值為該段文字的情緒分數物件 (0~1)，"
+            "例如：{\"t1\": {\"joy\": 0.8, \"neutral\": 0.2}, \"t2\": {\"sadness\": 0.6}}。不要有任何其他文字。\n\n"
+            + self._numbered_items(texts)
+        )
+
+    def _appraisal_batch_prompt(self, texts: List[str]) -> str:
+        return (
+            "請根據以下評價維度分別評估每一個事件。\n"
+            f"評價維度: {', '.join(config.APPRAISAL_DIMENSIONS)}；pleasantness 與 goal_conduciveness 範圍 -1~1，其餘 0~1。\n"
+            "請以單一 JSON 物件輸出，鍵為項目編號 (例如 \"t1\")，值為該事件的評價分數物件。請只輸出 JSON。\n\n"
+            + self._numbered_items(texts)
+        )
+
+    @staticmethod
+    def _validate_batch_emotions(raw: Any) -> Optional[Dict[str, float]]:
+        if not isinstance(raw, dict):
+            return None
+        valid = {k: max(0.0, min(1.0, float(v))) for k, v in raw.items()
+                 if k in config.EMOTIONS and isinstance(v, (int, float)) and not isinstance(v, bool)}
+        return valid if valid or not raw else None
+
+    @staticmethod
+    def _validate_batch_appraisal(raw: Any) -> Optional[Dict[str, float]]:
+        if not isinstance(raw, dict):
+            return None
+        valid = {k: max(-1.0, min(1.0, float(v))) for k, v in raw.items()
+                 if k in config.APPRAISAL_DIMENSIONS and isinstance(v, (int, float)) and not isinstance(v, bool)}
+        return valid or None
+
     def _parse_structured_output(self, raw_text: str) -> Dict:
         """
-        更強大的 JSON 解析器：從LLM的原始回應中安全地提取JSON物件。
-        能夠處理 markdown 標記和字串中的換行符。
+        從LLM的原始回應中安全地提取JSON物件。
+        使用單次掃描、能辨識字串的括號比對 (見 services.structured_output.extract_json)，
+        可處理 markdown 標記、巢狀物件、字串中的括號與換行，以及常見的格式錯誤。
         """
         logging.debug(f"LLM Raw Output to be parsed:\n---\n{raw_text}\n---")
-        
-        # 尋找被 ```json ... ``` 包圍的區塊或裸露的JSON物件
-        match = re.search(r"```json\s*(\{[\s\S]*?\})\s*```|(\{[\s\S]*?\})", raw_text, re.DOTALL)
-        
-        if match:
-            json_str = match.group(1) if match.group(1) else match.group(2)
-            try:
-                # 關鍵修正：使用 strict=False 來允許字串中的控制字元，例如換行符
-                data = json.loads(json_str, strict=False)
-                if isinstance(data, dict):
-                    logging.info("Successfully parsed structured JSON output.")
-                    return data
-                else:
-                    logging.warning(f"Parsed JSON is not a dictionary. Type: {type(data)}")
-                    return {"spoken_response": str(data), "internal_thought": "(JSON解析結果非字典)"}
-            except json.JSONDecodeError as e:
-                logging.error(f"Failed to parse extracted JSON. Error: {e}. Trying to fix...")
-                # 嘗試修復常見的錯誤，例如結尾多餘的逗號
-                fixed_json_str = re.sub(r',\s*([\}\]])', r'\1', json_str)
-                try:
-                    data = json.loads(fixed_json_str, strict=False)
-                    logging.info("Successfully parsed JSON after auto-fixing.")
-                    return data
-                except json.JSONDecodeError:
-                    logging.error(f"Auto-fixing JSON failed. Final attempt failed for string: '{json_str[:250]}...'")
-                    return {"spoken_response": raw_text, "internal_thought": "(JSON 提取後解析失敗)"}
-        
+
+        # 與串流的 SpokenResponseStreamExtractor 一致：優先採用含 spoken_response 的物件
+        data = extract_json(raw_text, expected_type=dict, required_keys=("spoken_response",))
+        if data is not None:
+            logging.info("Successfully parsed structured JSON output.")
+            return data
+
         logging.warning(f"No valid JSON object found in LLM response.")
-        return {"spoken_response": raw_text, "internal_thought": "(未找到有效的JSON物件)"}
\ No newline at end of file
+        return {"spoken_response": raw_text, "internal_thought": "(未找到有效的JSON物件)"}
+
+def build_llm_service(db_manager, api_key: str, model_name: str,
+                      rate_limiter: Optional[RateLimiter] = None) -> LLMService:
+    """
+    組裝應用程式使用的 LLM 服務 (含分析快取、排程、速率限制與非同步可靠性層)。
+    啟用 LLM_ROUTER_ENABLED 時以 AVAILABLE_LLM_MODELS 建立多模型路由，各後端共用快取、排程與速率限制。
+    main 與重新初始化時共用；rate_limiter 應與搜尋服務共用同一個實例。
+    """
+    from services.async_llm_service import AsyncGeminiService
+    from services.model_router import RoutingLLMService
+    shared = {"analysis_cache": AnalysisCache(db_manager), "scheduler": LLMScheduler(),
+              "rate_limiter": rate_limiter or RateLimiter(db_manager)}
+    model_names = [model_name] + [name for name in config.AVAILABLE_LLM_MODELS if name != model_name]
+    if not config.LLM_ROUTER_ENABLED or len(model_names) < 2:
+        return AsyncGeminiService(api_key=api_key, model_name=model_name, **shared)
+    backends = {name: AsyncGeminiService(api_key=api_key, model_name=name, **shared) for name in model_names}
+    return RoutingLLMService(backends, preferred_model=model_name)
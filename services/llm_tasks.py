@@ -0,0 +1,54 @@
+# services/llm_tasks.py
+from typing import Dict, Any, Optional
+
+import config
+
+# 模型分級 (實際模型名稱見 config.LLM_TIER_MODELS)
+TIER_CHAT = "chat"  # 使用者選擇的對話模型
+TIER_LITE = "lite"  # 便宜快速的輕量模型，用於背景與分析工作
+
+# 具名任務；呼叫 LLMService.generate_content 時放在 prompt_details["task"]
+TASK_CHAT = "chat"
+TASK_TOOL_FOLLOWUP = "tool_followup"
+TASK_EMOTION_ANALYSIS = "emotion_analysis"
+TASK_EVENT_APPRAISAL = "event_appraisal"
+TASK_USER_TEXT_LEARNING = "user_text_learning"
+TASK_PET_TEXT_LEARNING = "pet_text_learning"
+TASK_THOUGHT_REFLECTION = "thought_reflection"
+TASK_CORRECTION_ANALYSIS = "correction_analysis"
+TASK_REGULATION_THOUGHT = "regulation_thought"
+TASK_MEMORY_SUMMARY = "memory_summary"
+TASK_CONVERSATION_SUMMARY = "conversation_summary"
+
+# 各任務的預設生成參數；呼叫端提供的 generation_config 會覆蓋同名的鍵
+TASK_GENERATION_DEFAULTS: Dict[str, Dict[str, Any]] = {
+    TASK_CHAT: {},
+    TASK_TOOL_FOLLOWUP: {},
+    TASK_EMOTION_ANALYSIS: {"temperature": 0.1, "max_output_tokens": 500},
+    TASK_EVENT_APPRAISAL: {"temperature": 0.2, "max_output_tokens": 200},
+    TASK_USER_TEXT_LEARNING: {"temperature": 0.3, "max_output_tokens": 1000},
+    TASK_PET_TEXT_LEARNING: {"temperature": 0.3, "max_output_tokens": 600},
+    TASK_THOUGHT_REFLECTION: {"temperature": 0.4, "max_output_tokens": 600},
+    TASK_CORRECTION_ANALYSIS: {"temperature": 0.2, "max_output_tokens": 300},
+    TASK_REGULATION_THOUGHT: {"temperature": 0.6, "max_output_tokens": 50},
+    TASK_MEMORY_SUMMARY: {"temperature": 0.5, "max_output_tokens": 300},
+    TASK_CONVERSATION_SUMMARY: {"temperature": 0.3, "max_output_tokens": 600},
+}
+
+
+def task_tier(task: Optional[str]) -> str:
+    """任務使用的模型分級；未列出的任務使用對話模型"""
+    return config.LLM_TASK_TIERS.get(task or TASK_CHAT, TIER_CHAT)
+
+
+def model_name_for_task(task: Optional[str], chat_model_name: str) -> str:
+    """任務實際使用的模型名稱；對話分級 (或未設定模型的分級) 使用 chat_model_name"""
+    tier = task_tier(task)
+    if tier == TIER_CHAT:
+        return chat_model_name
+    return config.LLM_TIER_MODELS.get(tier) or chat_model_name
+
+
+def task_generation_config(task: Optional[str], overrides: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """合併任務的預設生成參數與呼叫端的覆寫值"""
+    return {**TASK_GENERATION_DEFAULTS.get(task or TASK_CHAT, {}), **(overrides or {})}
@@ -0,0 +1,351 @@
+# services/local_knowledge_service.py
+import re
+import json
+import time
+import logging
+import threading
+from typing import Dict, Any, Optional, List, Iterable, Set
+
+import config
+from database import DatabaseManager
+from services.base_services import SearchService
+from services.search_cache import classify_query, normalize_for_matching, QUERY_CLASS_GENERAL
+
+SOURCE_SEARCH = "search"        # 網路搜尋取得的結果
+SOURCE_FACT = "fact"            # 學到的使用者資訊 (TRAIT_TYPE_USER_INFO，含糾正)
+SOURCE_NEWS = "news"            # 每日新聞等記憶摘要 (TRAIT_TYPE_KEY_MEMORY_SUMMARY)
+SOURCE_DOCUMENT = "document"    # 使用者匯入的文件
+
+_CJK_RUN = re.compile(r"[぀-ヿ㐀-䶿一-鿿]+")
+_WORD = re.compile(r"[a-z0-9]+")
+_RESULT_FIELD = re.compile(r"^(標題|摘要|連結):\s*(.*)$", re.MULTILINE)
+
+
+def knowledge_terms(text: str) -> List[str]:
+    """
+    索引與查詢共用的詞彙切分：中日文連續字串切成重疊的雙字詞 (單字時保留單字)，
+    其他文字取英數單字。FTS5 的 unicode61 分詞器會把整段中文當成一個詞，因此預先切好再以空白分隔。
+    """
+    normalized = normalize_for_matching(text)
+    terms: List[str] = []
+    for run in _CJK_RUN.findall(normalized):
+        terms.extend([run] if len(run) == 1 else [run[i:i + 2] for i in range(len(run) - 1)])
+    terms.extend(_WORD.findall(normalized))
+    return terms
+
+
+def term_coverage(query: str, doc_terms: Set[str]) -> float:
+    """
+    查詢被文件涵蓋的比例：中日文以字為單位 (任一個包含該字的雙字詞出現在文件中即算涵蓋)，
+    英數以單字為單位。比直接計算雙字詞的比例寬鬆，自然問句中跨詞的雙字詞 (如「咪指」) 不會拉低分數。
+    """
+    normalized = normalize_for_matching(query)
+    covered, total = 0, 0
+    for run in _CJK_RUN.findall(normalized):
+        if len(run) == 1:
+            total += 1
+            covered += run in doc_terms
+            continue
+        bigram_hits = [run[i:i + 2] in doc_terms for i in range(len(run) - 1)]
+        for i in range(len(run)):
+            total += 1
+            covered += (i > 0 and bigram_hits[i - 1]) or (i < len(run) - 1 and bigram_hits[i])
+    for word in _WORD.findall(normalized):
+        total += 1
+        covered += word in doc_terms
+    return covered / total if total else 0.0
+
+
+def make_snippet(body: str, query_terms: Iterable[str], width: int = config.LOCAL_KNOWLEDGE_SNIPPET_CHARS) -> str:
+    """從本文中擷取涵蓋最多查詢詞的一段文字，被截斷的一側加上省略號"""
+    body = " ".join(body.split())
+    if len(body) <= width:
+        return body
+    lowered = body.lower()
+    positions = sorted((pos, term) for term in set(query_terms) for pos in _find_all(lowered, term))
+    best_start, best_count = 0, -1
+    for pos, _ in positions:
+        start = max(0, min(pos - width // 4, len(body) - width))
+        covered = {term for other, term in positions if start <= other and other + len(term) <= start + width}
+        if len(covered) > best_count:
+            best_start, best_count = start, len(covered)
+    snippet = body[best_start:best_start + width]
+    return ("…" if best_start > 0 else "") + snippet + ("…" if best_start + width < len(body) else "")
+
+
+def _find_all(text: str, term: str) -> List[int]:
+    positions, start = [], text.find(term)
+    while start != -1 and len(positions) < 20:
+        positions.append(start)
+        start = text.find(term, start + 1)
+    return positions
+
+
+class LocalKnowledgeSearchService(SearchService):
+    """
+    以 SQLite FTS5 建立的本地知識庫搜尋 (bm25 排序、片段擷取)，不需網路也不消耗配額。
+
+    內容來源：網路搜尋的結果、學到的使用者資訊 (含糾正)、每日新聞摘要，以及使用者匯入的文件。
+    只有查詢詞有足夠比例 (LOCAL_KNOWLEDGE_MIN_COVERAGE) 出現在文件中才算命中；
+    新聞與天氣類查詢只接受在該類別快取 TTL 內更新過的文件，網路搜尋的結果最多使用
+    LOCAL_KNOWLEDGE_SEARCH_MAX_AGE_SECONDS，之後改為重新搜尋。
+    網路搜尋結果每寫入一批就修剪一次：刪除過期的，並只保留最新的 LOCAL_KNOWLEDGE_MAX_SEARCH_DOCUMENTS 筆。
+    """
+
+    def __init__(self, db_manager: DatabaseManager):
+        self.db = db_manager
+        self._enabled = db_manager.has_knowledge_index()
+        self._versions: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+        self.stats = {"queries": 0, "hits": 0, "indexed": 0, "pruned": 0}
+        self._search_writes_since_prune = 0
+
+    @property
+    def is_enabled(self) -> bool:
+        return self._enabled
+
+    # --- 查詢 ---
+    def lookup(self, query: str, num_results: int = 3) -> List[Dict[str, Any]]:
+        """返回命中的文件 (已依 bm25 排序並通過覆蓋率與新鮮度檢查)，每筆附帶 snippet"""
+        if not self._enabled:
+            return []
+        terms = list(dict.fromkeys(knowledge_terms(query)))
+        if not terms:
+            return []
+        with self._lock:
+            self.stats["queries"] += 1
+        match_expression = " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        rows = self.db.search_knowledge_documents(match_expression, limit=max(num_results * 4, 10))
+
+        query_class = classify_query(query)
+        max_age = None if query_class == QUERY_CLASS_GENERAL else config.SEARCH_CACHE_TTL_SECONDS[query_class]
+        now = time.time()
+        hits = []
+        for row in rows:
+            row_max_age = max_age
+            if row["source"] == SOURCE_SEARCH:
+                row_max_age = min(max_age or config.LOCAL_KNOWLEDGE_SEARCH_MAX_AGE_SECONDS,
+                                  config.LOCAL_KNOWLEDGE_SEARCH_MAX_AGE_SECONDS)
+            if row_max_age is not None and now - float(row["updated_at"] or 0) > row_max_age:
+                continue
+            doc_terms = set(row["title_terms"].split()) | set(row["body_terms"].split())
+            if term_coverage(query, doc_terms) < config.LOCAL_KNOWLEDGE_MIN_COVERAGE:
+                continue
+            row["snippet"] = make_snippet(row["body"], terms)
+            hits.append(row)
+            if len(hits) >= num_results:
+                break
+        if hits:
+            with self._lock:
+                self.stats["hits"] += 1
+        return hits
+
+    def search(self, query: str, num_results: int = 3) -> Dict[str, Any]:
+        if not self._enabled:
+            return {"error": "Local knowledge base is unavailable (SQLite FTS5 missing)."}
+        hits = self.lookup(query, num_results)
+        results = [f"標題: {hit['title']}\n摘要: {hit['snippet']}\n連結: {hit['link'] or '(本地知識庫: ' + hit['source'] + ')'}"
+                   for hit in hits]
+        return {"results": results, "source": "local_knowledge"}
+
+    # --- 建立索引 ---
+    def _index(self, docs: List[Dict[str, Any]]) -> int:
+        if not self._enabled or not docs:
+            return 0
+        for doc in docs:
+            doc["title_terms"] = " ".join(knowledge_terms(doc["title"]))
+            doc["body_terms"] = " ".join(knowledge_terms(doc["body"]))
+        written = self.db.upsert_knowledge_documents(docs)
+        with self._lock:
+            self.stats["indexed"] += written
+            for doc in docs:
+                self._versions.setdefault(doc["source"], {})[doc["doc_key"]] = doc["updated_at"]
+        return written
+
+    def _known_versions(self, source: str) -> Dict[str, float]:
+        with self._lock:
+            if source not in self._versions:
+                self._versions[source] = self.db.load_knowledge_document_versions(source)
+            return dict(self._versions[source])
+
+    def index_search_results(self, query: str, results: List[str], fetched_at: Optional[float] = None) -> int:
+        """把 Google 搜尋結果 (標題/摘要/連結 格式) 加入知識庫，以連結 (或查詢+標題) 為鍵"""
+        fetched_at = fetched_at or time.time()
+        docs = []
+        for result in results:
+            fields = {name: value.strip() for name, value in _RESULT_FIELD.findall(result)}
+            title, body = fields.get("標題") or query, fields.get("摘要") or result
+            link = fields.get("連結") if fields.get("連結") not in (None, "", "#") else None
+            docs.append({"doc_key": f"{SOURCE_SEARCH}:{link or query + '|' + title}", "source": SOURCE_SEARCH,
+                         "title": title, "body": f"{body}\n(搜尋: {query})", "link": link, "updated_at": fetched_at})
+        written = self._index(docs)
+        with self._lock:
+            self._search_writes_since_prune += written
+            should_prune = self._search_writes_since_prune >= 50
+            if should_prune:
+                self._search_writes_since_prune = 0
+        if should_prune:
+            self.prune_search_documents()
+        return written
+
+    def prune_search_documents(self) -> int:
+        """刪除超過 LOCAL_KNOWLEDGE_SEARCH_MAX_AGE_SECONDS 的網路搜尋結果，並只保留最新的 LOCAL_KNOWLEDGE_MAX_SEARCH_DOCUMENTS 筆"""
+        if not self._enabled:
+            return 0
+        removed = self.db.prune_knowledge_documents(SOURCE_SEARCH, config.LOCAL_KNOWLEDGE_MAX_SEARCH_DOCUMENTS,
+                                                    time.time() - config.LOCAL_KNOWLEDGE_SEARCH_MAX_AGE_SECONDS)
+        if removed:
+            with self._lock:
+                self.stats["pruned"] += removed
+                self._versions.pop(SOURCE_SEARCH, None)  # 下次需要時從資料庫重新載入
+            logging.info(f"LocalKnowledge: pruned {removed} old search results.")
+        return removed
+
+    def sync_search_cache(self) -> int:
+        """
+        把 SQLite search_cache 中仍在保留期內的搜尋結果補進知識庫。
+        新的搜尋結果由 LocalFirstSearchService 即時索引，這裡只補上比已索引的最新結果更新的快取
+        (第一次啟用知識庫時會全部補上)。
+        """
+        watermark = max(self._known_versions(SOURCE_SEARCH).values(), default=0.0)
+        rows = self.db.load_recent_search_cache_entries(time.time() - config.SEARCH_CACHE_STALE_GRACE_SECONDS,
+                                                        config.SEARCH_CACHE_MAX_DB_ENTRIES)
+        indexed = 0
+        for row in rows:
+            created_at = float(row.get("created_at") or 0)
+            try:
+                results = json.loads(row["result_json"]).get("results", [])
+            except (json.JSONDecodeError, AttributeError):
+                continue
+            if results and created_at > watermark:
+                indexed += self.index_search_results(row["query"], results, fetched_at=created_at)
+        self.prune_search_documents()
+        return indexed
+
+    def sync_characteristics(self, characteristics: Iterable[Dict[str, Any]]) -> int:
+        """
+        把學到的使用者資訊與記憶摘要特徵加入知識庫；只重新索引新增或更新過的項目。
+        characteristics 為 individual_characteristics 的資料列。
+        """
+        sources = {config.TRAIT_TYPE_USER_INFO: SOURCE_FACT, config.TRAIT_TYPE_KEY_MEMORY_SUMMARY: SOURCE_NEWS}
+        docs = []
+        for char in characteristics:
+            source = sources.get(char.get("trait_type"))
+            if not source or not char.get("trait_value"):
+                continue
+            doc_key = f"{source}:{char['trait_id']}"
+            updated_at = float(char.get("last_reinforced_timestamp") or char.get("creation_timestamp") or 0)
+            if self._known_versions(source).get(doc_key, -1) >= updated_at:
+                continue
+            title = char.get("trait_key") or ("使用者資訊" if source == SOURCE_FACT else "記憶摘要")
+            docs.append({"doc_key": doc_key, "source": source, "title": title, "body": char["trait_value"],
+                         "link": None, "updated_at": updated_at})
+        return self._index(docs)
+
+    def import_document(self, title: str, text: str) -> int:
+        """匯入一份文件：依段落切成不超過 LOCAL_KNOWLEDGE_CHUNK_CHARS 的片段分別索引，返回片段數"""
+        chunks: List[str] = []
+        current = ""
+        for paragraph in (p.strip() for p in re.split(r"\n\s*\n", text)):
+            if not paragraph:
+                continue
+            if current and len(current) + len(paragraph) + 1 > config.LOCAL_KNOWLEDGE_CHUNK_CHARS:
+                chunks.append(current)
+                current = ""
+            while len(paragraph) > config.LOCAL_KNOWLEDGE_CHUNK_CHARS:
+                chunks.append(paragraph[:config.LOCAL_KNOWLEDGE_CHUNK_CHARS])
+                paragraph = paragraph[config.LOCAL_KNOWLEDGE_CHUNK_CHARS:]
+            current = f"{current}\n{paragraph}" if current else paragraph
+        if current:
+            chunks.append(current)
+        now = time.time()
+        docs = [{"doc_key": f"{SOURCE_DOCUMENT}:{title}:{idx}", "source": SOURCE_DOCUMENT,
+                 "title": f"{title} ({idx + 1}/{len(chunks)})" if len(chunks) > 1 else title,
+                 "body": chunk, "link": None, "updated_at": now} for idx, chunk in enumerate(chunks)]
+        written = self._index(docs)
+        logging.info(f"LocalKnowledge: imported '{title}' as {written} chunks.")
+        return written
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        stats["documents"] = self.db.count_knowledge_documents() if self._enabled else {}
+        return stats
+
+
+class LocalFirstSearchService(SearchService):
+    """
+    先查本地知識庫，沒有命中才呼叫遠端搜尋服務；遠端成功的結果會加入知識庫。
+    遠端失敗 (未設定、配額用盡、API 錯誤) 時，若本地有相關度較低的結果則以其代替。
+    is_enabled 反映遠端 (網路搜尋) 是否可用，與既有的呼叫端語意相同。
+    """
+
+    def __init__(self, local: LocalKnowledgeSearchService, remote: Optional[SearchService]):
+        self.local = local
+        self.remote = remote
+        self.rate_limiter = getattr(remote, "rate_limiter", None)
+        self.stats = {"local_hits": 0, "remote": 0, "local_fallbacks": 0}
+        self._lock = threading.Lock()
+
+    @property
+    def is_enabled(self) -> bool:
+        return bool(self.remote and self.remote.is_enabled)
+
+    def _bump(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def search(self, query: str, num_results: int = 3) -> Dict[str, Any]:
+        return self.search_many([query], num_results=num_results)[0]
+
+    def search_many(self, queries: List[str], num_results: int = 3) -> List[Dict[str, Any]]:
+        results: List[Optional[Dict[str, Any]]] = [None] * len(queries)
+        misses: List[int] = []
+        for idx, query in enumerate(queries):
+            local = self.local.search(query, num_results) if self.local.is_enabled else {"results": []}
+            if local.get("results"):
+                self._bump("local_hits")
+                results[idx] = local
+            else:
+                misses.append(idx)
+        if not misses:
+            return results
+
+        if self.remote:
+            remote_results = self.remote.search_many([queries[idx] for idx in misses], num_results=num_results)
+        else:
+            remote_results = [{"error": "Search service is not enabled."}] * len(misses)
+        for idx, remote in zip(misses, remote_results):
+            self._bump("remote")
+            if not remote.get("error"):
+                self.local.index_search_results(queries[idx], remote.get("results", []))
+                results[idx] = remote
+                continue
+            fallback = self._loose_local_results(queries[idx], num_results)
+            if fallback:
+                self._bump("local_fallbacks")
+                results[idx] = {"results": fallback, "source": "local_knowledge",
+                                "note": f"網路搜尋失敗 ({remote['error']})，以下為本地知識庫中相關度較低的結果。"}
+            else:
+                results[idx] = remote
+        return results
+
+    def _loose_local_results(self, query: str, num_results: int) -> List[str]:
+        """遠端失敗時放寬覆蓋率門檻再查一次本地知識庫"""
+        if not self.local.is_enabled:
+            return []
+        terms = list(dict.fromkeys(knowledge_terms(query)))
+        if not terms:
+            return []
+        match_expression = " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        rows = self.local.db.search_knowledge_documents(match_expression, limit=num_results)
+        return [f"標題: {row['title']}\n摘要: {make_snippet(row['body'], terms)}\n連結: {row['link'] or '(本地知識庫)'}"
+                for row in rows]
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        stats["local"] = self.local.get_stats()
+        if hasattr(self.remote, "get_stats"):
+            stats["remote_cache"] = self.remote.get_stats()
+        return stats
@@ -0,0 +1,267 @@
+# services/model_router.py
+import time
+import logging
+import threading
+import concurrent.futures
+from collections import deque
+from typing import Dict, Any, Optional, List, Callable
+
+import config
+from services.base_services import LLMService
+from services.llm_scheduler import LLMRequestDropped, PRIORITY_INTERACTIVE, current_priority
+from services.llm_tasks import TIER_CHAT, task_tier
+from services.rate_limiter import RateLimitExceeded
+from services.resilience import CircuitOpenError, is_retryable_error
+from services.worker_pool import worker_pools
+
+
+def should_fail_over(error: BaseException) -> bool:
+    """判斷錯誤是否與特定模型有關，值得改用其他模型重送"""
+    if isinstance(error, LLMRequestDropped):
+        return False  # 是本地佇列捨棄了請求，換模型只會增加負載
+    if isinstance(error, (RateLimitExceeded, CircuitOpenError, TimeoutError)):
+        return True  # 每個模型有各自的配額與斷路器
+    return is_retryable_error(error)
+
+
+class ModelHealth:
+    """單一模型最近 N 次呼叫的延遲與成功率，以及連續失敗後的冷卻期"""
+
+    def __init__(self, window: int = config.LLM_ROUTER_STATS_WINDOW):
+        self._samples: deque = deque(maxlen=window)  # (latency_ms, ok)
+        self._lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def record(self, latency_ms: float, ok: bool):
+        with self._lock:
+            self._samples.append((latency_ms, ok))
+            if ok:
+                self.consecutive_failures = 0
+                return
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= config.LLM_ROUTER_COOLDOWN_FAILURES:
+                self.cooldown_until = time.monotonic() + config.LLM_ROUTER_COOLDOWN_SECONDS
+
+    @property
+    def sample_count(self) -> int:
+        return len(self._samples)
+
+    def error_rate(self) -> float:
+        with self._lock:
+            if not self._samples:
+                return 0.0
+            return sum(1 for _, ok in self._samples if not ok) / len(self._samples)
+
+    def latency_percentile(self, q: float) -> Optional[float]:
+        """成功呼叫的延遲百分位數 (毫秒)；沒有樣本時返回 None"""
+        with self._lock:
+            latencies = sorted(latency for latency, ok in self._samples if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def is_healthy(self) -> bool:
+        if time.monotonic() < self.cooldown_until:
+            return False
+        return not (self.sample_count >= 5 and self.error_rate() > config.LLM_ROUTER_MAX_ERROR_RATE)
+
+    def snapshot(self) -> Dict[str, Any]:
+        p50, p90 = self.latency_percentile(0.5), self.latency_percentile(0.9)
+        return {
+            "samples": self.sample_count,
+            "error_rate": round(self.error_rate(), 3),
+            "p50_ms": round(p50) if p50 is not None else None,
+            "p90_ms": round(p90) if p90 is not None else None,
+            "healthy": self.is_healthy(),
+        }
+
+
+class _StreamGate:
+    """讓同一個請求的多次嘗試 (切換模型、對沖) 中只有第一個開始串流的嘗試能輸出文字"""
+
+    def __init__(self, on_stream: Optional[Callable[[str], None]]):
+        self.on_stream = on_stream
+        self.owner: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def for_attempt(self, attempt_id: str) -> Optional[Callable[[str], None]]:
+        if self.on_stream is None:
+            return None
+
+        def forward(delta: str):
+            with self._lock:
+                if self.owner is None:
+                    self.owner = attempt_id
+                elif self.owner != attempt_id:
+                    return
+            self.on_stream(delta)
+
+        return forward
+
+
+class RoutingLLMService(LLMService):
+    """
+    包裝多個模型後端的路由服務。
+
+    - 偏好使用者選擇的模型，其餘依 AVAILABLE_LLM_MODELS 的順序作為備援；
+    - 記錄每個模型最近的延遲與錯誤率，連續失敗或錯誤率過高的模型暫時排到最後；
+    - 模型相關的錯誤 (逾時、429/5xx、斷路、配額不足) 自動改用下一個模型重送；
+    - 可選的對沖請求：互動請求超過主要模型的 p90 延遲仍未完成 (也未開始串流) 時，
+      同時向下一個模型送出相同請求，採用先完成的結果。
+    只有對話分級的任務會被路由；其他分級 (例如 lite) 的任務與分析類呼叫由主要後端處理。
+    """
+
+    def __init__(self, backends: Dict[str, LLMService], preferred_model: str, hedge_enabled: bool = config.LLM_HEDGE_ENABLED):
+        if not backends:
+            raise ValueError("RoutingLLMService needs at least one backend.")
+        self.backends = backends
+        self.model_name = preferred_model if preferred_model in backends else next(iter(backends))
+        self.hedge_enabled = hedge_enabled
+        self.health: Dict[str, ModelHealth] = {name: ModelHealth() for name in backends}
+        self._executor = worker_pools.get("llm_hedge")
+        self._stats_lock = threading.Lock()
+        self.route_stats = {"requests": 0, "failovers": 0, "hedged": 0, "hedge_wins": 0}
+        logging.info(f"RoutingLLMService initialized with models {list(backends)} (preferred: {self.model_name}).")
+
+    @property
+    def primary(self) -> LLMService:
+        return self.backends[self.model_name]
+
+    def __getattr__(self, name: str):
+        # 相容直接存取主要後端屬性的呼叫端 (例如 scheduler、rate_limiter、analysis_cache)
+        if name in ("backends", "model_name"):
+            raise AttributeError(name)
+        return getattr(self.primary, name)
+
+    def candidate_order(self) -> List[str]:
+        """依偏好排序，不健康的模型移到最後 (仍作為最後手段)"""
+        preferred = [self.model_name] + [name for name in config.AVAILABLE_LLM_MODELS if name != self.model_name]
+        preferred += [name for name in self.backends if name not in preferred]
+        ordered = [name for name in preferred if name in self.backends]
+        return sorted(ordered, key=lambda name: not self.health[name].is_healthy())
+
+    def generate_content(self, prompt_details: Dict[str, Any]) -> Dict[str, Any]:
+        if task_tier(prompt_details.get("task")) != TIER_CHAT:
+            return self.primary.generate_content(prompt_details)  # 各後端的非對話分級都是同一個模型
+        self._bump("requests")
+        gate = _StreamGate(prompt_details.get("on_stream"))
+        order = self.candidate_order()
+        priority = prompt_details.get("priority") or current_priority()
+        attempted: set = set()
+        last_error: Optional[BaseException] = None
+        for name in order:
+            if name in attempted:
+                continue  # 已經作為對沖請求送過
+            attempted.add(name)
+            remaining = [other for other in order if other not in attempted]
+            try:
+                if self.hedge_enabled and remaining and priority == PRIORITY_INTERACTIVE:
+                    return self._generate_hedged(name, remaining[0], prompt_details, gate, attempted)
+                return self._attempt(name, prompt_details, gate.for_attempt(name))
+            except Exception as e:
+                last_error = e
+                remaining = [other for other in order if other not in attempted]
+                if not should_fail_over(e) or not remaining:
+                    break
+                self._bump("failovers")
+                logging.warning(f"LLM router: '{name}' failed ({type(e).__name__}: {e}); failing over to '{remaining[0]}'.")
+        logging.error(f"LLM router: request failed after trying {sorted(attempted)}: {last_error}", exc_info=last_error)
+        return {
+            "internal_thought": f"(API 錯誤: {last_error})",
+            "spoken_response": "哎呀，我的思考迴路短路了...",
+            "error": str(last_error)
+        }
+
+    def _attempt(self, name: str, prompt_details: Dict[str, Any], on_stream: Optional[Callable[[str], None]]) -> Dict[str, Any]:
+        """以指定模型送出一次請求並記錄延遲；失敗時拋出例外"""
+        # 每次嘗試使用自己的 contents 副本：工具呼叫時後端會把模型回應附加到歷史中
+        details = {**prompt_details, "contents": list(prompt_details["contents"]), "on_stream": on_stream}
+        backend = self.backends[name]
+        started = time.monotonic()
+        try:
+            if hasattr(backend, "generate_content_or_raise"):
+                result = backend.generate_content_or_raise(details)
+            else:
+                result = backend.generate_content(details)
+                if result.get("error"):
+                    raise RuntimeError(result["error"])
+        except LLMRequestDropped:
+            raise  # 佇列捨棄與模型健康無關
+        except Exception:
+            self.health[name].record((time.monotonic() - started) * 1000, ok=False)
+            raise
+        self.health[name].record((time.monotonic() - started) * 1000, ok=True)
+        return result
+
+    def _hedge_delay(self, name: str) -> Optional[float]:
+        health = self.health[name]
+        if health.sample_count < config.LLM_HEDGE_MIN_SAMPLES:
+            return None
+        p90_ms = health.latency_percentile(0.9)
+        if p90_ms is None:
+            return None
+        return max(config.LLM_HEDGE_MIN_DELAY_SECONDS, p90_ms / 1000)
+
+    def _generate_hedged(self, primary: str, secondary: str, prompt_details: Dict[str, Any], gate: _StreamGate,
+                         attempted: set) -> Dict[str, Any]:
+        """先送主要模型；超過其 p90 延遲仍未完成且未開始串流時，再向備援模型送出相同請求"""
+        delay = self._hedge_delay(primary)
+        first = self._executor.submit(self._attempt, primary, prompt_details, gate.for_attempt(primary))
+        if delay is None:
+            return first.result()
+        try:
+            return first.result(timeout=delay)
+        except concurrent.futures.TimeoutError:
+            pass
+        if gate.owner is not None:
+            return first.result()  # 使用者已經看到主要模型的文字，不再對沖
+
+        self._bump("hedged")
+        attempted.add(secondary)
+        logging.info(f"LLM router: '{primary}' exceeded its p90 ({delay:.1f}s); hedging with '{secondary}'.")
+        second = self._executor.submit(self._attempt, secondary, prompt_details, gate.for_attempt(secondary))
+        pending = {first: primary, second: secondary}
+        last_error: Optional[BaseException] = None
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                error = future.exception()
+                if error is None:
+                    if name == secondary:
+                        self._bump("hedge_wins")
+                    # 落後的請求仍會在背景完成並計入延遲統計，結果直接丟棄
+                    return future.result()
+                last_error = error
+        raise last_error
+
+    def analyze_text_for_emotions(self, text: str) -> Dict[str, float]:
+        return self.primary.analyze_text_for_emotions(text)
+
+    def appraise_event(self, event_text: str) -> Dict[str, float]:
+        return self.primary.appraise_event(event_text)
+
+    def analyze_texts_for_emotions_batch(self, texts: List[str]) -> List[Dict[str, float]]:
+        return self.primary.analyze_texts_for_emotions_batch(texts)
+
+    def appraise_events_batch(self, event_texts: List[str]) -> List[Dict[str, float]]:
+        return self.primary.appraise_events_batch(event_texts)
+
+    def count_tokens(self, contents: Any) -> Optional[int]:
+        return self.primary.count_tokens(contents)
+
+    def _bump(self, key: str):
+        with self._stats_lock:
+            self.route_stats[key] += 1
+
+    def get_reliability_stats(self) -> Dict[str, Any]:
+        """路由統計、各模型的延遲/錯誤率，以及各後端自己的可靠性統計"""
+        with self._stats_lock:
+            stats: Dict[str, Any] = {"router": dict(self.route_stats)}
+        for name, backend in self.backends.items():
+            model_stats = self.health[name].snapshot()
+            if hasattr(backend, "get_reliability_stats"):
+                model_stats["backend"] = backend.get_reliability_stats()
+            stats[name] = model_stats
+        return stats
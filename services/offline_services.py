@@ -0,0 +1,388 @@
+# services/offline_services.py
+"""
+離線用的錄製/重播/合成後端，用於沒有網路與 API 金鑰時的效能與負載測試。
+
+- record   ：照常呼叫真實 API，並把請求/回應寫入卡帶 (cassette) 檔案；
+- replay   ：依請求的正規化雜湊從卡帶中取回回應，並注入可設定的延遲；
+- synthetic：不需卡帶，依提示內容產生符合 schema 的 JSON 回應。
+
+LLM 的替換發生在 GeminiService 的傳輸層 (_invoke_model)，因此排程器、
+速率限制、分析快取、JSON 解析與串流擷取都會被實際執行。
+"""
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+from types import SimpleNamespace
+from typing import Dict, Any, Optional, List, Callable
+
+import config
+from services.base_services import SearchService
+from services.llm_service import GeminiService
+from services.tokens import estimate_contents_tokens, estimate_tokens
+
+MODE_LIVE = "live"
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+MODE_SYNTHETIC = "synthetic"
+
+# 重播時要遮蔽的易變內容 (提示中的日期時間)，讓不同時間錄製的請求仍能對應
+_VOLATILE_PATTERNS = [
+    re.compile(r"\d{4}[-/年]\d{1,2}[-/月]\d{1,2}日?"),
+    re.compile(r"\d{1,2}:\d{2}(:\d{2})?"),
+    re.compile(r"星期[一二三四五六日天]"),
+]
+
+
+def _normalize_text(text: str) -> str:
+    for pattern in _VOLATILE_PATTERNS:
+        text = pattern.sub("<t>", text)
+    return text
+
+
+def _canonical_contents(contents: Any) -> Any:
+    """把請求內容 (字串、字典或 SDK 物件) 轉成可序列化且穩定的結構"""
+    if contents is None or isinstance(contents, (bool, int, float)):
+        return contents
+    if isinstance(contents, str):
+        return _normalize_text(contents)
+    if isinstance(contents, dict):
+        return {str(k): _canonical_contents(v) for k, v in sorted(contents.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(contents, (list, tuple)):
+        return [_canonical_contents(item) for item in contents]
+    parts = getattr(contents, "parts", None)
+    if parts is not None:
+        return {"role": getattr(contents, "role", ""), "parts": [_canonical_contents(p) for p in parts]}
+    function_call = getattr(contents, "function_call", None)
+    if function_call:
+        return {"function_call": {"name": function_call.name, "args": _canonical_contents(dict(function_call.args))}}
+    text = getattr(contents, "text", None)
+    return _normalize_text(text) if isinstance(text, str) else _normalize_text(str(contents))
+
+
+def canonical_request_hash(kind: str, payload: Dict[str, Any]) -> str:
+    """以正規化後的請求內容計算穩定的 SHA-256 鍵"""
+    canonical = json.dumps({"kind": kind, **_canonical_contents(payload)}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    """以 JSON 檔案保存的請求/回應對照表 (執行緒安全，寫入時以暫存檔原子替換)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f).get("entries", {})
+                logging.info(f"Cassette loaded {len(self._entries)} entries from {path}.")
+            except (OSError, json.JSONDecodeError) as e:
+                logging.error(f"Failed to load cassette {path}: {e}")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            return dict(entry) if entry else None
+
+    def put(self, key: str, entry: Dict[str, Any]):
+        with self._lock:
+            self._entries[key] = entry
+            snapshot = {"version": 1, "entries": dict(self._entries)}
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f"Failed to write cassette {self.path}: {e}")
+
+
+class LatencyModel:
+    """
+    重播時注入的延遲。fixed_ms 為 None 時使用錄製時的延遲乘上 scale；
+    jitter_ms 以請求鍵為種子產生，因此同一請求每次的延遲都相同。
+    """
+
+    def __init__(self, fixed_ms: Optional[float] = None, scale: float = 1.0, jitter_ms: float = 0.0, seed: int = 0):
+        self.fixed_ms = fixed_ms
+        self.scale = scale
+        self.jitter_ms = jitter_ms
+        self.seed = seed
+
+    def delay_seconds(self, key: str, recorded_ms: Optional[float]) -> float:
+        base = self.fixed_ms if self.fixed_ms is not None else (recorded_ms or 0.0) * self.scale
+        jitter = random.Random(f"{self.seed}:{key}").uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0
+        return max(0.0, base + jitter) / 1000.0
+
+
+# --- 回應物件 (模擬 SDK 回應中 GeminiService 用到的屬性) ---
+
+def _fake_response(text: str = "", function_calls: Optional[List[Dict[str, Any]]] = None, total_tokens: Optional[int] = None):
+    if function_calls:
+        parts = [SimpleNamespace(function_call=SimpleNamespace(name=call["name"], args=dict(call.get("args") or {})), text="")
+                 for call in function_calls]
+    else:
+        parts = [SimpleNamespace(function_call=None, text=text)]
+    candidate = SimpleNamespace(content=SimpleNamespace(role="model", parts=parts))
+    return SimpleNamespace(
+        text=text, parts=parts, candidates=[candidate],
+        usage_metadata=SimpleNamespace(total_token_count=total_tokens or 0)
+    )
+
+
+def _serialize_response(response) -> Dict[str, Any]:
+    """把真實回應轉成卡帶可保存的形式"""
+    data: Dict[str, Any] = {"text": "", "function_calls": None, "total_tokens": None}
+    try:
+        calls = [part.function_call for part in response.candidates[0].content.parts if getattr(part, "function_call", None)]
+        if calls:
+            data["function_calls"] = [{"name": call.name, "args": _canonical_contents(dict(call.args))} for call in calls]
+        else:
+            data["text"] = response.text
+    except (AttributeError, IndexError, ValueError) as e:
+        logging.warning(f"Could not serialize LLM response for cassette: {e}")
+    data["total_tokens"] = GeminiService._usage_tokens(response)
+    return data
+
+
+def _prompt_text(contents: Any) -> str:
+    """取出請求中所有文字，用於合成模式判斷提示類型"""
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, dict):
+        if "text" in contents:
+            return str(contents["text"])
+        return _prompt_text(contents.get("parts", []))
+    if isinstance(contents, (list, tuple)):
+        return "\n".join(_prompt_text(item) for item in contents)
+    return str(getattr(contents, "text", "") or "")
+
+
+class SyntheticResponder:
+    """依本專案各類提示的格式要求，產生決定性的、符合 schema 的回應文字"""
+
+    _POSITIVE = sorted(config.POSITIVE_EMOTIONS)
+    _NEGATIVE = sorted(config.NEGATIVE_EMOTIONS)
+
+    def __init__(self, seed: int = 0):
+        self.seed = seed
+
+    def respond(self, key: str, contents: Any) -> str:
+        rng = random.Random(f"{self.seed}:{key}")
+        prompt = _prompt_text(contents)
+        if "`spoken_response`" in prompt:
+            payload: Dict[str, Any] = {
+                "internal_thought": "(合成) 使用者在跟我說話，我想好好回應。",
+                "spoken_response": rng.choice(["嗯嗯，我懂你的意思！", "聽起來很有趣耶～再多說一點嘛！", "原來是這樣呀，謝謝你告訴我。"]),
+            }
+            if "`user_emotions`" in prompt:
+                payload["user_emotions"] = self._emotions(rng)
+                payload["appraisal"] = self._appraisal(rng)
+            return "```json\n" + json.dumps(payload, ensure_ascii=False, indent=2) + "\n```"
+        if "項目編號" in prompt:
+            # 批次分析：每個 [tN] 項目各給一組分數
+            item_ids = re.findall(r"^\[(t\d+)\]", prompt, re.MULTILINE)
+            make = self._appraisal if "評價維度" in prompt else self._emotions
+            return json.dumps({item_id: make(rng) for item_id in item_ids})
+        if "評價維度" in prompt:
+            return json.dumps(self._appraisal(rng))
+        if "情緒列表" in prompt:
+            return json.dumps(self._emotions(rng))
+        if "'summary'" in prompt:
+            return json.dumps({"summary": "(合成) 最近和使用者聊了幾件日常小事。",
+                               "dominant_emotion_of_summary": rng.choice(self._POSITIVE)}, ensure_ascii=False)
+        if "JSON 陣列" in prompt or "JSON陣列" in prompt:
+            return "[]"
+        if "JSON" in prompt:
+            return "{}"
+        return rng.choice(["深呼吸，會沒事的。", "今天也要加油喔！", "我在這裡陪著你。"])
+
+    def _emotions(self, rng: random.Random) -> Dict[str, float]:
+        pool = self._POSITIVE + self._NEGATIVE + ["neutral"]
+        return {name: round(rng.uniform(0.2, 0.9), 2) for name in rng.sample(pool, rng.randint(1, 3))}
+
+    def _appraisal(self, rng: random.Random) -> Dict[str, float]:
+        signed = {"pleasantness", "goal_conduciveness"}
+        return {dim: round(rng.uniform(-1.0 if dim in signed else 0.0, 1.0), 2) for dim in config.APPRAISAL_DIMENSIONS}
+
+
+class CassetteGeminiService(GeminiService):
+    """
+    以卡帶或合成回應取代 Gemini 傳輸層的 LLM 服務。
+
+    Args:
+        mode: record / replay / synthetic。
+        cassette: record 與 replay 模式使用的卡帶。
+        latency: replay 與 synthetic 模式注入的延遲。
+        fallback_to_synthetic: replay 找不到對應請求時改用合成回應 (否則拋出 KeyError)。
+    """
+
+    def __init__(self, mode: str, model_name: str, cassette: Optional[Cassette] = None,
+                 api_key: Optional[str] = None, latency: Optional[LatencyModel] = None,
+                 fallback_to_synthetic: bool = True, seed: int = 0, **service_kwargs):
+        if mode not in (MODE_RECORD, MODE_REPLAY, MODE_SYNTHETIC):
+            raise ValueError(f"Unsupported offline LLM mode: {mode}")
+        if mode in (MODE_RECORD, MODE_REPLAY) and cassette is None:
+            raise ValueError(f"Mode '{mode}' requires a cassette.")
+        # 離線模式不會送出請求，金鑰只用於建立 SDK 的模型物件
+        super().__init__(api_key=api_key or "offline", model_name=model_name, **service_kwargs)
+        self.mode = mode
+        self.cassette = cassette
+        self.latency = latency or LatencyModel(fixed_ms=0.0)
+        self.fallback_to_synthetic = fallback_to_synthetic
+        self.responder = SyntheticResponder(seed)
+        self.stats = {"recorded": 0, "replayed": 0, "misses": 0, "synthetic": 0}
+        logging.info(f"CassetteGeminiService running in '{mode}' mode.")
+
+    def count_tokens(self, contents: Any) -> Optional[int]:
+        if self.mode == MODE_RECORD:
+            return super().count_tokens(contents)
+        return None
+
+    def _invoke_model(self, model, contents: Any, timeout: Optional[float] = None,
+                      on_chunk: Optional[Callable[[str], None]] = None, **kwargs):
+        key = canonical_request_hash("llm", {
+            "model": self._model_name_of(model), "contents": contents,
+            "generation_config": kwargs.get("generation_config"), "tools": bool(kwargs.get("tools")),
+        })
+
+        if self.mode == MODE_RECORD:
+            started = time.monotonic()
+            response = super()._invoke_model(model, contents, timeout=timeout, on_chunk=on_chunk, **kwargs)
+            entry = _serialize_response(response)
+            entry["latency_ms"] = round((time.monotonic() - started) * 1000, 1)
+            entry["model"] = self._model_name_of(model)
+            entry["prompt_preview"] = _prompt_text(contents)[-200:]
+            self.cassette.put(key, entry)
+            self.stats["recorded"] += 1
+            return response
+
+        entry = self.cassette.get(key) if self.mode == MODE_REPLAY else None
+        if entry is not None:
+            self.stats["replayed"] += 1
+        else:
+            if self.mode == MODE_REPLAY:
+                self.stats["misses"] += 1
+                if not self.fallback_to_synthetic:
+                    raise KeyError(f"No cassette entry for LLM request {key[:12]}.")
+                logging.debug(f"Cassette miss for LLM request {key[:12]}; using synthetic response.")
+            self.stats["synthetic"] += 1
+            text = self.responder.respond(key, contents)
+            entry = {"text": text, "function_calls": None, "latency_ms": None,
+                     "total_tokens": estimate_contents_tokens(contents) + estimate_tokens(text)}
+
+        delay = self.latency.delay_seconds(key, entry.get("latency_ms"))
+        text = entry.get("text") or ""
+        if on_chunk and text:
+            self._stream_text(text, delay, on_chunk)
+        else:
+            time.sleep(delay)
+        # 舊版卡帶只記錄第一個工具呼叫 (function_call)
+        function_calls = entry.get("function_calls") or ([entry["function_call"]] if entry.get("function_call") else None)
+        return _fake_response(text, function_calls, entry.get("total_tokens"))
+
+    @staticmethod
+    def _stream_text(text: str, delay: float, on_chunk: Callable[[str], None], chunk_chars: int = 24):
+        """模擬串流：約 30% 的延遲後送出第一塊，其餘平均分布"""
+        chunks = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+        time.sleep(delay * 0.3)
+        step = (delay * 0.7) / max(1, len(chunks) - 1)
+        for idx, chunk in enumerate(chunks):
+            if idx:
+                time.sleep(step)
+            on_chunk(chunk)
+
+
+class CassetteSearchService(SearchService):
+    """以卡帶或合成結果取代 Google Custom Search 的搜尋服務"""
+
+    def __init__(self, mode: str, cassette: Optional[Cassette] = None, inner: Optional[SearchService] = None,
+                 latency: Optional[LatencyModel] = None, fallback_to_synthetic: bool = True, seed: int = 0):
+        if mode not in (MODE_RECORD, MODE_REPLAY, MODE_SYNTHETIC):
+            raise ValueError(f"Unsupported offline search mode: {mode}")
+        if mode == MODE_RECORD and (inner is None or cassette is None):
+            raise ValueError("Record mode requires both a cassette and a live search service.")
+        if mode == MODE_REPLAY and cassette is None:
+            raise ValueError("Replay mode requires a cassette.")
+        self.mode = mode
+        self.cassette = cassette
+        self.inner = inner
+        self.latency = latency or LatencyModel(fixed_ms=0.0)
+        self.fallback_to_synthetic = fallback_to_synthetic
+        self.seed = seed
+        self.rate_limiter = getattr(inner, "rate_limiter", None)
+        self.stats = {"recorded": 0, "replayed": 0, "misses": 0, "synthetic": 0}
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.mode != MODE_RECORD or bool(getattr(self.inner, "is_enabled", False))
+
+    def search(self, query: str, num_results: int = 3) -> Dict[str, Any]:
+        key = canonical_request_hash("search", {"query": " ".join(query.split()).lower(), "num": num_results})
+        if self.mode == MODE_RECORD:
+            started = time.monotonic()
+            result = self.inner.search(query, num_results=num_results)
+            if not result.get("error"):
+                self.cassette.put(key, {"query": query, "result": result,
+                                        "latency_ms": round((time.monotonic() - started) * 1000, 1)})
+                self.stats["recorded"] += 1
+            return result
+
+        entry = self.cassette.get(key) if self.mode == MODE_REPLAY else None
+        if entry is not None:
+            self.stats["replayed"] += 1
+            result, recorded_ms = entry["result"], entry.get("latency_ms")
+        else:
+            if self.mode == MODE_REPLAY:
+                self.stats["misses"] += 1
+                if not self.fallback_to_synthetic:
+                    return {"error": f"No cassette entry for search '{query}'."}
+            self.stats["synthetic"] += 1
+            result, recorded_ms = self._synthetic_result(key, query, num_results), None
+        time.sleep(self.latency.delay_seconds(key, recorded_ms))
+        return result
+
+    def _synthetic_result(self, key: str, query: str, num_results: int) -> Dict[str, Any]:
+        rng = random.Random(f"{self.seed}:{key}")
+        results: List[str] = []
+        for idx in range(num_results):
+            results.append(
+                f"標題: 關於「{query}」的資料 {idx + 1}\n"
+                f"摘要: (合成) 這是與 {query} 相關的第 {idx + 1} 筆摘要，編號 {rng.randint(1000, 9999)}。\n"
+                f"連結: https://example.com/{key[:8]}/{idx + 1}"
+            )
+        return {"results": results}
+
+
+def build_offline_services(mode: str, db_manager, model_name: str, cassette_dir: str,
+                           api_key: Optional[str] = None, live_search: Optional[SearchService] = None,
+                           latency: Optional[LatencyModel] = None, rate_limiter=None):
+    """
+    依模式組裝離線用的 (llm_service, search_service)。
+    LLM 服務仍包含分析快取、排程器與速率限制，與正式環境的組裝方式相同。
+    """
+    from services.analysis_cache import AnalysisCache
+    from services.llm_scheduler import LLMScheduler
+    from services.rate_limiter import RateLimiter
+
+    llm_cassette = Cassette(os.path.join(cassette_dir, "llm_cassette.json")) if mode != MODE_SYNTHETIC else None
+    search_cassette = Cassette(os.path.join(cassette_dir, "search_cassette.json")) if mode != MODE_SYNTHETIC else None
+    llm_service = CassetteGeminiService(
+        mode, model_name=model_name, cassette=llm_cassette, api_key=api_key, latency=latency,
+        analysis_cache=AnalysisCache(db_manager), scheduler=LLMScheduler(),
+        rate_limiter=rate_limiter or RateLimiter(db_manager)
+    )
+    search_service = CassetteSearchService(mode, cassette=search_cassette, inner=live_search, latency=latency)
+    return llm_service, search_service
@@ -0,0 +1,336 @@
+# services/rate_limiter.py
+import json
+import time
+import logging
+import threading
+from datetime import date
+from typing import Dict, Any, Optional, List, Tuple
+
+import config
+from services.llm_scheduler import current_priority, PRIORITY_INTERACTIVE
+
+
+class RateLimitExceeded(RuntimeError):
+    """目前沒有足夠的額度，且呼叫端不願 (或不能) 再等待"""
+
+
+class TokenBucket:
+    """
+    權杖桶：容量為 capacity，每秒補充 refill_per_second。
+    允許餘額暫時變成負數 (實際用量超出預估時的對帳)，之後會自然補回。
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill_locked(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.refill_per_second)
+        self._updated_at = now
+
+    def try_consume(self, amount: float) -> float:
+        """嘗試扣除 amount；成功返回 0，否則返回需要再等待的秒數 (不扣除)"""
+        amount = min(amount, self.capacity)  # 超過容量的單筆請求只需等到桶滿
+        with self._lock:
+            self._refill_locked()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            if self.refill_per_second <= 0:
+                return float("inf")
+            return (amount - self._tokens) / self.refill_per_second
+
+    def adjust(self, delta: float):
+        """對帳：delta > 0 表示退還，delta < 0 表示補扣"""
+        with self._lock:
+            self._refill_locked()
+            self._tokens = min(self.capacity, self._tokens + delta)
+
+    @property
+    def available(self) -> float:
+        with self._lock:
+            self._refill_locked()
+            return self._tokens
+
+
+class LLMReservation:
+    """一次 LLM 請求預先扣除的額度，回應返回後以實際用量對帳"""
+
+    def __init__(self, model_name: str, estimated_tokens: int):
+        self.model_name = model_name
+        self.estimated_tokens = estimated_tokens
+
+
+class RateLimiter:
+    """
+    共用的速率限制與配額記帳。
+
+    - 每個模型有 RPM 與 TPM 兩個權杖桶，以及每日請求數 (RPD) 計數；
+      請求前以預估 token 數預扣，回應後以 usage_metadata 的實際數字對帳。
+    - 搜尋 API 有 RPM 權杖桶與每日配額，並保留一部分每日配額給互動請求；
+      計數沿用 SETTING_SEARCH_API_CALL_COUNT / SETTING_SEARCH_API_LAST_RESET_DATE。
+      搜尋快取省下的呼叫 (命中、近似查詢、併發合併、過期結果) 另外記在每日統計中。
+    - 每日計數寫入 app_state，重新啟動後仍然有效；寫入在鎖外進行，LLM 用量與快取統計
+      最多每 RATE_LIMIT_PERSIST_INTERVAL_SECONDS 寫一次 (關閉時呼叫 flush() 寫入最新數字)。
+    - 互動請求會在 max_wait 內等待額度；背景請求等不到時直接捨棄 (RateLimitExceeded)。
+    """
+
+    def __init__(self, db_manager=None,
+                 model_limits: Optional[Dict[str, Dict[str, int]]] = None,
+                 search_daily_quota: int = config.SEARCH_DAILY_QUOTA,
+                 search_rpm: int = config.SEARCH_RATE_LIMIT_RPM):
+        self.db = db_manager
+        self.model_limits = dict(model_limits or config.LLM_RATE_LIMITS)
+        self.search_daily_quota = search_daily_quota
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+        self.stats = {"waits": 0, "wait_seconds": 0.0, "shed": 0}
+
+        self._usage_date = date.today().isoformat()
+        self._llm_usage: Dict[str, Dict[str, int]] = {}
+        self._search_count = 0
+        self._search_saved: Dict[str, int] = {}
+        self._search_bucket = TokenBucket(search_rpm, search_rpm / 60.0)
+        self._persist_lock = threading.Lock()  # 依序寫入快照，避免較舊的數字蓋掉較新的
+        self._dirty = {"llm": False, "search": False, "saved": False}
+        self._persisted_at = {"llm": 0.0, "saved": 0.0}
+        self._load_counters()
+
+    # --- 持久化 ---
+    def _load_counters(self):
+        if not self.db:
+            return
+        today = date.today().isoformat()
+        try:
+            saved = json.loads(self.db.load_app_setting(config.SETTING_LLM_USAGE_COUNTERS, "") or "{}")
+        except json.JSONDecodeError:
+            saved = {}
+        if saved.get("date") == today:
+            self._llm_usage = {name: {"requests": int(u.get("requests", 0)), "tokens": int(u.get("tokens", 0))}
+                               for name, u in saved.get("models", {}).items()}
+        try:
+            saved_searches = json.loads(self.db.load_app_setting(config.SETTING_SEARCH_SAVED_COUNTERS, "") or "{}")
+        except json.JSONDecodeError:
+            saved_searches = {}
+        if saved_searches.get("date") == today:
+            self._search_saved = {source: int(count) for source, count in saved_searches.get("counts", {}).items()}
+        if self.db.load_app_setting(config.SETTING_SEARCH_API_LAST_RESET_DATE, "") == today:
+            self._search_count = int(self.db.load_app_setting(config.SETTING_SEARCH_API_CALL_COUNT, 0))
+        else:
+            self._search_count = 0
+            self._dirty["search"] = True
+            self._persist()
+
+    def _snapshot_due_locked(self, force: bool) -> List[Tuple[str, Any]]:
+        """取出需要寫入的計數快照並清除變動標記 (呼叫端持有 self._lock)"""
+        now = time.monotonic()
+        interval = config.RATE_LIMIT_PERSIST_INTERVAL_SECONDS
+        writes: List[Tuple[str, Any]] = []
+        if self._dirty["llm"] and (force or now - self._persisted_at["llm"] >= interval):
+            writes.append((config.SETTING_LLM_USAGE_COUNTERS,
+                           json.dumps({"date": self._usage_date, "models": self._llm_usage})))
+            self._dirty["llm"] = False
+            self._persisted_at["llm"] = now
+        if self._dirty["saved"] and (force or now - self._persisted_at["saved"] >= interval):
+            writes.append((config.SETTING_SEARCH_SAVED_COUNTERS,
+                           json.dumps({"date": self._usage_date, "counts": self._search_saved})))
+            self._dirty["saved"] = False
+            self._persisted_at["saved"] = now
+        if self._dirty["search"]:
+            # 搜尋配額計數每次都寫入，重新啟動後不會多用配額
+            writes.append((config.SETTING_SEARCH_API_CALL_COUNT, self._search_count))
+            writes.append((config.SETTING_SEARCH_API_LAST_RESET_DATE, self._usage_date))
+            self._dirty["search"] = False
+        return writes
+
+    def _persist(self, force: bool = False):
+        """把到期的計數寫入資料庫；在 self._lock 之外執行，不會擋住其他請求取得額度"""
+        if not self.db:
+            return
+        with self._lock:
+            if not any(self._dirty.values()):
+                return
+        with self._persist_lock:
+            with self._lock:
+                writes = self._snapshot_due_locked(force)
+            for key, value in writes:
+                self.db.save_app_setting(key, value)
+
+    def flush(self):
+        """立即寫入所有尚未保存的計數 (關閉應用程式前呼叫)"""
+        self._persist(force=True)
+
+    def _roll_day_locked(self):
+        """跨日時歸零每日計數 (由呼叫端在釋放鎖後呼叫 _persist() 寫入)"""
+        today = date.today().isoformat()
+        if today != self._usage_date:
+            self._usage_date = today
+            self._llm_usage = {}
+            self._search_count = 0
+            self._search_saved = {}
+            self._dirty.update(llm=True, search=True, saved=True)
+            self._persisted_at.update(llm=0.0, saved=0.0)
+
+    # --- LLM ---
+    def _limits_for(self, model_name: str) -> Dict[str, int]:
+        return self.model_limits.get(model_name, config.LLM_RATE_LIMIT_DEFAULT)
+
+    def _bucket(self, key: str, capacity: float, refill_per_second: float) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(capacity, refill_per_second)
+            return bucket
+
+    def _max_wait(self, priority: Optional[str]) -> float:
+        return config.RATE_LIMIT_MAX_WAIT_SECONDS.get(priority or current_priority(), 0.0)
+
+    def acquire_llm(self, model_name: str, estimated_tokens: int, priority: Optional[str] = None) -> LLMReservation:
+        """
+        為一次 LLM 請求取得 RPM/TPM/RPD 額度，必要時等待。
+        等待時間超過該優先等級的上限時拋出 RateLimitExceeded。
+        """
+        limits = self._limits_for(model_name)
+        rpm_bucket = self._bucket(f"llm:{model_name}:rpm", limits["rpm"], limits["rpm"] / 60.0)
+        tpm_bucket = self._bucket(f"llm:{model_name}:tpm", limits["tpm"], limits["tpm"] / 60.0)
+        max_wait = self._max_wait(priority)
+        started = time.monotonic()
+
+        with self._lock:
+            self._roll_day_locked()
+            used_today = self._llm_usage.get(model_name, {}).get("requests", 0)
+        self._persist()
+        if used_today >= limits["rpd"]:
+            self._shed(f"daily request limit for {model_name} reached ({used_today}/{limits['rpd']}).")
+
+        while True:
+            wait_rpm = rpm_bucket.try_consume(1)
+            if wait_rpm == 0:
+                wait_tpm = tpm_bucket.try_consume(estimated_tokens)
+                if wait_tpm == 0:
+                    break
+                rpm_bucket.adjust(1)  # TPM 不足時退還剛扣的請求數
+                wait = wait_tpm
+            else:
+                wait = wait_rpm
+            waited = time.monotonic() - started
+            if waited + wait > max_wait:
+                self._shed(f"{model_name} is over its rate limit (needs {wait:.1f}s more, "
+                           f"max wait {max_wait:.0f}s for '{priority or current_priority()}').")
+            time.sleep(min(wait, 1.0))
+
+        self._record_wait(time.monotonic() - started)
+        with self._lock:
+            usage = self._llm_usage.setdefault(model_name, {"requests": 0, "tokens": 0})
+            usage["requests"] += 1
+            usage["tokens"] += estimated_tokens
+            self._dirty["llm"] = True
+        self._persist()
+        return LLMReservation(model_name, estimated_tokens)
+
+    def reconcile_llm(self, reservation: LLMReservation, actual_tokens: Optional[int]):
+        """以回應的實際 token 數修正預扣的 TPM 額度與每日計數"""
+        if actual_tokens is None:
+            return
+        delta = reservation.estimated_tokens - int(actual_tokens)
+        if delta == 0:
+            return
+        limits = self._limits_for(reservation.model_name)
+        self._bucket(f"llm:{reservation.model_name}:tpm", limits["tpm"], limits["tpm"] / 60.0).adjust(delta)
+        with self._lock:
+            usage = self._llm_usage.setdefault(reservation.model_name, {"requests": 0, "tokens": 0})
+            usage["tokens"] = max(0, usage["tokens"] - delta)
+            self._dirty["llm"] = True
+        self._persist()
+
+    def refund_llm(self, reservation: LLMReservation):
+        """請求失敗 (逾時、伺服器錯誤、改由其他後端重試) 時退還預扣的 token；請求數照常計入"""
+        self.reconcile_llm(reservation, 0)
+
+    # --- 搜尋 ---
+    def acquire_search(self, priority: Optional[str] = None):
+        """
+        為一次搜尋 API 呼叫取得額度並計入每日配額。
+        背景請求不能使用保留給互動請求的最後幾次配額。
+        """
+        priority = priority or current_priority()
+        with self._lock:
+            self._roll_day_locked()
+            limit = self.search_daily_quota
+            if priority != PRIORITY_INTERACTIVE:
+                limit -= config.SEARCH_QUOTA_INTERACTIVE_RESERVE
+            if self._search_count >= limit:
+                count = self._search_count
+            else:
+                count = None
+        self._persist()
+        if count is not None:
+            self._shed(f"search daily quota reached for '{priority}' requests ({count}/{self.search_daily_quota}).")
+
+        started = time.monotonic()
+        max_wait = self._max_wait(priority)
+        while True:
+            wait = self._search_bucket.try_consume(1)
+            if wait == 0:
+                break
+            if time.monotonic() - started + wait > max_wait:
+                self._shed(f"search API is over its per-minute limit (needs {wait:.1f}s more).")
+            time.sleep(min(wait, 1.0))
+        self._record_wait(time.monotonic() - started)
+
+        with self._lock:
+            self._search_count += 1
+            self._dirty["search"] = True
+        self._persist()
+
+    def search_quota_remaining(self, priority: Optional[str] = None) -> int:
+        """該優先等級今日還能使用的搜尋次數 (背景請求不計入保留給互動請求的部分)"""
+        priority = priority or current_priority()
+        with self._lock:
+            self._roll_day_locked()
+            limit = self.search_daily_quota
+            if priority != PRIORITY_INTERACTIVE:
+                limit -= config.SEARCH_QUOTA_INTERACTIVE_RESERVE
+            remaining = max(0, limit - self._search_count)
+        self._persist()
+        return remaining
+
+    def record_search_saved(self, source: str):
+        """記錄一次由搜尋快取省下的 API 呼叫 (source: hit / near_duplicate / collapsed / stale)"""
+        with self._lock:
+            self._roll_day_locked()
+            self._search_saved[source] = self._search_saved.get(source, 0) + 1
+            self._dirty["saved"] = True
+        self._persist()
+
+    def _shed(self, reason: str):
+        with self._lock:
+            self.stats["shed"] += 1
+        logging.warning(f"RateLimiter: {reason}")
+        raise RateLimitExceeded(reason)
+
+    def _record_wait(self, waited: float):
+        if waited < 0.01:
+            return
+        with self._lock:
+            self.stats["waits"] += 1
+            self.stats["wait_seconds"] = round(self.stats["wait_seconds"] + waited, 2)
+        logging.info(f"RateLimiter: waited {waited:.2f}s for capacity.")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """今日各模型用量、搜尋配額與等待/捨棄次數"""
+        with self._lock:
+            self._roll_day_locked()
+            stats = {
+                "date": self._usage_date,
+                "llm": {name: dict(u) for name, u in self._llm_usage.items()},
+                "search": {"used": self._search_count, "quota": self.search_daily_quota,
+                           "saved_by_cache": dict(self._search_saved)},
+                **self.stats,
+            }
+        self._persist()
+        return stats
@@ -0,0 +1,121 @@
+# services/resilience.py
+import time
+import random
+import asyncio
+import logging
+import threading
+from typing import Dict, Any
+
+_google_exceptions = None
+_google_exceptions_loaded = False
+
+
+def _load_google_exceptions():
+    """第一次判斷錯誤時才載入 google.api_core (啟動時不需要)；缺少時僅依連線錯誤判斷"""
+    global _google_exceptions, _google_exceptions_loaded
+    if not _google_exceptions_loaded:
+        try:
+            from google.api_core import exceptions as google_exceptions  # 隨 google-generativeai 安裝
+            _google_exceptions = google_exceptions
+        except ImportError:
+            _google_exceptions = None
+        _google_exceptions_loaded = True
+    return _google_exceptions
+
+
+class CircuitOpenError(RuntimeError):
+    """斷路器開啟中，請求被立即拒絕"""
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    """判斷錯誤是否為暫時性的 (429、5xx、連線中斷)，值得退避後重試"""
+    if isinstance(error, (ConnectionError, asyncio.TimeoutError)):
+        return True
+    google_exceptions = _load_google_exceptions()
+    if google_exceptions is not None:
+        return isinstance(error, (
+            google_exceptions.TooManyRequests, google_exceptions.InternalServerError,
+            google_exceptions.BadGateway, google_exceptions.ServiceUnavailable,
+            google_exceptions.GatewayTimeout, google_exceptions.DeadlineExceeded,
+        ))
+    return False
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """指數退避搭配完整抖動 (full jitter)：在 [0, min(max, base * 2^attempt)] 中隨機取值"""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    簡單的三態斷路器。
+
+    連續失敗達 failure_threshold 次後進入 open 狀態，期間所有請求立即失敗；
+    經過 reset_timeout 秒後進入 half_open，只放行一個試探請求，
+    成功則關閉斷路器，失敗則重新開啟。
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self.stats = {"rejected": 0, "opened": 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state_locked()
+
+    def _current_state_locked(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._trial_in_flight = False
+        return self._state
+
+    def before_call(self):
+        """呼叫前檢查；斷路時拋出 CircuitOpenError"""
+        with self._lock:
+            state = self._current_state_locked()
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            self.stats["rejected"] += 1
+            retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+        raise CircuitOpenError(f"Circuit '{self.name}' is open; failing fast (retry in {retry_in:.0f}s).")
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logging.info(f"CircuitBreaker '{self.name}': closed after successful trial call.")
+            self._state = self.CLOSED
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.stats["opened"] += 1
+                    logging.warning(f"CircuitBreaker '{self.name}': opened after {self._consecutive_failures} consecutive failures.")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def release_trial(self):
+        """試探請求因非服務端原因 (例如參數錯誤) 結束時，釋放試探名額但不改變狀態"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self._current_state_locked(), "consecutive_failures": self._consecutive_failures, **self.stats}
@@ -0,0 +1,348 @@
+# services/search_cache.py
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Any, Optional, FrozenSet, Tuple, List
+
+import config
+from database import DatabaseManager
+from services.base_services import SearchService
+from services.llm_scheduler import current_priority
+from services.rate_limiter import RateLimiter
+
+QUERY_CLASS_NEWS = "news"
+QUERY_CLASS_WEATHER = "weather"
+QUERY_CLASS_GENERAL = "general"  # 常識、知識類查詢，結果很少變動
+
+_FILLER_PATTERN = re.compile("|".join(sorted(map(re.escape, config.SEARCH_QUERY_FILLER_WORDS), key=len, reverse=True)))
+_CJK_CHAR = re.compile(r"[぀-ヿ㐀-䶿一-鿿]")
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def normalize_query(query: str) -> str:
+    """正規化查詢字串：全半形統一、轉小寫、合併空白"""
+    query = unicodedata.normalize("NFKC", str(query or "")).lower()
+    return re.sub(r"\s+", " ", query).strip()
+
+
+def classify_query(query: str) -> str:
+    """依關鍵字判斷查詢類別 (決定快取的 TTL)；天氣優先於新聞"""
+    normalized = normalize_query(query)
+    for query_class in (QUERY_CLASS_WEATHER, QUERY_CLASS_NEWS):
+        if any(keyword in normalized for keyword in config.SEARCH_QUERY_CLASS_KEYWORDS[query_class]):
+            return query_class
+    return QUERY_CLASS_GENERAL
+
+
+def normalize_for_matching(text: str) -> str:
+    """比對用的正規化：在 normalize_query 之外統一同義寫法，並把語助詞換成空白"""
+    normalized = normalize_query(text)
+    for variant, canonical in config.SEARCH_QUERY_SYNONYMS.items():
+        normalized = normalized.replace(variant, canonical)
+    return _FILLER_PATTERN.sub(" ", normalized)
+
+
+def query_signature(query: str) -> FrozenSet[str]:
+    """
+    近似查詢比對用的特徵：去掉語助詞與標點後的中日文單字與英數單字集合。
+    與順序、空白、「今天/今日」這類同義寫法無關，但不同地名或主題的字會讓集合不同。
+    """
+    normalized = normalize_for_matching(query)
+    return frozenset(_CJK_CHAR.findall(normalized)) | frozenset(_WORD.findall(normalized))
+
+
+def _jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class SearchCache:
+    """
+    搜尋結果的兩層快取：程序內 LRU (L1) + SQLite search_cache 表 (L2)。
+
+    鍵為正規化查詢、結果數 (num) 與語言限制 (lr)；TTL 依查詢類別而定
+    (新聞、天氣短，一般知識長)。過期的項目在 SEARCH_CACHE_STALE_GRACE_SECONDS 內仍保留，
+    配額用盡或 API 失敗時可作為過期結果回傳。
+    近似查詢 (語序、空白、語助詞不同) 只在 L1 中比對，啟動後第一次使用時從 L2 載入近期項目。
+    """
+
+    def __init__(self, db_manager: Optional[DatabaseManager],
+                 memory_entries: int = config.SEARCH_CACHE_MEMORY_ENTRIES,
+                 max_db_entries: int = config.SEARCH_CACHE_MAX_DB_ENTRIES):
+        self.db = db_manager
+        self.memory_entries = memory_entries
+        self.max_db_entries = max_db_entries
+        self._lru: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._warmed = False
+        self._writes_since_prune = 0
+
+    @staticmethod
+    def make_key(query: str, num_results: int, language: str) -> str:
+        raw = "\x1f".join([normalize_query(query), str(num_results), language or ""])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, query: str, num_results: int, language: str, allow_stale: bool = False) -> Tuple[Optional[Dict[str, Any]], str]:
+        """
+        查詢快取，返回 (結果, 來源)；來源為 'hit'、'near_duplicate'、'stale' 或 'miss'。
+        allow_stale 時，找不到新鮮結果會退而使用寬限期內的過期結果。
+        """
+        self._warm_from_db()
+        now = time.time()
+        key = self.make_key(query, num_results, language)
+        entry = self._lookup_exact(key, now)
+        if entry and entry["expires_at"] > now:
+            return self._slice(entry, num_results), "hit"
+
+        signature = query_signature(query)
+        near = self._lookup_near_duplicate(signature, num_results, language, classify_query(query), now)
+        if near:
+            return self._slice(near, num_results), "near_duplicate"
+        if allow_stale:
+            stale = entry or self._lookup_near_duplicate(signature, num_results, language, classify_query(query),
+                                                         now - config.SEARCH_CACHE_STALE_GRACE_SECONDS)
+            if stale:
+                return self._slice(stale, num_results), "stale"
+        return None, "miss"
+
+    def put(self, query: str, num_results: int, language: str, result: Dict[str, Any]):
+        if result.get("error") or "results" not in result:
+            return  # 不快取錯誤
+        now = time.time()
+        query_class = classify_query(query)
+        entry = {
+            "key": self.make_key(query, num_results, language), "query": query, "num": num_results,
+            "lr": language or "", "query_class": query_class, "signature": query_signature(query),
+            "result": {"results": list(result["results"])},
+            "expires_at": now + config.SEARCH_CACHE_TTL_SECONDS.get(query_class, config.SEARCH_CACHE_TTL_SECONDS[QUERY_CLASS_GENERAL]),
+        }
+        self._remember(entry)
+        with self._lock:
+            self._writes_since_prune += 1
+            should_prune = self._writes_since_prune >= 50
+            if should_prune:
+                self._writes_since_prune = 0
+        if self.db:
+            self.db.save_search_cache_entry(entry["key"], query, num_results, entry["lr"], query_class,
+                                            json.dumps(entry["result"], ensure_ascii=False), now, entry["expires_at"])
+            if should_prune:
+                removed = self.db.prune_search_cache(self.max_db_entries, now - config.SEARCH_CACHE_STALE_GRACE_SECONDS)
+                if removed:
+                    logging.info(f"SearchCache: pruned {removed} old entries from SQLite.")
+
+    def _lookup_exact(self, key: str, now: float) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry:
+                self._lru.move_to_end(key)
+                return entry
+        if not self.db:
+            return None
+        row = self.db.load_search_cache_entry(key, now - config.SEARCH_CACHE_STALE_GRACE_SECONDS)
+        entry = self._entry_from_row(row) if row else None
+        return self._remember(entry) if entry else None
+
+    def _lookup_near_duplicate(self, signature: FrozenSet[str], num_results: int, language: str, query_class: str,
+                               min_expires_at: float) -> Optional[Dict[str, Any]]:
+        """在 L1 中找語言與類別相同、結果數足夠且特徵集合夠接近的項目，取最接近且最新的一筆"""
+        if not signature:
+            return None
+        best, best_score = None, config.SEARCH_CACHE_NEAR_DUPLICATE_MIN_JACCARD
+        with self._lock:
+            for entry in reversed(self._lru.values()):
+                if (entry["expires_at"] <= min_expires_at or entry["lr"] != (language or "")
+                        or entry["query_class"] != query_class or entry["num"] < num_results):
+                    continue
+                score = _jaccard(signature, entry["signature"])
+                if score >= best_score and (best is None or score > best_score):
+                    best, best_score = entry, score
+                    if score == 1.0:
+                        break
+        return best
+
+    def _warm_from_db(self):
+        """第一次查詢時把 L2 中近期的項目載入 L1，讓近似比對在重新啟動後仍然有效"""
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+        if not self.db:
+            return
+        rows = self.db.load_recent_search_cache_entries(time.time() - config.SEARCH_CACHE_STALE_GRACE_SECONDS,
+                                                        self.memory_entries)
+        for row in reversed(rows):  # 由舊到新加入，最近存取的留在 LRU 尾端
+            entry = self._entry_from_row(row)
+            if entry:
+                self._remember(entry)
+
+    @staticmethod
+    def _entry_from_row(row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        try:
+            result = json.loads(row["result_json"])
+        except json.JSONDecodeError:
+            logging.warning("SearchCache: corrupted L2 entry ignored.")
+            return None
+        return {
+            "key": row["cache_key"], "query": row["query"], "num": int(row["num"]), "lr": row["lr"] or "",
+            "query_class": row["query_class"], "signature": query_signature(row["query"]),
+            "result": result, "expires_at": float(row["expires_at"]),
+        }
+
+    def _remember(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            self._lru[entry["key"]] = entry
+            self._lru.move_to_end(entry["key"])
+            while len(self._lru) > self.memory_entries:
+                self._lru.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def _slice(entry: Dict[str, Any], num_results: int) -> Dict[str, Any]:
+        return {"results": list(entry["result"].get("results", []))[:num_results]}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._lru)
+
+
+class _InFlightSearch:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[Dict[str, Any]] = None
+
+
+class CachedSearchService(SearchService):
+    """
+    為任一 SearchService 加上結果快取、同查詢併發合併與配額感知。
+
+    - 快取命中 (含近似查詢) 不呼叫 API，也不佔用每日配額；
+    - 多個執行緒同時搜尋相同的查詢時只送出一次請求，其餘等待同一個結果；
+    - 每日配額已用完 (或 API 失敗) 時，改用寬限期內的過期結果；
+    - 省下的呼叫次數計入速率限制器的每日搜尋統計。
+    """
+
+    def __init__(self, inner: SearchService, db_manager: Optional[DatabaseManager],
+                 rate_limiter: Optional[RateLimiter] = None, cache: Optional[SearchCache] = None):
+        self.inner = inner
+        self.cache = cache or SearchCache(db_manager)
+        self.rate_limiter = rate_limiter or getattr(inner, "rate_limiter", None)
+        self.language = getattr(inner, "language_restrict", "")
+        self._inflight: Dict[str, _InFlightSearch] = {}
+        self._lock = threading.Lock()
+        self.stats = {"hit": 0, "near_duplicate": 0, "collapsed": 0, "stale": 0, "api_calls": 0}
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.inner.is_enabled
+
+    def search(self, query: str, num_results: int = 3) -> Dict[str, Any]:
+        cached, source = self.cache.get(query, num_results, self.language)
+        if cached is not None:
+            self._record(source)
+            logging.info(f"Search cache {source} for '{query}'.")
+            return cached
+
+        key = self.cache.make_key(query, num_results, self.language)
+        with self._lock:
+            pending = self._inflight.get(key)
+            is_leader = pending is None
+            if is_leader:
+                pending = self._inflight[key] = _InFlightSearch()
+        if not is_leader:
+            pending.done.wait(config.SEARCH_INFLIGHT_WAIT_SECONDS)
+            if pending.result is not None:
+                self._record("collapsed")
+                return dict(pending.result)
+            return self._search_uncached(query, num_results)  # 等待逾時，自行送出
+
+        try:
+            pending.result = self._search_uncached(query, num_results)
+            return dict(pending.result)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            pending.done.set()
+
+    def search_many(self, queries: List[str], num_results: int = 3) -> List[Dict[str, Any]]:
+        """快取命中的查詢直接返回，其餘 (去除重複後) 交給內層服務一次並行搜尋"""
+        results: List[Optional[Dict[str, Any]]] = [None] * len(queries)
+        misses: Dict[str, List[int]] = {}
+        for idx, query in enumerate(queries):
+            cached, source = self.cache.get(query, num_results, self.language)
+            if cached is not None:
+                self._record(source)
+                results[idx] = cached
+                continue
+            key = self.cache.make_key(query, num_results, self.language)
+            if key in misses:
+                self._record("collapsed")
+            misses.setdefault(key, []).append(idx)
+
+        to_fetch = []
+        for indices in misses.values():
+            query = queries[indices[0]]
+            stale = self._stale_if_quota_exhausted(query, num_results)
+            if stale is not None:
+                for idx in indices:
+                    results[idx] = dict(stale)
+            else:
+                to_fetch.append(indices)
+        if to_fetch:
+            with self._lock:
+                self.stats["api_calls"] += len(to_fetch)
+            fetched = self.inner.search_many([queries[indices[0]] for indices in to_fetch], num_results=num_results)
+            for indices, result in zip(to_fetch, fetched):
+                result = self._finish(queries[indices[0]], num_results, result)
+                for idx in indices:
+                    results[idx] = dict(result)
+        return results
+
+    def _stale_if_quota_exhausted(self, query: str, num_results: int) -> Optional[Dict[str, Any]]:
+        if not self.rate_limiter or self.rate_limiter.search_quota_remaining(current_priority()) > 0:
+            return None
+        stale, _ = self.cache.get(query, num_results, self.language, allow_stale=True)
+        if stale is not None:
+            self._record("stale")
+            logging.info(f"Search quota exhausted; serving stale cached results for '{query}'.")
+        return stale
+
+    def _search_uncached(self, query: str, num_results: int) -> Dict[str, Any]:
+        stale = self._stale_if_quota_exhausted(query, num_results)
+        if stale is not None:
+            return stale
+        with self._lock:
+            self.stats["api_calls"] += 1
+        return self._finish(query, num_results, self.inner.search(query, num_results=num_results))
+
+    def _finish(self, query: str, num_results: int, result: Dict[str, Any]) -> Dict[str, Any]:
+        """成功的結果寫入快取；失敗時盡量改用過期結果"""
+        if not result.get("error"):
+            self.cache.put(query, num_results, self.language, result)
+            return result
+        stale, _ = self.cache.get(query, num_results, self.language, allow_stale=True)
+        if stale is not None:
+            self._record("stale")
+            logging.warning(f"Search failed ({result['error']}); serving stale cached results for '{query}'.")
+            return stale
+        return result
+
+    def _record(self, source: str):
+        with self._lock:
+            self.stats[source] += 1
+        if self.rate_limiter:
+            self.rate_limiter.record_search_saved(source)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        saved = stats["hit"] + stats["near_duplicate"] + stats["collapsed"] + stats["stale"]
+        total = saved + stats["api_calls"]
+        stats["saved_rate"] = round(saved / total, 3) if total else 0.0
+        stats["l1_size"] = len(self.cache)
+        return stats
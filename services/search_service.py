@@ -1,47 +1,119 @@
 # services/search_service.py
+import os
+import json
 import logging
+import threading
 from typing import Dict, Any, Optional
 
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-
+import config
 from services.base_services import SearchService
+from services.rate_limiter import RateLimiter, RateLimitExceeded
+from services.lazy_loading import LazyModule, startup_timer
+
+# googleapiclient 載入約需 0.3 秒，延後到第一次建立搜尋客戶端時
+discovery = LazyModule("googleapiclient.discovery")
+googleapiclient_errors = LazyModule("googleapiclient.errors")
+googleapiclient_http = LazyModule("googleapiclient.http")
 
 class GoogleSearchService(SearchService):
     """使用 Google Custom Search API 的搜尋服務"""
 
-    def __init__(self, api_key: Optional[str], cx_id: Optional[str]):
+    def __init__(self, api_key: Optional[str], cx_id: Optional[str], rate_limiter: Optional[RateLimiter] = None):
         self.api_key = api_key
         self.cx_id = cx_id
+        self.rate_limiter = rate_limiter
+        self.language_restrict = config.SEARCH_LANGUAGE_RESTRICT
         self._service = None
-
-        if self.is_enabled:
-            try:
-                self._service = build("customsearch", "v1", developerKey=self.api_key, static_discovery=False)
-                logging.info("GoogleSearchService initialized successfully.")
-            except Exception as e:
-                logging.error(f"Failed to build Google Search service: {e}", exc_info=True)
-                self._service = None
+        self._service_built = False
+        self._service_lock = threading.Lock()
+        self._thread_local = threading.local()
 
     @property
     def is_enabled(self) -> bool:
         """檢查服務是否已啟用 (金鑰和ID都存在)"""
         return bool(self.api_key and self.cx_id)
 
+    def warm_up(self):
+        """預先建立搜尋客戶端 (在背景執行緒中呼叫)，讓第一次搜尋不必等待"""
+        self._get_service()
+
+    def _get_service(self):
+        """第一次使用時才建立 API 客戶端；建立失敗只記錄一次，之後的搜尋直接返回錯誤"""
+        if self._service_built:
+            return self._service
+        with self._service_lock:
+            if not self._service_built:
+                if self.is_enabled:
+                    with startup_timer.phase("search client"):
+                        self._service = self._build_service()
+                self._service_built = True
+        return self._service
+
+    def _build_service(self):
+        """
+        依序嘗試：googleapiclient 內附的 discovery 文件 (不需連網)、上次下載並快取的文件、
+        最後才向 discovery 端點下載，並把下載到的文件存起來供下次啟動使用。
+        """
+        try:
+            service = discovery.build("customsearch", "v1", developerKey=self.api_key, static_discovery=True)
+            logging.info("GoogleSearchService initialized from the bundled discovery document.")
+            return service
+        except Exception as e:
+            logging.info(f"Bundled discovery document unavailable ({e}); trying the cached copy.")
+
+        cache_path = config.SEARCH_DISCOVERY_CACHE_PATH
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    service = discovery.build_from_document(f.read(), developerKey=self.api_key)
+                logging.info("GoogleSearchService initialized from the cached discovery document.")
+                return service
+            except Exception as e:
+                logging.warning(f"Cached discovery document at '{cache_path}' is unusable: {e}")
+
+        try:
+            service = discovery.build("customsearch", "v1", developerKey=self.api_key, static_discovery=False)
+            logging.info("GoogleSearchService initialized from the discovery endpoint.")
+        except Exception as e:
+            logging.error(f"Failed to build Google Search service: {e}", exc_info=True)
+            return None
+        root_desc = getattr(service, "_rootDesc", None)
+        if root_desc:
+            try:
+                with open(cache_path, "w", encoding="utf-8") as f:
+                    json.dump(root_desc, f)
+            except OSError as e:
+                logging.warning(f"Could not cache discovery document to '{cache_path}': {e}")
+        return service
+
+    def _http(self):
+        """httplib2.Http 不是執行緒安全的，每個執行緒使用自己的連線"""
+        http = getattr(self._thread_local, "http", None)
+        if http is None:
+            http = self._thread_local.http = googleapiclient_http.build_http()
+        return http
+
     def search(self, query: str, num_results: int = 3) -> Dict[str, Any]:
         """執行網路搜尋"""
-        if not self._service:
+        service = self._get_service()
+        if not service:
             logging.warning("Search skipped: GoogleSearchService is not enabled or failed to initialize.")
             return {"error": "Service not configured. Check API key and CX ID."}
 
+        if self.rate_limiter:
+            try:
+                self.rate_limiter.acquire_search()
+            except RateLimitExceeded as e:
+                return {"error": f"搜尋額度不足: {e}"}
+
         try:
             logging.info(f"Performing Google search for: '{query}'")
-            response = self._service.cse().list(
+            response = service.cse().list(
                 q=query,
                 cx=self.cx_id,
                 num=num_results,
-                lr='lang_zh-TW' # 優先顯示繁體中文結果
-            ).execute()
+                lr=self.language_restrict
+            ).execute(http=self._http())
 
             results_list: list[str] = []
             if 'items' in response:
@@ -56,7 +128,7 @@ class GoogleSearchService(SearchService):
                 logging.info(f"No search results found for '{query}'.")
                 return {"results": []}
 
-        except HttpError as e:
+        except googleapiclient_errors.HttpError as e:
             error_content = str(e.content)
             if e.resp.status in [403, 429]:
                 logging.error(f"Search API Quota Exceeded or Key/CX ID issue: {e.resp.status} - {error_content}")
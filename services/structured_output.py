@@ -0,0 +1,326 @@
+# services/structured_output.py
+import re
+import json
+import logging
+from typing import Optional, List, Tuple, Any, Iterable
+
+_SIMPLE_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+_CLOSERS = {'{': '}', '[': ']'}
+_PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_MAX_UNCLOSED_RETRIES = 3
+# 掃描時只需停在結構字元上：字串外看引號與括號，字串內看引號與反斜線
+_STRUCTURAL_PATTERN = re.compile(r'["{}\[\]]')
+_STRING_SPECIAL_PATTERN = re.compile(r'["\\]')
+# strict=False 允許字串中出現原始換行等控制字元
+_DECODER = json.JSONDecoder(strict=False)
+
+
+def scan_json_span(text: str, start: int) -> Tuple[int, bool]:
+    """
+    從 text[start] (必須是 '{' 或 '[') 開始，找出最外層 JSON 值的結束位置。
+    只看每個字元一次，會略過字串內的括號與跳脫字元。
+
+    Returns:
+        (end, complete)：end 為結束位置 (不含)；括號未閉合 (例如輸出被截斷) 時
+        end 為 len(text) 且 complete 為 False。
+    """
+    depth = 0
+    pos = start
+    n = len(text)
+    while pos < n:
+        match = _STRUCTURAL_PATTERN.search(text, pos)
+        if not match:
+            break
+        ch = match.group()
+        pos = match.end()
+        if ch == '"':
+            # 跳到字串結尾；反斜線連同下一個字元一起略過
+            while True:
+                special = _STRING_SPECIAL_PATTERN.search(text, pos)
+                if not special:
+                    return n, False
+                if special.group() == '"':
+                    pos = special.end()
+                    break
+                pos = special.end() + 1
+        elif ch in '{[':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return pos, True
+    return n, False
+
+
+def repair_json(fragment: str) -> str:
+    """
+    單次掃描修復常見的 LLM JSON 錯誤：結尾多餘的逗號、不相符的右括號、
+    Python 風格的 True/False/None，以及被截斷時未閉合的字串與括號。
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    in_string = False
+    escape = False
+    i, n = 0, len(fragment)
+    while i < n:
+        ch = fragment[i]
+        if in_string:
+            out.append(ch)
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+            i += 1
+            continue
+        if ch == '"':
+            in_string = True
+            out.append(ch)
+        elif ch in '{[':
+            stack.append(_CLOSERS[ch])
+            out.append(ch)
+        elif ch in '}]':
+            _strip_trailing_comma(out)
+            if stack:
+                out.append(stack.pop())  # 以實際開啟的括號種類為準
+                if not stack:
+                    break
+        elif ch.isalpha():
+            j = i
+            while j < n and (fragment[j].isalnum() or fragment[j] == '_'):
+                j += 1
+            word = fragment[i:j]
+            out.append(_PYTHON_LITERALS.get(word, word))
+            i = j
+            continue
+        else:
+            out.append(ch)
+        i += 1
+
+    if in_string:
+        if escape:
+            out.pop()  # 截斷在反斜線上
+        out.append('"')
+    if stack:
+        _strip_trailing_comma(out)
+        tail = "".join(out).rstrip()
+        if tail.endswith(':'):
+            out.append("null")
+        out.extend(reversed(stack))
+    return "".join(out)
+
+
+def _strip_trailing_comma(out: List[str]):
+    """移除輸出尾端 (忽略空白) 的一個逗號"""
+    k = len(out) - 1
+    while k >= 0 and out[k].isspace():
+        k -= 1
+    if k >= 0 and out[k] == ',':
+        del out[k]
+
+
+def extract_json(text: str, expected_type: Optional[type] = dict, repair: bool = True,
+                 required_keys: Optional[Iterable[str]] = None) -> Optional[Any]:
+    """
+    從 LLM 的原始輸出中找出並解碼第一個可用的最外層 JSON 值 (可被說明文字或 ```json 標記包圍)。
+
+    空的物件或陣列 (例如說明文字中的 "{}") 不算可用，只有在找不到其他候選時才返回。
+
+    Args:
+        expected_type: dict 只找物件、list 只找陣列、None 兩者皆可。
+        repair: 嚴格解碼失敗時是否嘗試 repair_json。
+        required_keys: 指定時優先返回包含其中任一鍵的物件 (與 SpokenResponseStreamExtractor
+            選擇同一個物件)；都沒有時才退回第一個可用的值。
+
+    Returns:
+        解碼後的值；找不到可用的 JSON 時返回 None。整體為線性時間：
+        完整的候選區段 (不論能否解碼) 會被整段跳過；未閉合的候選最多重試
+        _MAX_UNCLOSED_RETRIES 次，避免 "{{{{..." 這類輸入退化成平方時間。
+    """
+    if not text:
+        return None
+    keys = set(required_keys or ())
+    openers = "{" if expected_type is dict else "[" if expected_type is list else "{["
+    fallback = None   # 第一個可用但不含 required_keys 的值
+    trivial = None    # 第一個空的物件或陣列
+    pos = 0
+    unclosed_retries = 0
+    while True:
+        starts = [idx for idx in (text.find(ch, pos) for ch in openers) if idx != -1]
+        if not starts:
+            break
+        start = min(starts)
+        # 快速路徑：直接從候選位置解碼一個完整的 JSON 值
+        try:
+            value, end = _DECODER.raw_decode(text, start)
+            complete = True
+        except ValueError:
+            value = None
+            end, complete = scan_json_span(text, start)
+            if repair:
+                value = _decode(repair_json(text[start:end]))
+                if value is not None:
+                    logging.debug("extract_json: decoded after repair.")
+
+        if value is not None and (expected_type is None or isinstance(value, expected_type)):
+            if not value:
+                trivial = value if trivial is None else trivial
+            elif not keys or (isinstance(value, dict) and keys & value.keys()):
+                return value
+            elif fallback is None:
+                fallback = value
+        if complete:
+            pos = end
+        elif value is not None:
+            break  # 修復後的未閉合值延伸到文字結尾，之後只剩它內部的巢狀值
+        else:
+            unclosed_retries += 1
+            if unclosed_retries > _MAX_UNCLOSED_RETRIES:
+                break
+            pos = start + 1
+    return fallback if fallback is not None else trivial
+
+
+def _decode(fragment: str) -> Optional[Any]:
+    try:
+        return _DECODER.decode(fragment)
+    except ValueError:
+        return None
+
+
+class SpokenResponseStreamExtractor:
+    """
+    串流 JSON 的增量掃描器：在模型逐塊輸出時，一旦頂層物件中目標欄位
+    (預設 `spoken_response`) 的字串值開始，就立即解碼並吐出新增的文字。
+
+    只看每個字元一次，能正確處理字串中的大括號、跨區塊的跳脫序列
+    (包含 \\uXXXX 與代理對)，以及 JSON 前面的說明文字或 ```json 標記。
+    """
+
+    _SEEK, _AWAIT_COLON, _AWAIT_VALUE, _IN_VALUE, _DONE = range(5)
+
+    def __init__(self, field_name: str = "spoken_response"):
+        self.field_name = field_name
+        self._state = self._SEEK
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key_chars: List[str] = []
+        self._last_key: Optional[str] = None
+        self._pending_escape: Optional[str] = None  # 值字串內尚未完成的跳脫序列 (不含反斜線)
+        self._high_surrogate: Optional[int] = None
+        self.emitted_text = ""
+
+    @property
+    def started(self) -> bool:
+        return self._state in (self._IN_VALUE, self._DONE)
+
+    @property
+    def finished(self) -> bool:
+        return self._state == self._DONE
+
+    def feed(self, chunk: str) -> str:
+        """送入一段新的原始輸出，返回目標欄位新增的已解碼文字 (可能為空字串)"""
+        out: List[str] = []
+        for ch in chunk:
+            state = self._state
+            if state == self._DONE:
+                break
+            if state == self._IN_VALUE:
+                self._consume_value_char(ch, out)
+                continue
+            if state == self._AWAIT_VALUE:
+                if ch.isspace():
+                    continue
+                if ch == '"':
+                    self._state = self._IN_VALUE
+                    continue
+                # 目標欄位不是字串，回到一般掃描
+                self._state = self._SEEK
+            elif state == self._AWAIT_COLON and not self._in_string:
+                if ch.isspace():
+                    continue
+                if ch == ':' and self._last_key == self.field_name:
+                    self._state = self._AWAIT_VALUE
+                    continue
+                self._state = self._SEEK
+            self._scan_structure(ch)
+        text = "".join(out)
+        self.emitted_text += text
+        return text
+
+    def _scan_structure(self, ch: str):
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+                if self._depth == 1:
+                    self._key_chars.append(_SIMPLE_ESCAPES.get(ch, ch))
+            elif ch == '\\':
+                self._escape = True
+            elif ch == '"':
+                self._in_string = False
+                if self._depth == 1:
+                    # 頂層物件中的字串：若後面緊接冒號即為鍵
+                    self._last_key = "".join(self._key_chars)
+                    self._state = self._AWAIT_COLON
+            elif self._depth == 1:
+                self._key_chars.append(ch)
+            return
+
+        if ch == '"':
+            if self._depth >= 1:
+                self._in_string = True
+                self._key_chars = []
+        elif ch in '{[':
+            self._depth += 1
+        elif ch in '}]':
+            if self._depth > 0:
+                self._depth -= 1
+
+    def _consume_value_char(self, ch: str, out: List[str]):
+        if self._pending_escape is not None:
+            self._pending_escape += ch
+            seq = self._pending_escape
+            if seq[0] == 'u':
+                if len(seq) < 5:
+                    return
+                self._pending_escape = None
+                try:
+                    code = int(seq[1:], 16)
+                except ValueError:
+                    out.append(seq)
+                    return
+                self._emit_code_point(code, out)
+                return
+            self._pending_escape = None
+            self._flush_surrogate(out)
+            out.append(_SIMPLE_ESCAPES.get(seq, seq))
+            return
+        if ch == '\\':
+            self._pending_escape = ""
+            return
+        self._flush_surrogate(out)
+        if ch == '"':
+            self._state = self._DONE
+            return
+        out.append(ch)
+
+    def _emit_code_point(self, code: int, out: List[str]):
+        if 0xD800 <= code <= 0xDBFF:
+            self._flush_surrogate(out)
+            self._high_surrogate = code
+            return
+        if 0xDC00 <= code <= 0xDFFF and self._high_surrogate is not None:
+            combined = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+            self._high_surrogate = None
+            out.append(chr(combined))
+            return
+        self._flush_surrogate(out)
+        out.append(chr(code))
+
+    def _flush_surrogate(self, out: List[str]):
+        if self._high_surrogate is not None:
+            out.append("�")  # 孤立的高代理字元
+            self._high_surrogate = None
@@ -0,0 +1,54 @@
+# services/tokens.py
+import re
+import math
+
+# CJK 字元 (含日文假名、全形標點) 大約各佔一個 token；其他文字約 4 個字元一個 token
+_CJK_PATTERN = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿豈-﫿＀-￯]")
+
+
+def estimate_tokens(text: str) -> int:
+    """快速的本地 token 估算，不需呼叫任何 API"""
+    if not text:
+        return 0
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    other_chars = len(text) - cjk_count
+    return cjk_count + math.ceil(other_chars / 4)
+
+
+def estimate_contents_tokens(contents) -> int:
+    """估算一次模型請求內容的 token 數 (字串、{"parts": [...]} 字典或 SDK 的 Content 物件)"""
+    if contents is None:
+        return 0
+    if isinstance(contents, str):
+        return estimate_tokens(contents)
+    if isinstance(contents, dict):
+        if "text" in contents:
+            return estimate_tokens(str(contents["text"]))
+        if "parts" in contents:
+            return estimate_contents_tokens(contents["parts"])
+        return estimate_tokens(str(contents))
+    if isinstance(contents, (list, tuple)):
+        return sum(estimate_contents_tokens(item) for item in contents)
+    parts = getattr(contents, "parts", None)
+    if parts is not None:
+        return estimate_contents_tokens(list(parts))
+    text = getattr(contents, "text", None)
+    return estimate_tokens(text if isinstance(text, str) else str(contents))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, suffix: str = "…") -> str:
+    """將文字截斷到估算 token 數不超過 max_tokens (保留開頭)"""
+    if max_tokens <= 0 or not text:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # 二分搜尋可保留的最長前綴
+    low, high = 0, len(text)
+    budget = max_tokens - estimate_tokens(suffix)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low].rstrip() + suffix if low > 0 else ""
@@ -0,0 +1,133 @@
+# services/tool_loop.py
+import json
+import time
+import logging
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+import config
+from services.llm_scheduler import current_priority, request_priority
+from services.llm_tasks import TASK_TOOL_FOLLOWUP
+from services.worker_pool import RejectedJobError, worker_pools
+
+
+class ToolExecutor:
+    """
+    執行模型要求的工具呼叫。
+
+    同一輪的多個呼叫在 tool_calls 工作池中平行執行，各自有逾時 (LLM_TOOL_TIMEOUTS 可為個別工具覆寫預設的 LLM_TOOL_TIMEOUT_SECONDS)；
+    逾時、失敗或因工作池已滿而未執行的呼叫以 {"error": ...} 回報給模型，不會讓整個回合失敗。
+    成功的結果依 (工具名稱, 參數) 快取在這個執行器上 —— 每個回合建立一個，模型在連續幾輪中重複查詢時不會再執行一次。
+    """
+
+    def __init__(self, tools: Dict[str, Callable[..., Dict[str, Any]]],
+                 timeouts: Optional[Dict[str, float]] = None,
+                 default_timeout: float = config.LLM_TOOL_TIMEOUT_SECONDS):
+        self.tools = tools
+        self.timeouts = {**config.LLM_TOOL_TIMEOUTS, **(timeouts or {})}
+        self.default_timeout = default_timeout
+        self._cache: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.trace: List[Dict[str, Any]] = []
+
+    @staticmethod
+    def _cache_key(name: str, args: Dict[str, Any]) -> Tuple[str, str]:
+        return name, json.dumps(args, sort_keys=True, ensure_ascii=False, default=str)
+
+    def run_all(self, calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """平行執行一輪工具呼叫，返回與 calls 同順序的結果"""
+        results: List[Optional[Dict[str, Any]]] = [None] * len(calls)
+        pending = []
+        priority = current_priority()
+        for idx, call in enumerate(calls):
+            name, args = call["name"], call.get("args") or {}
+            key = self._cache_key(name, args)
+            if key in self._cache:
+                results[idx] = self._cache[key]
+                self.trace.append({"name": name, "args": args, "ms": 0.0, "cached": True})
+                continue
+            tool = self.tools.get(name)
+            if tool is None:
+                logging.error(f"LLM called an unknown tool: {name}")
+                results[idx] = {"error": f"Tool '{name}' not found."}
+                self.trace.append({"name": name, "args": args, "ms": 0.0, "error": "unknown tool"})
+                continue
+            try:
+                future = worker_pools.get("tool_calls").submit(self._invoke, tool, args, priority)
+            except RejectedJobError as e:
+                logging.warning(f"Tool '{name}' was not run: {e}")
+                results[idx] = {"error": "工具目前忙碌中，請稍後再試或直接回答"}
+                self.trace.append({"name": name, "args": args, "ms": 0.0, "error": "rejected"})
+                continue
+            pending.append((idx, name, args, key, time.perf_counter(), future))
+
+        for idx, name, args, key, started, future in pending:
+            timeout = self.timeouts.get(name, self.default_timeout)
+            remaining = max(0.0, timeout - (time.perf_counter() - started))
+            entry: Dict[str, Any] = {"name": name, "args": args}
+            try:
+                result = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                logging.warning(f"Tool '{name}' timed out after {timeout:.0f}s.")
+                result = {"error": f"工具執行逾時 ({timeout:.0f} 秒)"}
+                entry["error"] = "timeout"
+            except Exception as e:
+                logging.error(f"Tool '{name}' raised an error: {e}", exc_info=True)
+                result = {"error": f"工具執行失敗: {e}"}
+                entry["error"] = str(e)
+            if not isinstance(result, dict):
+                result = {"result": result}
+            if "error" not in entry and not result.get("error"):
+                self._cache[key] = result
+            entry["ms"] = round((time.perf_counter() - started) * 1000, 1)
+            self.trace.append(entry)
+            logging.info(f"Tool '{name}' executed in {entry['ms']}ms. Result: {str(result)[:200]}...")
+            results[idx] = result
+        return results
+
+    @staticmethod
+    def _invoke(tool: Callable[..., Dict[str, Any]], args: Dict[str, Any], priority: str) -> Dict[str, Any]:
+        # 工具內的搜尋與 LLM 請求沿用呼叫端的優先等級
+        with request_priority(priority):
+            return tool(**args)
+
+
+def run_tool_loop(llm, prompt_details: Dict[str, Any], executor: ToolExecutor,
+                  max_depth: int = config.LLM_TOOL_MAX_DEPTH) -> Dict[str, Any]:
+    """
+    生成並執行工具呼叫，直到模型給出文字回答或達到 max_depth 輪。
+
+    每一輪把所有 function_response 一起送回模型 (TASK_TOOL_FOLLOWUP)，並繼續提供工具，
+    讓模型可以根據上一輪的結果再查詢；最後一輪不再提供工具，要求模型以現有資訊作答。
+    返回最終的生成結果，另附 'tool_calls' (執行紀錄)、'tool_rounds' (輪數) 與 'tool_seconds' (執行工具的總時間)。
+    """
+    result = llm.generate_content(prompt_details)
+    rounds = 0
+    tool_seconds = 0.0
+    while result.get("tool_call_requests") or result.get("tool_call_request"):
+        if rounds >= max_depth:
+            logging.warning(f"Tool loop stopped after {rounds} rounds; the model still requested tools.")
+            break
+        calls = result.get("tool_call_requests") or [result["tool_call_request"]]
+        history = result["messages_history_for_next_turn"]
+        started = time.perf_counter()
+        outputs = executor.run_all(calls)
+        tool_seconds += time.perf_counter() - started
+        history.append({
+            "role": "tool",
+            "parts": [{"function_response": {"name": call["name"], "response": output}}
+                      for call, output in zip(calls, outputs)]
+        })
+        rounds += 1
+        logging.debug(f"Tool loop: follow-up call {rounds}/{max_depth} with {len(calls)} tool result(s).")
+        result = llm.generate_content({
+            "task": TASK_TOOL_FOLLOWUP,
+            "contents": history,
+            "generation_config": prompt_details.get("generation_config"),
+            "expect_structured_output": prompt_details.get("expect_structured_output", True),
+            "priority": prompt_details.get("priority"),
+            "tools": prompt_details.get("tools") if rounds < max_depth else None,
+        })
+    result["tool_calls"] = executor.trace
+    result["tool_rounds"] = rounds
+    result["tool_seconds"] = tool_seconds
+    return result
@@ -0,0 +1,258 @@
+# services/worker_pool.py
+import time
+import heapq
+import logging
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import Dict, Any, Callable, Optional, List, Deque, Tuple
+
+import config
+
+# 佇列已滿時的處理方式
+POLICY_REJECT = "reject"            # 拒絕新工作 (submit 拋出 RejectedJobError，dispatch 返回 None)
+POLICY_DROP_OLDEST = "drop_oldest"  # 取消佇列中最舊的工作，讓新工作排入 (適合投機性的學習工作)
+POLICY_CALLER_RUNS = "caller_runs"  # 由呼叫端的執行緒直接執行 (呼叫端本來就會等結果時使用)
+
+
+class RejectedJobError(RuntimeError):
+    """工作池佇列已滿 (或已關閉)，工作未被接受"""
+
+
+class WorkerPool(Executor):
+    """
+    有名稱、執行緒數與佇列長度上限的工作池。
+
+    執行緒在需要時才建立，閒置超過 WORKER_POOL_IDLE_SECONDS 後退出；
+    同時可接受的工作數 = 最多 max_workers 個執行中 + max_queue 個排隊中，超過時依 policy 處理。
+    實作 concurrent.futures.Executor 介面，可直接交給 loop.run_in_executor 或 concurrent.futures.wait 使用。
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int, policy: str = POLICY_REJECT,
+                 drain_on_shutdown: bool = False):
+        if policy not in (POLICY_REJECT, POLICY_DROP_OLDEST, POLICY_CALLER_RUNS):
+            raise ValueError(f"Unknown rejection policy for pool '{name}': {policy}")
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.policy = policy
+        self.drain_on_shutdown = drain_on_shutdown
+        self._queue: Deque[Tuple[Future, Callable, tuple, dict]] = deque()
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._idle = 0
+        self._active = 0
+        self._shutdown = False
+        self._thread_counter = itertools.count(1)
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "dropped": 0, "caller_runs": 0}
+
+    def submit(self, fn: Callable, /, *args, **kwargs) -> Future:
+        future: Future = Future()
+        job = (future, fn, args, kwargs)
+        with self._cond:
+            if self._shutdown:
+                raise RejectedJobError(f"Worker pool '{self.name}' is shut down.")
+            # 已接受但尚未完成的工作 (執行中 + 排隊中) 以 max_workers + max_queue 為上限；
+            # 不以閒置執行緒數計算，剛建立、尚未取走工作的執行緒不會讓排隊中的工作被誤判為多餘
+            if self._active + len(self._queue) >= self.max_workers + self.max_queue:
+                if self.policy == POLICY_DROP_OLDEST and self._queue:
+                    self._queue.popleft()[0].cancel()
+                    self.stats["dropped"] += 1
+                elif self.policy == POLICY_CALLER_RUNS:
+                    self.stats["caller_runs"] += 1
+                    job = None
+                else:
+                    self.stats["rejected"] += 1
+                    raise RejectedJobError(f"Worker pool '{self.name}' is full "
+                                           f"({self._active} active, {len(self._queue)} queued).")
+            if job is not None:
+                self._queue.append(job)
+                self.stats["submitted"] += 1
+                if len(self._queue) > self._idle and len(self._threads) < self.max_workers:
+                    self._spawn_locked()
+                self._cond.notify()
+        if job is None:
+            self._run((future, fn, args, kwargs))
+        return future
+
+    def _spawn_locked(self):
+        thread = threading.Thread(target=self._worker, name=f"{self.name}-{next(self._thread_counter)}", daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def _worker(self):
+        current = threading.current_thread()
+        while True:
+            with self._cond:
+                self._idle += 1
+                deadline = time.monotonic() + config.WORKER_POOL_IDLE_SECONDS
+                while not self._queue and not self._shutdown:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                self._idle -= 1
+                if not self._queue:
+                    self._threads.remove(current)  # 閒置過久或已關閉
+                    self._cond.notify_all()
+                    return
+                job = self._queue.popleft()
+                self._active += 1
+            try:
+                self._run(job)
+            finally:
+                with self._cond:
+                    self._active -= 1
+
+    def _run(self, job: Tuple[Future, Callable, tuple, dict]):
+        future, fn, args, kwargs = job
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            with self._cond:
+                self.stats["failed"] += 1
+            future.set_exception(e)
+        else:
+            with self._cond:
+                self.stats["completed"] += 1
+            future.set_result(result)
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False, timeout: Optional[float] = None) -> int:
+        """停止接受新工作；cancel_futures 時取消排隊中的工作。返回逾時後仍未完成的工作數"""
+        self.begin_shutdown(cancel_futures=cancel_futures)
+        return self.wait_idle(timeout) if wait else self.pending_count()
+
+    def begin_shutdown(self, cancel_futures: bool = False):
+        with self._cond:
+            self._shutdown = True
+            if cancel_futures:
+                while self._queue:
+                    self._queue.popleft()[0].cancel()
+                    self.stats["dropped"] += 1
+            self._cond.notify_all()
+
+    def wait_idle(self, timeout: Optional[float] = None) -> int:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._threads:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._active + len(self._queue)
+
+    def pending_count(self) -> int:
+        with self._cond:
+            return self._active + len(self._queue)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"workers": len(self._threads), "active": self._active, "queued": len(self._queue),
+                    **self.stats, "max_workers": self.max_workers, "max_queue": self.max_queue, "policy": self.policy}
+
+
+class WorkerPoolManager:
+    """
+    應用程式共用的工作池集合 (設定見 config.WORKER_POOLS)，所有背景工作都經由這裡派送。
+
+    - get(name)：取得 (必要時建立) 具名工作池，可當作 Executor 使用。
+    - dispatch(name, fn, ...)：發出即忘的背景工作；被拒絕時返回 None，失敗的例外會記錄到日誌。
+    - schedule(delay, name, fn, ...)：延遲後再派送到工作池 (取代 threading.Timer)。
+    - shutdown()：關閉時讓執行中的工作在期限內結束；設定 drain_on_shutdown 的工作池 (例如回合後的持久化) 會先把佇列做完。
+    """
+
+    def __init__(self, pool_configs: Dict[str, Dict[str, Any]]):
+        self.pool_configs = pool_configs
+        self._pools: Dict[str, WorkerPool] = {}
+        self._lock = threading.Lock()
+        self._timers: List[Tuple[float, int, str, Callable, tuple, dict]] = []
+        self._timer_cond = threading.Condition()
+        self._timer_seq = itertools.count()
+        self._timer_thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def get(self, name: str) -> WorkerPool:
+        with self._lock:
+            pool = self._pools.get(name)
+            if pool is None:
+                if name not in self.pool_configs:
+                    raise KeyError(f"Unknown worker pool: {name}")
+                pool = self._pools[name] = WorkerPool(name, **self.pool_configs[name])
+            return pool
+
+    def dispatch(self, name: str, fn: Callable, *args, **kwargs) -> Optional[Future]:
+        try:
+            future = self.get(name).submit(fn, *args, **kwargs)
+        except RejectedJobError as e:
+            logging.warning(f"Background job {getattr(fn, '__name__', fn)} not dispatched: {e}")
+            return None
+        future.add_done_callback(lambda f: self._log_failure(name, fn, f))
+        return future
+
+    @staticmethod
+    def _log_failure(name: str, fn: Callable, future: Future):
+        if future.cancelled():
+            logging.info(f"Background job {getattr(fn, '__name__', fn)} in pool '{name}' was dropped.")
+            return
+        error = future.exception()
+        if error is not None:
+            logging.error(f"Background job {getattr(fn, '__name__', fn)} in pool '{name}' failed: {error}", exc_info=error)
+
+    def schedule(self, delay: float, name: str, fn: Callable, *args, **kwargs):
+        """delay 秒後把工作派送到指定工作池 (由單一排程執行緒管理所有延遲工作)"""
+        with self._timer_cond:
+            if self._closed:
+                return
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_seq), name, fn, args, kwargs))
+            if self._timer_thread is None:
+                self._timer_thread = threading.Thread(target=self._timer_loop, name="WorkerScheduler", daemon=True)
+                self._timer_thread.start()
+            self._timer_cond.notify()
+
+    def _timer_loop(self):
+        while True:
+            with self._timer_cond:
+                while not self._closed and (not self._timers or self._timers[0][0] > time.monotonic()):
+                    self._timer_cond.wait(self._timers[0][0] - time.monotonic() if self._timers else None)
+                if self._closed:
+                    return
+                _, _, name, fn, args, kwargs = heapq.heappop(self._timers)
+            self.dispatch(name, fn, *args, **kwargs)
+
+    def shutdown(self, timeout: float = config.WORKER_POOL_SHUTDOWN_TIMEOUT_SECONDS) -> Dict[str, int]:
+        """停止所有工作池；返回逾時後各池仍未完成的工作數 (工作執行緒為 daemon，不會阻擋程式結束)"""
+        with self._timer_cond:
+            self._closed = True
+            self._timers.clear()
+            self._timer_cond.notify_all()
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.begin_shutdown(cancel_futures=not pool.drain_on_shutdown)
+        deadline = time.monotonic() + timeout
+        leftover = {}
+        for pool in pools:
+            remaining = pool.wait_idle(max(0.0, deadline - time.monotonic()))
+            if remaining:
+                leftover[pool.name] = remaining
+        if leftover:
+            logging.warning(f"Worker pools still busy after {timeout:.0f}s shutdown timeout: {leftover}")
+        else:
+            logging.info("All worker pools shut down cleanly.")
+        return leftover
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            pools = dict(self._pools)
+        with self._timer_cond:
+            scheduled = len(self._timers)
+        stats = {name: pool.get_stats() for name, pool in pools.items()}
+        stats["scheduled"] = {"pending": scheduled}
+        return stats
+
+
+# 整個應用程式共用的工作池
+worker_pools = WorkerPoolManager(config.WORKER_POOLS)
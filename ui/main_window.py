@@ -1,14 +1,14 @@
 # ui/main_window.py (Part 1/3)
 import tkinter as tk
-from tkinter import scrolledtext, ttk, messagebox, simpledialog
+from tkinter import scrolledtext, ttk, messagebox, simpledialog, filedialog
 from PIL import Image, ImageTk
 import logging
-import threading
 import os
 from datetime import datetime
 from typing import Optional, Dict, Any 
 import config
 from core.pet_logic import PetLogic
+from services.worker_pool import worker_pools
 from ui.settings_window import SettingsWindow # 稍後會建立這個檔案
 import random
 class MainWindow:
@@ -26,6 +26,9 @@ class MainWindow:
         self.user_input_entry: Optional[ttk.Entry] = None
         self.current_pet_image: Optional[ImageTk.PhotoImage] = None
         self.settings_window_instance: Optional[tk.Toplevel] = None
+        # 串流中的回應：以 stream_start / stream_end 兩個 mark 標記其在聊天視窗中的範圍
+        self._streaming_message_active = False
+        self._streamed_char_count = 0
         
         # --- 計時器 ID ---
         self._periodic_update_id: Optional[str] = None
@@ -60,6 +63,17 @@ class MainWindow:
                 messagebox.showerror("失敗", "API 金鑰無效或模型初始化失敗，請重試或檢查金鑰。", parent=self.root)
         else:
             messagebox.showwarning("未設定", "未提供 API 金鑰。LLM 功能將無法使用。", parent=self.root)
+    def on_services_ready(self, llm_error: Optional[str] = None):
+        """背景服務建構完成後 (由 main 排到 UI 執行緒) 呼叫；LLM 無法使用時改為受限模式"""
+        if not self.root or not self.root.winfo_exists(): return
+        if self.logic.llm is not None:
+            return
+        if llm_error:
+            messagebox.showwarning("LLM 警告", f"啟動時初始化 Gemini 模型失敗：{llm_error}\n將以有限模式啟動，請檢查設定。", parent=self.root)
+        if self.user_input_entry:  # 先前以完整介面顯示 (有金鑰)，改為受限模式
+            self.user_input_entry = None
+            self._setup_minimal_ui_for_error("LLM 模型尚未就緒。\n請點擊「設定API金鑰」按鈕或透過選單設定。")
+            self.update_pet_appearance(self.logic.get_initial_state()["dominant_emotion"])
     def rebuild_full_ui(self):
         """銷毀當前 UI (無論是最小化還是完整的)，並重建完整的 UI。"""
         if self._periodic_update_id:
@@ -141,6 +155,7 @@ class MainWindow:
         file_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="檔案", menu=file_menu)
         file_menu.add_command(label="設定", command=self._open_settings)
+        file_menu.add_command(label="匯入知識文件...", command=self._import_knowledge_document)
         file_menu.add_separator()
         file_menu.add_command(label="離開", command=self.on_close)
 
@@ -193,16 +208,16 @@ class MainWindow:
             args = (triggered_feedback_type, feedback_content)
         else:
             target_method = self.logic.handle_user_input
-            args = (user_text,)
+            args = (user_text, self._schedule_stream_text)
 
         # 禁用輸入框，顯示思考中
         self.user_input_entry.config(state=tk.DISABLED)
         self.update_pet_appearance("thinking")
 
-        # 使用執行緒處理耗時的邏輯，避免UI卡死
-        thread = threading.Thread(target=self._process_response_worker, args=(target_method, args))
-        thread.daemon = True
-        thread.start()
+        # 交給 ui_submit 工作池處理耗時的邏輯，避免UI卡死
+        if worker_pools.dispatch("ui_submit", self._process_response_worker, target_method, args) is None:
+            self._add_chat_message("系統", "小星還在忙上一件事，請稍後再試。", "error")
+            self.user_input_entry.config(state=tk.NORMAL)
 
     def _process_response_worker(self, target_method, args):
         """
@@ -216,7 +231,7 @@ class MainWindow:
             
             # 處理完畢後，將UI更新操作交回主執行緒
             if result and self.root and self.root.winfo_exists():
-                self.root.after(0, self._finalize_response, result)
+                self.root.after(0, self._finalize_response, result, True)
         except Exception as e:
             logging.error(f"Error in worker thread for {target_method.__name__}: {e}", exc_info=True)
             # 即使發生錯誤，也要確保UI可以恢復
@@ -226,29 +241,90 @@ class MainWindow:
                 "tag": "error"
             }
             if self.root and self.root.winfo_exists():
-                self.root.after(0, self._finalize_response, error_result)
+                self.root.after(0, self._finalize_response, error_result, True)
         finally:
             # 確保輸入框在任何情況下都會被重新啟用
             if self.root and self.root.winfo_exists():
                  self.root.after(1, lambda: self.user_input_entry.config(state=tk.NORMAL) if self.user_input_entry else None)
 
-    def _finalize_response(self, result: Dict[str, Any]):
-        """在主執行緒中安全地更新UI，現在會顯示內心思考。"""
+    def _schedule_stream_text(self, delta: str):
+        """串流回呼 (在背景執行緒中被呼叫)：把新增文字交回主執行緒顯示"""
+        if self.root and self.root.winfo_exists():
+            self.root.after(0, self._append_stream_text, delta)
+
+    def _append_stream_text(self, delta: str):
+        """在主執行緒中把串流文字接到目前的回應訊息後面，必要時先建立訊息"""
+        if not self.chat_history_text or not self.chat_history_text.winfo_exists():
+            return
+        try:
+            widget = self.chat_history_text
+            widget.config(state=tk.NORMAL)
+            if not self._streaming_message_active:
+                # 兩個 mark 都是 LEFT gravity：串流期間加在 END 的其他訊息 (主動訊息、提醒等) 會排在 stream_end 之後，
+                # 定案時刪除的 stream_start ~ stream_end 範圍只會有串流文字
+                widget.mark_set("stream_start", "end-1c")
+                widget.mark_gravity("stream_start", tk.LEFT)
+                separator = "\n" if widget.index('end-1c') != "1.0" else ""
+                timestamp = datetime.now().strftime("%H:%M")
+                widget.insert(tk.END, f"{separator}[{timestamp}] 小星: ", "pet")
+                widget.mark_set("stream_end", "end-1c")
+                widget.mark_gravity("stream_end", tk.LEFT)
+                self._streaming_message_active = True
+                self._streamed_char_count = 0
+            remaining = 1000 - self._streamed_char_count
+            if remaining > 0:
+                chunk = delta[:remaining]
+                # 只在插入串流文字的這一刻讓 stream_end 跟著右移 (全在主執行緒中，其他訊息不會插進來)
+                widget.mark_gravity("stream_end", tk.RIGHT)
+                widget.insert("stream_end", chunk, "pet")
+                widget.mark_gravity("stream_end", tk.LEFT)
+                self._streamed_char_count += len(chunk)
+            widget.see(tk.END)
+            widget.config(state=tk.DISABLED)
+        except tk.TclError as e:
+            logging.error(f"TclError appending streamed text (widget might be destroyed): {e}")
+
+    def _take_streamed_message_position(self) -> str:
+        """移除串流中的暫時訊息，返回最終訊息應插入的位置"""
+        if not self._streaming_message_active:
+            return tk.END
+        self._streaming_message_active = False
+        if not self.chat_history_text or not self.chat_history_text.winfo_exists():
+            return tk.END
+        try:
+            widget = self.chat_history_text
+            widget.config(state=tk.NORMAL)
+            widget.delete("stream_start", "stream_end")
+            widget.mark_gravity("stream_start", tk.RIGHT)  # 之後依序插入的訊息會排在 mark 之前
+            widget.config(state=tk.DISABLED)
+            return "stream_start"
+        except tk.TclError as e:
+            logging.error(f"TclError removing streamed message: {e}")
+            return tk.END
+
+    def _finalize_response(self, result: Dict[str, Any], replaces_stream: bool = False):
+        """
+        在主執行緒中安全地更新UI，現在會顯示內心思考。
+        replaces_stream: 為 True 時，以最終結果取代串流中顯示的暫時訊息 (位置不變)。
+        """
         if not self.root or not self.root.winfo_exists():
             return
 
+        position = self._take_streamed_message_position() if replaces_stream else tk.END
+
         # 顯示內心思考
         internal_thought = result.get("internal_thought")
         if internal_thought:
             # 使用新的 "thought" 標籤
-            self._add_chat_message("小星 (思考)", internal_thought, "thought")
+            self._add_chat_message("小星 (思考)", internal_thought, "thought", position)
 
         # 顯示口頭回應
         if "display_text" in result and result["display_text"]:
             self._add_chat_message(
                 "小星",
                 result["display_text"],
-                result.get("tag", "pet")
+                result.get("tag", "pet"),
+                position
             )
         
         if "new_emotion_for_ui" in result:
@@ -258,8 +334,8 @@ class MainWindow:
             self.user_input_entry.config(state=tk.NORMAL)
             self.user_input_entry.focus_set()
 
-    def _add_chat_message(self, sender: str, message: str, tag: str):
-        """安全地將訊息新增到聊天視窗"""
+    def _add_chat_message(self, sender: str, message: str, tag: str, index: str = tk.END):
+        """安全地將訊息新增到聊天視窗 (預設加在最後，index 可指定插入位置)"""
         if not self.chat_history_text or not self.chat_history_text.winfo_exists():
             logging.warning(f"Chat history UI not available for message: [{sender}]")
             return
@@ -268,14 +344,14 @@ class MainWindow:
             self.chat_history_text.config(state=tk.NORMAL)
             
             # 確保訊息之間有換行
-            if self.chat_history_text.index('end-1c') != "1.0":
-                self.chat_history_text.insert(tk.END, "\n")
+            if self.chat_history_text.index('end-1c' if index == tk.END else index) != "1.0":
+                self.chat_history_text.insert(index, "\n")
             
             timestamp = datetime.now().strftime("%H:%M")
             display_message = message_str[:1000] + ("..." if len(message_str) > 1000 else "")
             
             formatted_message = f"[{timestamp}] {sender}: {display_message}"
-            self.chat_history_text.insert(tk.END, formatted_message, tag)
+            self.chat_history_text.insert(index, formatted_message, tag)
             self.chat_history_text.see(tk.END) # 自動捲動到底部
             self.chat_history_text.config(state=tk.DISABLED)
         except tk.TclError as e:
@@ -307,14 +383,29 @@ class MainWindow:
             self.root.after(10000, self._periodic_update)
             return
 
-        # 執行緒化以避免阻塞UI
-        thread = threading.Thread(target=self._periodic_worker)
-        thread.daemon = True
-        thread.start()
+        # 交給 periodic 工作池以避免阻塞UI (上一次還在執行時，這次會被略過)
+        worker_pools.dispatch("periodic", self._periodic_worker)
 
         # 重新排程下一次更新
         self._periodic_update_id = self.root.after(random.randint(15000, 25000), self._periodic_update)
 
+    def _import_knowledge_document(self):
+        """選擇文字檔並匯入本地知識庫 (custom_search 工具會先查詢本地知識庫)"""
+        file_path = filedialog.askopenfilename(
+            title="匯入知識文件", filetypes=[("文字檔", "*.txt *.md"), ("所有檔案", "*.*")]
+        )
+        if not file_path:
+            return
+        try:
+            chunks = self.logic.import_knowledge_document(file_path)
+        except OSError as e:
+            messagebox.showerror("匯入失敗", f"無法讀取檔案：{e}")
+            return
+        if chunks:
+            messagebox.showinfo("匯入完成", f"已將「{os.path.basename(file_path)}」匯入知識庫 ({chunks} 個片段)。")
+        else:
+            messagebox.showwarning("匯入失敗", "本地知識庫無法使用，或檔案沒有內容。")
+
     def _periodic_worker(self):
         """在背景執行緒中執行定期的核心邏輯檢查"""
         try:
@@ -351,6 +442,7 @@ class MainWindow:
             self.root.after_cancel(self._periodic_update_id)
             self._periodic_update_id = None
         
-        # (可選) 可以在此處加入儲存最終狀態的邏輯
-        
+        # 讓回合後的記憶寫入在期限內完成，並保存對話狀態
+        self.logic.shutdown()
+
         self.root.destroy()
\ No newline at end of file
@@ -494,7 +494,8 @@ class SettingsWindow(tk.Toplevel):
         if messagebox.askyesno("確認忘記", confirm_msg, parent=self):
             # 呼叫資料庫管理員直接刪除
             if self.logic.db.delete_individual_characteristic(trait_id_to_delete):
-                # 操作成功後，刷新核心邏輯的快取和UI列表
+                # 操作成功後，刷新核心邏輯的快取、近似重複索引和UI列表
+                self.logic.personality_system.forget_characteristics([trait_id_to_delete])
                 self.logic.personality_system.load_characteristics_cache(min_relevance=0.01)
                 self._load_and_display_characteristics()
                 messagebox.showinfo("操作成功", "小星已經忘記了該特徵。", parent=self)
@@ -521,6 +522,7 @@ class SettingsWindow(tk.Toplevel):
                 self.logic.personality_system.demographics[key] = var.get()
             # 儲存更新後的人口統計資料
             self.logic.db.save_demographics(self.logic.user_id, self.logic.personality_system.demographics)
+            self.logic.personality_system.mark_state_changed("traits", "demographics")
 
             # --- 套用 API & Model Tab 設定 ---
             previous_model = self.logic.settings.get(config.SETTING_SELECTED_LLM)